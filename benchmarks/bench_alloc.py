@@ -0,0 +1,31 @@
+"""Compare the malloc and pool allocators on allocation heavy scripts.
+
+    python benchmarks/bench_alloc.py
+"""
+import timeit
+
+import duktape
+
+SCRIPTS = {
+    'objects': '(function() { var a = []; for (var i = 0; i < 20000; i++) { a.push({i: i, s: "x" + i}); } })',
+    'strings': '(function() { var s = ""; for (var i = 0; i < 20000; i++) { s = (s + i).slice(-64); } })',
+    'closures': '(function() { var f = []; for (var i = 0; i < 20000; i++) { f.push(function() { return i; }); } })',
+}
+
+
+def bench(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e3
+
+
+def main():
+    print('%10s %12s %12s %12s' % ('script', 'malloc', 'pool', 'peak'))
+    for name, script in SCRIPTS.items():
+        times = []
+        for allocator in ('malloc', 'pool'):
+            ctx = duktape.Context(allocator=allocator)
+            times.append(bench(ctx.eval(script), 20))
+        print('%10s %10.2fms %10.2fms %10dK' % (name, times[0], times[1], ctx.memory_stats().peak // 1024))
+
+
+if __name__ == '__main__':
+    main()
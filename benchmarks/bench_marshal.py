@@ -0,0 +1,63 @@
+"""Compare recursive and JSON marshalling of plain data.
+
+For growing payload sizes prints the time needed to:
+
+* push a list of records with the recursive conversion and as a JSON
+  string decoded with ``JSON.parse``
+* read it back with the recursive conversion and with
+  ``Context.get_json``
+
+Duktape's JSON decoder is slower than the recursive push at every size,
+so JSON marshalling is only used when reading values back. Reading is only
+marginally faster through JSON, not enough to pay for checking that a value
+is plain JSON data first, so it is opt-in (``Context(marshal="json")`` or
+``Context.get_json``) rather than picked automatically.
+
+    python benchmarks/bench_marshal.py
+"""
+import json
+import timeit
+
+import duktape
+
+
+def record(i):
+    return {'id': i, 'name': 'item %d' % i, 'price': i * 1.5, 'tags': ['a', 'b'], 'active': True}
+
+
+def bench(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    ctx = duktape.Context()
+    parse_data = ctx.eval('(function(s) { data = JSON.parse(s); })')
+    get_data = ctx.eval('(function() { return data; })')
+
+    print('%8s %12s %12s %12s %12s' % ('size', 'push native', 'push json', 'get native', 'get json'))
+    for size in [1, 2, 4, 8, 16, 32, 64, 128, 256, 1024, 4096]:
+        data = [record(i) for i in range(size)]
+        number = max(10, 20000 // size)
+
+        def push_native():
+            ctx['data'] = data
+
+        def push_json():
+            parse_data(json.dumps(data))
+
+        def get_native():
+            get_data()
+
+        def get_json():
+            ctx.get_json('data')
+
+        print('%8d %10.1fus %10.1fus %10.1fus %10.1fus' % (
+            size,
+            bench(push_native, number),
+            bench(push_json, number),
+            bench(get_native, number),
+            bench(get_json, number)))
+
+
+if __name__ == '__main__':
+    main()
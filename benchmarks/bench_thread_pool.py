@@ -0,0 +1,42 @@
+"""Compare the ways of running a request in isolated globals.
+
+Each request evaluates a small script in a fresh global environment, either:
+
+* ``thread``: a new ``ctx.new_thread(True)`` per request,
+* ``pool``: a thread checked out of ``ctx.thread_pool()``, whose globals are
+  restored on release,
+* ``context``: a new ``duktape.Context()`` per request.
+
+    python benchmarks/bench_thread_pool.py
+"""
+import timeit
+
+import duktape
+
+SCRIPT = 'var items = []; for (var i = 0; i < 10; i++) items.push(i * 2); items.length'
+
+
+def bench(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    ctx = duktape.Context()
+    pool = ctx.thread_pool(size=4)
+
+    def thread():
+        ctx.new_thread(True).eval(SCRIPT)
+
+    def pooled():
+        with pool.checkout() as thread:
+            thread.eval(SCRIPT)
+
+    def context():
+        duktape.Context().eval(SCRIPT)
+
+    for name, func in [('thread', thread), ('pool', pooled), ('context', context)]:
+        print('%-8s %8.1fus/request' % (name, bench(func, 1000)))
+
+
+if __name__ == '__main__':
+    main()
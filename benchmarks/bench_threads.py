@@ -0,0 +1,55 @@
+"""Measure the scaling of CPU-bound scripts across threads.
+
+Runs the same script in 1, 2, 4, ... threads (up to the number of CPUs),
+each thread with its own context, with and without ``release_gil``, and
+prints the wall time and the speedup over a single thread. Without
+releasing the GIL the threads execute one at a time.
+
+    python benchmarks/bench_threads.py
+"""
+import os
+import threading
+import time
+
+import duktape
+
+SCRIPT = '''
+var n = 0;
+for (var i = 0; i < 2000000; i++) {
+    n = (n + i * i) % 1000003;
+}
+n
+'''
+
+
+def run(threads, release_gil):
+    contexts = [duktape.Context(release_gil=release_gil) for i in range(threads)]
+    workers = [threading.Thread(target=ctx.eval, args=(SCRIPT,)) for ctx in contexts]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - started
+
+
+def main():
+    cpus = os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] * 2 <= cpus:
+        counts.append(counts[-1] * 2)
+
+    print('%8s %12s %8s %12s %8s' % ('threads', 'gil', 'speedup', 'nogil', 'speedup'))
+    base = {}
+    for threads in counts:
+        row = []
+        for release_gil in (False, True):
+            elapsed = min(run(threads, release_gil) for i in range(3))
+            base.setdefault(release_gil, elapsed)
+            # speedup in throughput: threads scripts in elapsed seconds
+            row += [elapsed, base[release_gil] * threads / elapsed]
+        print('%8d %11.3fs %7.2fx %11.3fs %7.2fx' % (threads, *row))
+
+
+if __name__ == '__main__':
+    main()
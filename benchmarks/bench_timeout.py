@@ -0,0 +1,47 @@
+"""Measure the overhead of the execution limits.
+
+Runs a CPU-bound loop with growing iteration counts in a context without
+limits, with a timeout, with an instruction budget and with both, and
+prints the time of each run and the overhead over the unlimited one.
+
+Duktape checks the limits every ``duktape.EXEC_CHECK_INTERVAL`` bytecode
+instructions (fixed at build time), the columns show how the overhead
+changes with the number of checks performed by a call.
+
+    python benchmarks/bench_timeout.py
+"""
+import timeit
+
+import duktape
+
+SCRIPT = '(function(n) { var x = 0; for (var i = 0; i < n; i++) { x = (x + i) % 7919; } return x; })'
+
+
+def bench(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e3
+
+
+def main():
+    contexts = {
+        'none': duktape.Context(),
+        'timeout': duktape.Context(timeout=3600),
+        'max_ops': duktape.Context(max_ops=10 ** 15),
+        'both': duktape.Context(timeout=3600, max_ops=10 ** 15),
+    }
+    funcs = {name: ctx.eval(SCRIPT) for name, ctx in contexts.items()}
+
+    print('%10s %8s' % ('loops', 'checks') + ''.join('%18s' % name for name in funcs))
+    for loops in [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]:
+        number = max(1, 10 ** 6 // loops)
+        times = {name: bench(lambda: func(loops), number) for name, func in funcs.items()}
+        # roughly 6 instructions per iteration
+        checks = loops * 6 // duktape.EXEC_CHECK_INTERVAL
+        row = '%10d %8d' % (loops, checks)
+        for name in funcs:
+            overhead = (times[name] / times['none'] - 1) * 100
+            row += '%10.3fms %+5.1f%%' % (times[name], overhead)
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
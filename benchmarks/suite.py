@@ -0,0 +1,235 @@
+"""Benchmark suite of the bridge's hot paths.
+
+Each case times one operation (context creation, eval, require, conversions
+both ways, proxy access, calls in both directions, ...) and reports the best
+of several runs in microseconds per operation, so results are comparable
+between runs on the same machine.
+
+    python benchmarks/suite.py                          # run and print
+    python benchmarks/suite.py --save results.json      # also save them
+    python benchmarks/suite.py --compare benchmarks/baseline.json
+
+--compare prints the change of every case against a saved run and exits
+with status 1 when a case is slower by more than --threshold (default 10%).
+benchmarks/baseline.json holds a reference run; regenerate it with --save
+on the machine used for comparisons. --filter only runs the cases whose
+name contains the given string.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import timeit
+
+import duktape
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+NODE_MODULES = os.path.join(HERE, os.pardir, 'test', 'node_modules')
+
+CASES = {}
+
+
+def case(number):
+    # registers a setup function returning the operation to time, called
+    # number times per run
+    def register(setup):
+        CASES[setup.__name__] = (setup, number)
+        return setup
+    return register
+
+
+WIDE = {'key%d' % i: i for i in range(1000)}
+DEEP = [1]
+for i in range(100):
+    DEEP = [DEEP]
+STRINGS = ['string number %d with some text' % i for i in range(1000)]
+ASTRAL = ['emoji \U0001F600 number %d \U0001F680' % i for i in range(1000)]
+LARGE_SCRIPT = '\n'.join('function f%d(x) { return x * %d + 1; }' % (i, i) for i in range(2000))
+
+
+@case(200)
+def context_create():
+    return duktape.Context
+
+
+@case(10000)
+def eval_small():
+    ctx = duktape.Context(compile_cache_size=0)
+    return lambda: ctx.eval('1 + 1')
+
+
+@case(20)
+def eval_large():
+    ctx = duktape.Context(compile_cache_size=0)
+    return lambda: ctx.eval(LARGE_SCRIPT)
+
+
+@case(200)
+def load_require():
+    tmp_dir = tempfile.mkdtemp()
+    main = os.path.join(tmp_dir, 'main.js')
+    with open(main, 'w') as f:
+        f.write('var a = require("a"), c = require("c");')
+
+    def load():
+        duktape.Context(module_path=NODE_MODULES).load(main)
+    return load
+
+
+def to_js_case(value):
+    ctx = duktape.Context()
+
+    def to_js():
+        ctx['value'] = value
+    return to_js
+
+
+def to_python_case(value):
+    ctx = duktape.Context()
+    ctx['value'] = value
+    return lambda: ctx['value']
+
+
+for name, value, number in [('wide', WIDE, 200), ('deep', DEEP, 2000),
+                            ('strings', STRINGS, 500), ('astral', ASTRAL, 500)]:
+    CASES['to_js_' + name] = (lambda value=value: to_js_case(value), number)
+    CASES['to_python_' + name] = (lambda value=value: to_python_case(value), number)
+
+
+@case(20000)
+def proxy_dict_get():
+    ctx = duktape.Context()
+    ctx.eval('var obj = {a: 1, b: "two", c: [3]}')
+    obj = ctx.proxy('obj')
+    return lambda: obj['b']
+
+
+@case(50)
+def proxy_array_iter():
+    ctx = duktape.Context()
+    ctx.eval('var arr = []; for (var i = 0; i < 10000; i++) arr.push(i);')
+    arr = ctx.proxy('arr')
+    return lambda: list(arr)
+
+
+@case(20000)
+def jsfunc_call():
+    ctx = duktape.Context()
+    func = ctx.eval('(function(a, b) { return a + b; })')
+    return lambda: func(1, 2)
+
+
+@case(50)
+def py_callback():
+    ctx = duktape.Context()
+    ctx['add'] = duktape.PyFunc(lambda a, b: a + b, 2)
+    func = ctx.eval('(function() { var x = 0; for (var i = 0; i < 1000; i++) x = add(x, i); return x; })')
+    return func
+
+
+@case(50)
+def py_callback_typed():
+    ctx = duktape.Context()
+    ctx['add'] = duktape.PyFunc(lambda a, b: a + b, signature=(int, int))
+    func = ctx.eval('(function() { var x = 0; for (var i = 0; i < 1000; i++) x = add(x, i); return x; })')
+    return func
+
+
+@case(10000)
+def datetime_roundtrip():
+    ctx = duktape.Context()
+    now = datetime.datetime(2020, 1, 2, 3, 4, 5, 6000)
+
+    def roundtrip():
+        ctx['date'] = now
+        return ctx['date']
+    return roundtrip
+
+
+@case(1000)
+def thread_create():
+    ctx = duktape.Context()
+    return lambda: ctx.new_thread(True)
+
+
+NAMESPACE = {'f%d' % i: duktape.PyFunc(lambda a: a, 1) for i in range(200)}
+
+
+@case(100)
+def namespace_setitem():
+    ctx = duktape.Context()
+
+    def setitem():
+        ctx['api'] = NAMESPACE
+    return setitem
+
+
+@case(100)
+def namespace_register():
+    ctx = duktape.Context()
+    table = duktape.FunctionTable(NAMESPACE)
+    return lambda: ctx.register('api', table)
+
+
+def run(names, repeat):
+    results = {}
+    for name in names:
+        setup, number = CASES[name]
+        func = setup()
+        func()
+        results[name] = min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+        print('%-22s %12.2fus' % (name, results[name]))
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print('\n%-22s %12s %12s %8s' % ('case', 'baseline', 'current', 'change'))
+    for name, current in results.items():
+        if name not in baseline:
+            print('%-22s %12s %11.2fus' % (name, '-', current))
+            continue
+        change = current / baseline[name] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-22s %11.2fus %11.2fus %+7.1f%%%s' % (name, baseline[name], current,
+                                                       change * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--save', metavar='FILE', help='save the results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare with saved results')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown reported as a regression (default: 0.1)')
+    parser.add_argument('--filter', default='', help='only run the matching cases')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per case (default: 5)')
+    args = parser.parse_args()
+
+    names = [name for name in CASES if args.filter in name]
+    results = run(names, args.repeat)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
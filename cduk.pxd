@@ -12,18 +12,25 @@ cdef extern from "duktape_c/duk_config.h":
     ctypedef duk_uint_t duk_uarridx_t
     ctypedef duk_int_t duk_errcode_t
 
-cdef extern from "duktape_c/duktape.h":
+cdef extern from "duktape_c/duktape.h" nogil:
     ctypedef duk_ret_t (*duk_c_function)(duk_context *ctx)
     ctypedef void *(*duk_alloc_function) (void *udata, duk_size_t size)
     ctypedef void *(*duk_realloc_function) (void *udata, void *ptr, duk_size_t size)
     ctypedef void (*duk_free_function) (void *udata, void *ptr)
     ctypedef void (*duk_fatal_function) (void *udata, const char *msg)
+    ctypedef duk_ret_t (*duk_safe_call_function) (duk_context *ctx, void *udata)
 
     ctypedef struct duk_function_list_entry:
         const char *key
         duk_c_function value
         duk_idx_t nargs
 
+    ctypedef struct duk_memory_functions:
+        duk_alloc_function alloc_func
+        duk_realloc_function realloc_func
+        duk_free_function free_func
+        void *udata
+
     ctypedef struct duk_thread_state:
         char data[128]
 
@@ -35,11 +42,17 @@ cdef extern from "duktape_c/duktape.h":
     unsigned int DUK_TYPE_STRING
     unsigned int DUK_TYPE_OBJECT
 
+    unsigned int DUK_BUFOBJ_ARRAYBUFFER
+    unsigned int DUK_BUFOBJ_UINT8ARRAY
+
     unsigned int DUK_COMPILE_EVAL
     unsigned int DUK_COMPILE_FUNCTION
     unsigned int DUK_COMPILE_STRICT
     unsigned int DUK_COMPILE_SHEBANG
 
+    unsigned int DUK_DEFPROP_HAVE_VALUE
+    unsigned int DUK_DEFPROP_FORCE
+
     unsigned int DUK_ENUM_OWN_PROPERTIES_ONLY
     unsigned int DUK_RET_TYPE_ERROR
 
@@ -47,19 +60,26 @@ cdef extern from "duktape_c/duktape.h":
 
     duk_int_t DUK_VARARGS
 
+    long DUK_VERSION
+
     void duk_concat(duk_context *ctx, duk_idx_t count)
     duk_context *duk_create_heap(duk_alloc_function alloc_func, duk_realloc_function realloc_func, duk_free_function free_func, void *heap_udata, duk_fatal_function fatal_handler)
     duk_context *duk_create_heap_default() # macro
+    void duk_def_prop(duk_context *ctx, duk_idx_t obj_idx, duk_uint_t flags)
     void duk_destroy_heap(duk_context* ctx)
+    void duk_dump_function(duk_context *ctx)
     void duk_dup(duk_context *ctx, duk_idx_t from_idx)
     void duk_enum(duk_context *ctx, duk_idx_t obj_idx, duk_uint_t enum_flags)
     void duk_gc(duk_context *ctx, duk_uint_t flags)
     duk_bool_t duk_get_boolean(duk_context *ctx, duk_idx_t idx)
+    void *duk_get_buffer(duk_context *ctx, duk_idx_t idx, duk_size_t *out_size)
+    void *duk_get_buffer_data(duk_context *ctx, duk_idx_t idx, duk_size_t *out_size)
     duk_context *duk_get_context(duk_context *ctx, duk_idx_t idx)
     duk_bool_t duk_get_global_string(duk_context *ctx, const char *key)
     void *duk_get_heapptr(duk_context *ctx, duk_idx_t idx)
     duk_size_t duk_get_length(duk_context *ctx, duk_idx_t idx)
     const char *duk_get_lstring(duk_context *ctx, duk_idx_t idx, duk_size_t *out_len)
+    void duk_get_memory_functions(duk_context *ctx, duk_memory_functions *out_funcs)
     const char *duk_require_lstring(duk_context *ctx, duk_idx_t idx, duk_size_t *out_len)
     const char *duk_require_string(duk_context *ctx, duk_idx_t idx)
     duk_double_t duk_get_number(duk_context *ctx, duk_idx_t idx)
@@ -67,13 +87,17 @@ cdef extern from "duktape_c/duktape.h":
     duk_bool_t duk_get_prop_index(duk_context *ctx, duk_idx_t obj_idx, duk_uarridx_t arr_idx)
     duk_bool_t duk_get_prop_string(duk_context *ctx, duk_idx_t obj_idx, const char *key)
     duk_bool_t duk_has_prop_string(duk_context *ctx, duk_idx_t obj_idx, const char *key)
+    void duk_get_prop_desc(duk_context *ctx, duk_idx_t obj_idx, duk_uint_t flags)
     duk_idx_t duk_get_top(duk_context *ctx)
+    void duk_set_top(duk_context *ctx, duk_idx_t idx)
     duk_int_t duk_get_type(duk_context *ctx, duk_idx_t idx)
     void duk_insert(duk_context *ctx, duk_idx_t to_idx)
     duk_bool_t duk_is_array(duk_context *ctx, duk_idx_t idx)
+    duk_bool_t duk_is_buffer_data(duk_context *ctx, duk_idx_t idx)
     duk_bool_t duk_is_boolean(duk_context *ctx, duk_idx_t idx)
     duk_bool_t duk_is_error(duk_context *ctx, duk_idx_t idx)
     duk_bool_t duk_is_function(duk_context *ctx, duk_idx_t idx)
+    duk_bool_t duk_is_lightfunc(duk_context *ctx, duk_idx_t idx) # macro
     duk_bool_t duk_is_nan(duk_context *ctx, duk_idx_t idx)
     duk_bool_t duk_is_null(duk_context *ctx, duk_idx_t idx)
     duk_bool_t duk_is_undefined(duk_context *ctx, duk_idx_t idx)
@@ -83,6 +107,7 @@ cdef extern from "duktape_c/duktape.h":
     duk_bool_t duk_is_string(duk_context *ctx, duk_idx_t idx)
     duk_bool_t duk_is_symbol(duk_context *ctx, duk_idx_t idx)
     void duk_join(duk_context *ctx, duk_idx_t count)
+    void duk_load_function(duk_context *ctx)
     duk_bool_t duk_next(duk_context *ctx, duk_idx_t enum_idx, duk_bool_t get_value)
     duk_idx_t duk_normalize_index(duk_context *ctx, duk_idx_t idx)
     duk_int_t duk_pcall(duk_context *ctx, duk_idx_t nargs)
@@ -93,15 +118,26 @@ cdef extern from "duktape_c/duktape.h":
     void duk_pop(duk_context *ctx)
     void duk_pop_n(duk_context *ctx, duk_idx_t count)
     duk_idx_t duk_push_array(duk_context *ctx)
+    duk_idx_t duk_push_bare_object(duk_context *ctx)
+    duk_idx_t duk_push_bare_array(duk_context *ctx)
     duk_idx_t duk_push_c_function(duk_context *ctx, duk_c_function func, duk_idx_t nargs)
+    duk_idx_t duk_push_c_lightfunc(duk_context *ctx, duk_c_function func, duk_idx_t nargs, duk_idx_t length, duk_int_t magic)
+    void duk_push_boolean(duk_context *ctx, duk_bool_t val)
     void duk_push_current_function(duk_context *ctx)
     void duk_push_false(duk_context *ctx)
+    void *duk_push_fixed_buffer(duk_context *ctx, duk_size_t size) # macro
+    void duk_push_external_buffer(duk_context *ctx) # macro
+    void duk_push_buffer_object(duk_context *ctx, duk_idx_t idx_buffer, duk_size_t byte_offset, duk_size_t byte_length, duk_uint_t flags)
+    void duk_config_buffer(duk_context *ctx, duk_idx_t idx, void *ptr, duk_size_t len)
     void duk_push_context_dump(duk_context *ctx)
     void duk_push_global_object(duk_context *ctx)
     void duk_push_global_stash(duk_context *ctx)
     void duk_push_heap_stash(duk_context *ctx)
+    duk_idx_t duk_push_heapptr(duk_context *ctx, void *ptr)
     void duk_push_int(duk_context *ctx, duk_int_t val)
+    void duk_push_uint(duk_context *ctx, duk_uint_t val)
     const char *duk_push_lstring(duk_context *ctx, const char *str, duk_size_t len)
+    const char *duk_push_sprintf(duk_context *ctx, const char *fmt, ...)
     void duk_push_null(duk_context *ctx)
     void duk_push_number(duk_context *ctx, duk_double_t val)
     duk_idx_t duk_push_object(duk_context *ctx)
@@ -123,12 +159,19 @@ cdef extern from "duktape_c/duktape.h":
     duk_double_t duk_require_number(duk_context *ctx, duk_idx_t idx)
     void *duk_get_pointer(duk_context *ctx, duk_idx_t idx)
     const char *duk_get_string(duk_context *ctx, duk_idx_t idx)
+    duk_int_t duk_get_int(duk_context *ctx, duk_idx_t idx)
+    duk_bool_t duk_check_stack(duk_context *ctx, duk_idx_t extra)
+    void duk_inspect_callstack_entry(duk_context *ctx, duk_int_t level)
     void *duk_require_pointer(duk_context *ctx, duk_idx_t idx)
     void duk_require_stack(duk_context *ctx, duk_idx_t extra)
     const char *duk_safe_to_string(duk_context *ctx, duk_idx_t idx)
     void duk_set_finalizer(duk_context *ctx, duk_idx_t idx)
     const char *duk_to_string(duk_context *ctx, duk_idx_t idx)
+    void duk_to_object(duk_context *ctx, duk_idx_t idx)
+    duk_int_t duk_get_current_magic(duk_context *ctx)
+    void duk_set_magic(duk_context *ctx, duk_idx_t idx, duk_int_t magic)
     duk_ret_t duk_generic_error(duk_context *ctx, const char *fmt, ...)
+    duk_int_t duk_safe_call(duk_context *ctx, duk_safe_call_function func, void *udata, duk_idx_t nargs, duk_idx_t nrets)
     duk_idx_t duk_push_thread(duk_context *ctx)
     duk_idx_t duk_push_thread_new_globalenv(duk_context *ctx)
     void duk_push_thread_stash(duk_context *ctx, duk_context *target_ctx)
@@ -154,5 +197,32 @@ cdef extern from "duktape_c/duktape.h":
 cdef extern from "fileio.c":
     void fileio_push_file_string(duk_context *ctx, const char *filename)
 
+cdef extern from "heap_udata.c" nogil:
+    long HEAP_UDATA_CHECK_INTERVAL
+    ctypedef void (*heap_udata_sampler)(void *udata, duk_context *ctx)
+    ctypedef struct heap_udata:
+        size_t memory_limit
+        size_t memory_used
+        size_t memory_peak
+        size_t allocs
+        size_t reallocs
+        size_t frees
+        size_t failed
+        int pool
+        int depth
+        int timed_out
+        duk_context *exec_ctx
+        heap_udata_sampler sampler
+        void *profiler
+        double sample_interval
+        double next_sample
+        void *pyctx_ctx
+        void *pyctx
+    void heap_udata_arm(heap_udata *udata, double timeout, long long max_ops)
+    void *heap_udata_alloc(void *udata, duk_size_t size)
+    void *heap_udata_realloc(void *udata, void *ptr, duk_size_t size)
+    void heap_udata_free(void *udata, void *ptr)
+    void heap_udata_release_pool(heap_udata *udata)
+
 cdef extern from 'duktape_c/duk_module_node.c':
     cdef void duk_module_node_init(duk_context *ctx)
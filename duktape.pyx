@@ -2,18 +2,34 @@
 
 cimport cduk
 cimport cpython
+from cpython.buffer cimport PyBUF_CONTIG, PyBuffer_FillInfo, PyBuffer_Release, PyObject_GetBuffer
+cimport cython
 
+import asyncio
+import builtins
 import collections.abc
+import concurrent.futures
+import contextlib
 import datetime
+import functools
+import hashlib
+import heapq
 import importlib
+import inspect
+import itertools
 import json
+import mmap
+import multiprocessing
 import os
 import struct
-import weakref
+import threading
+import time
+import zipfile
 from collections import defaultdict
 from libc.stdio cimport printf
 from libc.stdint cimport uintptr_t
-from libc.string cimport strlen
+from libc.math cimport floor
+from libc.string cimport memchr, memcpy, memset, strlen, strncmp
 
 import pytz
 
@@ -24,72 +40,130 @@ class Error(Exception):
     pass
 
 
+class TimeoutError(Error, builtins.TimeoutError):
+    pass
+
+
 cdef force_unicode(bytes):
     return unicode_decode_cesu8(bytes, strlen(bytes))
 
 
+cdef extern from "Python.h":
+    int PyUnicode_KIND(object o)
+    int PyUnicode_4BYTE_KIND
+    const char *PyUnicode_AsUTF8AndSize(object o, Py_ssize_t *size) except NULL
+    str PyUnicode_DecodeUTF8(const char *s, Py_ssize_t size, const char *errors)
+
+
 cdef str unicode_decode_cesu8(const char* bytes, size_t length):
-    cdef size_t i
-    cdef const unsigned char *bytes2 = <const unsigned char *>bytes;
-    utf8_bytes = None
-    i = 0
-    while i < length:
-        if bytes2[i] == 0:
-            break
-
-        # CESU-8 surrogate pair?
-        # \xed[\xa0-\xaf][\x80-\xbf]\xed[\xb0-\xbf][\x80-\xbf]
-        if bytes2[i] == 0xed and i + 5 < length and \
-               0xa0 <= bytes2[i+1] <= 0xaf and \
-               0x80 <= bytes2[i+2] <= 0xbf and \
-           bytes2[i+3] == 0xed and \
-               0xb0 <= bytes2[i+4] <= 0xbf and \
-               0x80 <= bytes2[i+5] <= 0xbf:
-            if utf8_bytes is None:
-                utf8_bytes = bytearray(bytes2[:i])
-            # convert CESU-8 surrogate pair into UTF-8
-            utf8_bytes.append(0xf0 | (((bytes2[i+1]+1) & 0x1c) >> 2))
-            utf8_bytes.append(0x80 | (((bytes2[i+1]+1) & 0x03) << 4) | ((bytes2[i+2] & 0x3c) >> 2))
-            utf8_bytes.append(0x80 | ((bytes2[i+2] & 0x03) << 4) | (bytes2[i+4] & 0x0f))
-            utf8_bytes.append(bytes2[i+5])
-            i += 6
-        else:
-            if utf8_bytes is not None:
-                utf8_bytes.append(bytes2[i])
-            i += 1
-    return bytes.decode() if utf8_bytes is None else utf8_bytes.decode()
+    cdef size_t i, j
+    cdef const unsigned char *bytes2 = <const unsigned char *>bytes
+    cdef unsigned char *utf8_bytes
+    cdef const void *nul = memchr(bytes, 0, length)
+    if nul != NULL:
+        length = <const char*>nul - bytes
+
+    # CESU-8 and UTF-8 only differ for surrogates, which are encoded
+    # starting with \xed: without it the string is plain UTF-8
+    if memchr(bytes, 0xed, length) == NULL:
+        return PyUnicode_DecodeUTF8(bytes, length, NULL)
+
+    utf8_bytes = <unsigned char *>cpython.PyMem_Malloc(length)
+    if utf8_bytes == NULL:
+        raise MemoryError()
+    try:
+        i = j = 0
+        while i < length:
+            # CESU-8 surrogate pair?
+            # \xed[\xa0-\xaf][\x80-\xbf]\xed[\xb0-\xbf][\x80-\xbf]
+            if bytes2[i] == 0xed and i + 5 < length and \
+                   0xa0 <= bytes2[i+1] <= 0xaf and \
+                   0x80 <= bytes2[i+2] <= 0xbf and \
+               bytes2[i+3] == 0xed and \
+                   0xb0 <= bytes2[i+4] <= 0xbf and \
+                   0x80 <= bytes2[i+5] <= 0xbf:
+                # convert CESU-8 surrogate pair into UTF-8
+                utf8_bytes[j] = 0xf0 | (((bytes2[i+1]+1) & 0x1c) >> 2)
+                utf8_bytes[j+1] = 0x80 | (((bytes2[i+1]+1) & 0x03) << 4) | ((bytes2[i+2] & 0x3c) >> 2)
+                utf8_bytes[j+2] = 0x80 | ((bytes2[i+2] & 0x03) << 4) | (bytes2[i+4] & 0x0f)
+                utf8_bytes[j+3] = bytes2[i+5]
+                i += 6
+                j += 4
+            else:
+                utf8_bytes[j] = bytes2[i]
+                i += 1
+                j += 1
+        # unpaired surrogates are valid in javascript strings
+        return PyUnicode_DecodeUTF8(<char*>utf8_bytes, j, "surrogatepass")
+    finally:
+        cpython.PyMem_Free(utf8_bytes)
 
 
 cdef smart_str(s):
     return unicode_encode_cesu8(s) if isinstance(s, str) else s
 
 
-cdef unicode_encode_cesu8(str ustring):
-    # python transposition of duk_unicode_encode_cesu8(duk_ucodepoint_t cp, duk_uint8_t *out)
+cdef bytes unicode_encode_cesu8(str ustring):
+    cdef bytes utf8 = ustring.encode('utf-8', 'surrogatepass')
+    if PyUnicode_KIND(ustring) != PyUnicode_4BYTE_KIND:
+        # no astral characters: UTF-8 == CESU-8
+        return utf8
+
+    cdef const unsigned char *src = utf8
+    cdef Py_ssize_t length = len(utf8)
+    cdef Py_ssize_t i, j, extra = 0
     cdef unsigned long x
-    out = bytearray()
-    for uchar in ustring:
-        x = ord(uchar)
-        if x < 0x80:
-            out.append(x)
-        elif x < 0x800:
-            out.append(0xc0 + ((x >> 6) & 0x1f))
-            out.append(0x80 + (x & 0x3f))
-        elif x < 0x10000:
-            out.append(0xe0 + ((x >> 12) & 0x0f))
-            out.append(0x80 + ((x >> 6) & 0x3f))
-            out.append(0x80 + (x & 0x3f))
+    for i in range(length):
+        if src[i] >= 0xf0:
+            extra += 2
+    cdef bytes out = cpython.PyBytes_FromStringAndSize(NULL, length + extra)
+    cdef unsigned char *dst = <unsigned char *>cpython.PyBytes_AS_STRING(out)
+    i = j = 0
+    while i < length:
+        if src[i] >= 0xf0:
+            # rewrite a 4 bytes UTF-8 sequence as a CESU-8 surrogate pair,
+            # see duk_unicode_encode_cesu8(duk_ucodepoint_t cp, duk_uint8_t *out)
+            x = (((src[i] & 0x07) << 18) | ((src[i+1] & 0x3f) << 12) |
+                 ((src[i+2] & 0x3f) << 6) | (src[i+3] & 0x3f)) - 0x10000
+            dst[j] = 0xed
+            dst[j+1] = 0xa0 + ((x >> 16) & 0x0f)
+            dst[j+2] = 0x80 + ((x >> 10) & 0x3f)
+            dst[j+3] = 0xed
+            dst[j+4] = 0xb0 + ((x >> 6) & 0x0f)
+            dst[j+5] = 0x80 + (x & 0x3f)
+            i += 4
+            j += 6
         else:
-            x -= 0x10000
-            out.append(0xed)
-            out.append(0xa0 + ((x >> 16) & 0x0f))
-            out.append(0x80 + ((x >> 10) & 0x3f))
-            out.append(0xed)
-            out.append(0xb0 + ((x >> 6) & 0x0f))
-            out.append(0x80 + (x & 0x3f))
+            dst[j] = src[i]
+            i += 1
+            j += 1
     return out
 
 
+cdef duk_push_str(cduk.duk_context *ctx, str ustring):
+    cdef const char *buf
+    cdef Py_ssize_t size
+    if PyUnicode_KIND(ustring) != PyUnicode_4BYTE_KIND:
+        # zero-copy fast path: push the UTF-8 representation cached by python
+        try:
+            buf = PyUnicode_AsUTF8AndSize(ustring, &size)
+        except UnicodeEncodeError:
+            # unpaired surrogates
+            pass
+        else:
+            cduk.duk_push_lstring(ctx, buf, size)
+            return
+    cesu8 = unicode_encode_cesu8(ustring)
+    cduk.duk_push_lstring(ctx, cesu8, len(cesu8))
+
+
+cdef duk_push_smart_str(cduk.duk_context *ctx, s):
+    if isinstance(s, str):
+        duk_push_str(ctx, s)
+    else:
+        cduk.duk_push_lstring(ctx, s, len(s))
+
+
 cdef DUK_HIDDEN_SYMBOL(symbol):
     return b'\xFF' + symbol
 
@@ -107,6 +181,13 @@ cdef duk_get_global_dotted_string(Context pyctx, key):
     return True
 
 
+cdef duk_get_global_name(Context pyctx, name):
+    # name: a dotted name or a GlobalRef, which may have cached its object
+    if isinstance(name, GlobalRef):
+        return name.push(pyctx)
+    return duk_get_global_dotted_string(pyctx, smart_str(name))
+
+
 cdef duk_context_dump(cduk.duk_context *ctx):
     cduk.duk_push_context_dump(ctx)
     dump = force_unicode(cduk.duk_to_string(ctx, -1))
@@ -125,10 +206,15 @@ cdef duk_reraise(Context pyctx, cduk.duk_int_t rc):
             cduk.duk_pop(pyctx.ctx)
         else:
             python_error = None
+        timed_out = pyctx.udata.timed_out
+        if timed_out and not pyctx.udata.depth:
+            pyctx.udata.timed_out = 0
         exc = to_python(pyctx, -1)
         cduk.duk_safe_to_stacktrace(pyctx.ctx, -1)
         stacktrace = to_python_string(pyctx.ctx, -1)
         cduk.duk_pop(pyctx.ctx)
+        if timed_out:
+            raise TimeoutError(stacktrace)
         duk_error = Error(stacktrace)
         if python_error:
             duk_error.__cause__ = python_error
@@ -138,7 +224,26 @@ cdef duk_reraise(Context pyctx, cduk.duk_int_t rc):
             raise duk_error
 
 
-cdef duk_throw_python_error(Context pyctx, python_error):
+# Returned by the implementation of a C function, which runs holding the GIL,
+# when the value on top of the stack has to be thrown: duk_throw() longjmps
+# and must be called only once the GIL has been released by the wrapper
+cdef enum:
+    DUK_RET_THROW = -1000
+
+
+cdef inline cduk.duk_ret_t duk_throw_pending(cduk.duk_context *ctx, cduk.duk_ret_t ret) nogil:
+    if ret == DUK_RET_THROW:
+        cduk.duk_throw(ctx)
+    return ret
+
+
+cdef cduk.duk_ret_t duk_push_error(cduk.duk_context *ctx, message):
+    message = smart_str(message)
+    cduk.duk_push_error_object(ctx, cduk.DUK_ERR_ERROR, b"%s", <const char *>message)
+    return DUK_RET_THROW
+
+
+cdef duk_push_python_error(Context pyctx, python_error):
     try:
         to_js(pyctx, python_error)
     except TypeError, e:
@@ -148,10 +253,9 @@ cdef duk_throw_python_error(Context pyctx, python_error):
     cduk.duk_put_prop_string(pyctx.ctx, -2, DUK_HIDDEN_SYMBOL(b"python_error"))
     cduk.duk_push_c_function(pyctx.ctx, python_error_finalizer, -1)
     cduk.duk_set_finalizer(pyctx.ctx, -2)
-    cduk.duk_throw(pyctx.ctx)
 
 
-cdef cduk.duk_ret_t python_error_finalizer(cduk.duk_context *ctx):
+cdef cduk.duk_ret_t python_error_finalizer(cduk.duk_context *ctx) with gil:
     cduk.duk_get_prop_string(ctx, 0, DUK_HIDDEN_SYMBOL(b"python_error"))
     python_error = <object>cduk.duk_get_pointer(ctx, -1)
     cduk.duk_pop(ctx)
@@ -159,11 +263,17 @@ cdef cduk.duk_ret_t python_error_finalizer(cduk.duk_context *ctx):
     return 0
 
 
-cdef cduk.duk_ret_t duk_resolve_module(cduk.duk_context *ctx):
+cdef cduk.duk_ret_t duk_resolve_module(cduk.duk_context *ctx) nogil:
+    return duk_throw_pending(ctx, duk_resolve_module_impl(ctx))
+
+
+cdef cduk.duk_ret_t duk_resolve_module_impl(cduk.duk_context *ctx) with gil:
     #
     # [0]: module_id
     # [1]: parent_id
     #
+    cdef Context pyctx = duk_get_pyctx(ctx)
+    cdef ModuleCache cache = pyctx.module_cache
     module_id = to_python_string(ctx, 0)
     parent_id = to_python_string(ctx, 1)
 
@@ -172,6 +282,8 @@ cdef cduk.duk_ret_t duk_resolve_module(cduk.duk_context *ctx):
     # https://nodejs.org/api/esm.html
     # https://nodejs.org/api/modules.html#modules_all_together
     #
+    loader = pyctx.module_loader
+    loader_id = cache.loader_id(loader) if cache is not None else None
     if module_id.startswith('./') or module_id.startswith('../'):
         if not parent_id:
             cduk.duk_push_global_stash(ctx)
@@ -181,82 +293,491 @@ cdef cduk.duk_ret_t duk_resolve_module(cduk.duk_context *ctx):
             if cduk.duk_get_prop_string(ctx, -1, b'__duktape_loading_file__'):
                 parent_id = to_python_string(ctx, -1)
             cduk.duk_pop_n(ctx, 2)
-        module_id_path = os.path.join(os.path.dirname(parent_id), module_id)
-        module_file = load_as_file(module_id_path) or load_as_dir(module_id_path)
+        key = (module_id, os.path.dirname(parent_id), loader_id)
     else:
-        pyctx = duk_get_pyctx(ctx)
-        for module_path in pyctx.module_paths:
-            module_id_path = os.path.join(module_path, module_id)
-            module_file = load_as_file(module_id_path) or load_as_dir(module_id_path)
-            if module_file:
-                break
-        else:
-            module_file = None
+        # without module_path, modules are looked up from the loader root
+        key = (module_id, tuple(pyctx.module_paths) if pyctx.module_path else ('',), loader_id)
 
-    if module_file and os.path.isfile(module_file):
-        cduk.duk_push_string(ctx, smart_str(os.path.normpath(module_file)))
+    try:
+        module_file = cache.lookup(key) if cache is not None else NOT_CACHED
+        if module_file is NOT_CACHED:
+            module_file = resolve_module_file(module_id, key[1], cache, loader)
+            if cache is not None:
+                cache.store(key, module_file)
+    except Exception as e:
+        duk_push_python_error(pyctx, e)
+        return DUK_RET_THROW
+
+    if module_file:
+        cduk.duk_push_string(ctx, smart_str(module_file))
     else:
-        cduk.duk_generic_error(ctx, smart_str("Cannot find module '%s'" % module_id))
+        return duk_push_error(ctx, "Cannot find module '%s'" % module_id)
 
     return 1
 
 
-cdef load_as_file(x):
+cdef resolve_module_file(module_id, search, ModuleCache cache, loader):
+    # search: the parent directory for a relative module id, the module
+    # paths otherwise
+    if isinstance(search, str):
+        search = [search]
+    for module_path in search:
+        module_id_path = os.path.join(module_path, module_id)
+        module_file = load_as_file(module_id_path, loader) or load_as_dir(module_id_path, cache, loader)
+        if module_file and isfile(module_file, loader):
+            return os.path.normpath(module_file)
+
+
+cdef bint isfile(path, loader) except -1:
+    if loader is None:
+        return os.path.isfile(path)
+    return loader.isfile(path)
+
+
+cdef load_as_file(x, loader):
     for item in [x,
                  x + '.js',
                  x + '.json']:
-        if os.path.isfile(item):
+        if isfile(item, loader):
             return item
 
 
-cdef load_index(x):
+cdef load_index(x, loader):
     for item in [os.path.join(x, 'index.js'),
                  os.path.join(x, 'index.json')]:
-        if os.path.isfile(item):
+        if isfile(item, loader):
             return item
 
 
-cdef load_as_dir(x):
+cdef load_as_dir(x, ModuleCache cache, loader):
     pkg_json_path = os.path.join(x, 'package.json')
-    if os.path.isfile(pkg_json_path):
-        with open(pkg_json_path) as pkg_json_file:
-            pkg_json = json.load(pkg_json_file)
-            pkg_main = pkg_json.get('main')
-            if pkg_main:
-                m = os.path.join(x, pkg_main)
-                return load_as_file(m) or load_index(m)
-    return load_index(x)
+    if isfile(pkg_json_path, loader):
+        if cache is not None:
+            pkg_main = cache.package_main(pkg_json_path, loader)
+        else:
+            pkg_main = read_package_main(pkg_json_path, loader)
+        if pkg_main:
+            m = os.path.join(x, pkg_main)
+            return load_as_file(m, loader) or load_index(m, loader)
+    return load_index(x, loader)
+
+
+cdef read_package_main(pkg_json_path, loader):
+    if loader is not None:
+        source = loader.read(pkg_json_path)
+        if not isinstance(source, (str, bytes)):
+            source = bytes(source)
+        return json.loads(source).get('main')
+    with open(pkg_json_path) as pkg_json_file:
+        return json.load(pkg_json_file).get('main')
+
+
+class DirectoryLoader:
+    # Modules from a directory, module paths are relative to it
+
+    def __init__(self, root):
+        self.root = root
+
+    def isfile(self, path):
+        return os.path.isfile(os.path.join(self.root, path))
 
+    def read(self, path):
+        with open(os.path.join(self.root, path), 'rb') as f:
+            return f.read()
 
-cdef cduk.duk_ret_t duk_load_module(cduk.duk_context *ctx):
+
+class DictLoader:
+    # Modules from a {path: source} mapping
+
+    def __init__(self, modules):
+        self.modules = {os.path.normpath(path): source for path, source in modules.items()}
+
+    def isfile(self, path):
+        return os.path.normpath(path) in self.modules
+
+    def read(self, path):
+        return self.modules[os.path.normpath(path)]
+
+
+class ZipLoader(DictLoader):
+    # Modules from a zip archive (a path or a file object), which is read
+    # at once
+
+    def __init__(self, archive):
+        with zipfile.ZipFile(archive) as zf:
+            super().__init__({info.filename: zf.read(info) for info in zf.infolist()
+                              if not info.is_dir()})
+
+
+class MmapLoader:
+    # Modules from a bundle file created with MmapLoader.build(), which is
+    # memory mapped: sources are pushed into the heap without being copied
+    # into Python objects
+    #
+    # bundle format: MAGIC, the index length, the JSON index mapping paths to
+    # (offset, length) in the data which follows
+
+    MAGIC = b'DUKBUNDL'
+    HEADER = struct.Struct('<8sQ')
+
+    def __init__(self, bundle):
+        with open(bundle, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_length = self.HEADER.unpack_from(self.mmap)
+        if magic != self.MAGIC:
+            self.mmap.close()
+            raise ValueError("%s is not a module bundle" % bundle)
+        index_end = self.HEADER.size + index_length
+        index = json.loads(self.mmap[self.HEADER.size:index_end])
+        self.index = {path: (index_end + offset, index_end + offset + length)
+                      for path, (offset, length) in index.items()}
+
+    @classmethod
+    def build(cls, bundle, modules):
+        # modules: a {path: source} mapping or a directory
+        if isinstance(modules, (str, bytes, os.PathLike)):
+            root, modules = modules, {}
+            for dirpath, dirnames, filenames in os.walk(root):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    with open(path, 'rb') as f:
+                        modules[os.path.relpath(path, root)] = f.read()
+        index, data, offset = {}, [], 0
+        for path, source in modules.items():
+            source = smart_str(source)
+            index[os.path.normpath(path)] = (offset, len(source))
+            data.append(source)
+            offset += len(source)
+        index = json.dumps(index).encode()
+        with open(bundle, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, len(index)))
+            f.write(index)
+            f.writelines(data)
+
+    def isfile(self, path):
+        return os.path.normpath(path) in self.index
+
+    def read(self, path):
+        start, end = self.index[os.path.normpath(path)]
+        return memoryview(self.mmap)[start:end]
+
+    def close(self):
+        # the memoryviews returned by read() which are still alive keep the
+        # map open, it is then unmapped along with the last of them
+        if self.mmap is None:
+            return
+        try:
+            self.mmap.close()
+        except BufferError:
+            pass
+        self.mmap = None
+        self.index = {}
+
+
+# returned by ModuleCache.lookup() for the ids which have not been resolved yet
+NOT_CACHED = object()
+
+
+cdef class ModuleCache:
+    # Caches the resolution of require() ids and the "main" entry of the
+    # package.json files. It can be shared by several contexts. With
+    # negative=True failed resolutions are cached too, so modules created
+    # after a failed require() are not found until the cache is cleared.
+    # With validate=True cached files are checked to be unchanged (by mtime)
+    # and failed resolutions are never cached, which is meant for
+    # development.
+
+    cdef dict resolved
+    cdef dict package_mains
+    # the loaders of the cached entries by id, loaders do not have to be
+    # hashable and are kept alive so that their ids are not reused
+    cdef dict loaders
+    cdef readonly bint validate
+    cdef readonly bint negative
+    cdef readonly Py_ssize_t hits
+    cdef readonly Py_ssize_t misses
+
+    def __init__(self, validate=False, negative=False):
+        self.resolved = {}
+        self.package_mains = {}
+        self.loaders = {}
+        self.validate = validate
+        self.negative = negative and not validate
+
+    def __len__(self):
+        return len(self.resolved)
+
+    def clear(self):
+        self.resolved.clear()
+        self.package_mains.clear()
+        self.loaders.clear()
+        self.hits = self.misses = 0
+
+    cdef loader_id(self, loader):
+        if loader is None:
+            return None
+        self.loaders[id(loader)] = loader
+        return id(loader)
+
+    cdef lookup(self, key):
+        # the resolved file, None if it has not been found, or NOT_CACHED
+        entry = self.resolved.get(key)
+        if entry is not None and (not self.validate or file_mtime(entry[0]) == entry[1]):
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return NOT_CACHED
+
+    cdef store(self, key, module_file):
+        if module_file is not None:
+            self.resolved[key] = (module_file, file_mtime(module_file) if self.validate else None)
+        elif self.negative:
+            self.resolved[key] = (None, None)
+
+    cdef package_main(self, pkg_json_path, loader):
+        mtime = file_mtime(pkg_json_path) if self.validate else None
+        key = (pkg_json_path, self.loader_id(loader))
+        entry = self.package_mains.get(key)
+        if entry is None or entry[1] != mtime:
+            entry = (read_package_main(pkg_json_path, loader), mtime)
+            self.package_mains[key] = entry
+        return entry[0]
+
+
+cdef file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+cdef cduk.duk_ret_t duk_load_module(cduk.duk_context *ctx) nogil:
+    return duk_throw_pending(ctx, duk_load_module_impl(ctx))
+
+
+cdef cduk.duk_ret_t duk_load_module_impl(cduk.duk_context *ctx) with gil:
     #
     # [0]: resolved_id
     # [1]: exports
     # [2]: module
     #
+    cdef Context pyctx = duk_get_pyctx(ctx)
     resolved_id = to_python_string(ctx, 0)
-    if resolved_id.endswith('.json'):
-        # treat a JSON file as an object
-        cduk.duk_push_string(ctx, b"module.exports = ")
-        cduk.fileio_push_file_string(ctx, smart_str(resolved_id))
-        cduk.duk_concat(ctx, 2)
+    try:
+        if resolved_id.endswith('.json'):
+            # treat a JSON file as an object
+            cduk.duk_push_string(ctx, b"module.exports = ")
+            duk_push_module_source(pyctx, resolved_id)
+            cduk.duk_concat(ctx, 2)
+        else:
+            if pyctx.bytecode_cache and pyctx.module_loader is None:
+                return duk_load_module_bytecode(pyctx, ctx, resolved_id)
+            if pyctx.force_strict:
+                # force strict mode for loaded modules
+                cduk.duk_push_string(ctx, b"'use strict';")
+                duk_push_module_source(pyctx, resolved_id)
+                cduk.duk_concat(ctx, 2)
+            else:
+                duk_push_module_source(pyctx, resolved_id)
+    except Exception as e:
+        duk_push_python_error(pyctx, e)
+        return DUK_RET_THROW
+    return 1
+
+
+cdef duk_push_module_source(Context pyctx, resolved_id):
+    cdef const unsigned char[:] view
+    if pyctx.module_loader is None:
+        cduk.fileio_push_file_string(pyctx.ctx, smart_str(resolved_id))
+        return
+    source = pyctx.module_loader.read(resolved_id)
+    if isinstance(source, (str, bytes)):
+        duk_push_smart_str(pyctx.ctx, source)
     else:
-        pyctx = duk_get_pyctx(ctx)
+        # any buffer, i.e. a memoryview of a mmap
+        view = source
+        if view.shape[0]:
+            cduk.duk_push_lstring(pyctx.ctx, <const char *>&view[0], view.shape[0])
+        else:
+            cduk.duk_push_string(pyctx.ctx, b"")
+
+
+cdef cduk.duk_ret_t duk_load_module_bytecode(Context pyctx, cduk.duk_context *ctx, resolved_id):
+    # Same as duk_module_node does for a module source but the module wrapper
+    # function is loaded from (or stored into) the bytecode cache
+    cdef cduk.duk_idx_t count = 3
+    cdef cduk.duk_uint_t compile_flags = cduk.DUK_COMPILE_EVAL
+    if pyctx.force_strict:
+        compile_flags |= cduk.DUK_COMPILE_STRICT
+    if not duk_load_cached_bytecode(pyctx, resolved_id, 'module', compile_flags):
+        cduk.duk_push_string(ctx, b"(function(exports,require,module,__filename,__dirname){")
         if pyctx.force_strict:
             # force strict mode for loaded modules
             cduk.duk_push_string(ctx, b"'use strict';")
-            cduk.fileio_push_file_string(ctx, smart_str(resolved_id))
-            cduk.duk_concat(ctx, 2)
-        else:
-            cduk.fileio_push_file_string(ctx, smart_str(resolved_id))
+            count += 1
+        cduk.fileio_push_file_string(ctx, smart_str(resolved_id))
+        if cduk.duk_is_string(ctx, -1) and cduk.duk_get_string(ctx, -1).startswith(b'#!'):
+            # shebang support
+            cduk.duk_push_string(ctx, b"//")
+            cduk.duk_insert(ctx, -2)
+            count += 1
+        cduk.duk_push_string(ctx, b"\n})")
+        cduk.duk_concat(ctx, count)                         # [ ... source ]
+        cduk.duk_get_prop_string(ctx, 2, b"filename")       # [ ... source filename ]
+        if cduk.duk_pcompile(ctx, compile_flags) or cduk.duk_pcall(ctx, 0):
+            return DUK_RET_THROW
+        duk_save_cached_bytecode(pyctx, resolved_id, 'module', compile_flags)
+    # [ ... wrapper ]
+    if cduk.duk_safe_call(ctx, duk_safe_name_main, NULL, 1, 1):
+        return DUK_RET_THROW
+    cduk.duk_get_prop_string(ctx, 2, b"exports")            # exports
+    cduk.duk_get_prop_string(ctx, 2, b"require")            # require
+    cduk.duk_dup(ctx, 2)                                    # module
+    cduk.duk_get_prop_string(ctx, 2, b"filename")           # __filename
+    cduk.duk_push_undefined(ctx)                            # __dirname
+    if duk_pcall_nogil(pyctx, 5):
+        return DUK_RET_THROW
+    cduk.duk_push_true(ctx)
+    cduk.duk_put_prop_string(ctx, 2, b"loaded")
+    return 0
+
+
+cdef cduk.duk_ret_t duk_safe_name_main(cduk.duk_context *ctx, void *udata) nogil:
+    # [ ... wrapper ] -> [ ... wrapper ], named like duk_module_node does
+    cduk.duk_push_string(ctx, b"name")
+    cduk.duk_push_string(ctx, b"main")
+    cduk.duk_def_prop(ctx, -3, cduk.DUK_DEFPROP_HAVE_VALUE | cduk.DUK_DEFPROP_FORCE)
     return 1
 
 
+cdef cduk.duk_ret_t duk_safe_dump_function(cduk.duk_context *ctx, void *udata) nogil:
+    cduk.duk_dump_function(ctx)
+    return 1
+
+
+cdef cduk.duk_ret_t duk_safe_load_function(cduk.duk_context *ctx, void *udata) nogil:
+    cduk.duk_load_function(ctx)
+    return 1
+
+
+cdef bytes duk_dump_bytecode(Context pyctx):
+    # [ ... func ] -> [ ... func ]
+    cdef cduk.duk_size_t size
+    cduk.duk_dup(pyctx.ctx, -1)
+    duk_reraise(pyctx, cduk.duk_safe_call(pyctx.ctx, duk_safe_dump_function, NULL, 1, 1))
+    cdef const char *buf = <const char*>cduk.duk_get_buffer(pyctx.ctx, -1, &size)
+    try:
+        return buf[:size]
+    finally:
+        cduk.duk_pop(pyctx.ctx)
+
+
+cdef duk_push_bytecode(Context pyctx, bytes bytecode):
+    # [ ... ] -> [ ... func ]
+    cdef void *buf = cduk.duk_push_fixed_buffer(pyctx.ctx, len(bytecode))
+    memcpy(buf, <const char*>bytecode, len(bytecode))
+    duk_reraise(pyctx, cduk.duk_safe_call(pyctx.ctx, duk_safe_load_function, NULL, 1, 1))
+
+
+# bytecode cache files start with the source mtime (ns), the source size, the
+# duktape version they have been generated with and the SHA-1 of the bytecode:
+# duk_load_function() does not validate its input
+BYTECODE_CACHE_HEADER = struct.Struct('<qqq20s')
+
+
+cdef bytecode_cache_path(Context pyctx, filename, kind, compile_flags):
+    key = '%s:%s:%d' % (os.path.abspath(filename), kind, compile_flags)
+    return os.path.join(pyctx.bytecode_cache,
+                        hashlib.sha1(key.encode()).hexdigest() + '.dukbc')
+
+
+cdef bytecode_cache_stamp(filename):
+    st = os.stat(filename)
+    return (st.st_mtime_ns, st.st_size, cduk.DUK_VERSION)
+
+
+cdef duk_load_cached_bytecode(Context pyctx, filename, kind, compile_flags):
+    # push the cached function and return True if the cached bytecode is
+    # still valid for filename
+    try:
+        stamp = bytecode_cache_stamp(filename)
+        with open(bytecode_cache_path(pyctx, filename, kind, compile_flags), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return False
+    if len(data) < BYTECODE_CACHE_HEADER.size:
+        return False
+    header = BYTECODE_CACHE_HEADER.unpack_from(data)
+    bytecode = data[BYTECODE_CACHE_HEADER.size:]
+    if header[:3] != stamp or header[3] != hashlib.sha1(bytecode).digest():
+        return False
+    try:
+        # on error the stack is left unchanged
+        duk_push_bytecode(pyctx, bytecode)
+    except Error:
+        return False
+    return True
+
+
+cdef duk_save_cached_bytecode(Context pyctx, filename, kind, compile_flags):
+    # [ ... func ] -> [ ... func ]
+    bytecode = duk_dump_bytecode(pyctx)
+    path = bytecode_cache_path(pyctx, filename, kind, compile_flags)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        header = BYTECODE_CACHE_HEADER.pack(*bytecode_cache_stamp(filename),
+                                            hashlib.sha1(bytecode).digest())
+        os.makedirs(pyctx.bytecode_cache, exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            f.write(bytecode)
+        os.replace(tmp_path, path)
+    except OSError:
+        # the cache is best effort
+        pass
+
+
 class PyFunc:
 
-    def __init__(self, func, nargs=None):
+    # signature is an optional sequence of the argument types, see
+    # SIGNATURE_TYPES, converted without the to_python() dispatch
+    def __init__(self, func, nargs=None, signature=None):
+        if signature is not None:
+            signature = tuple(signature)
+            signature_codes(signature)
+            if nargs is None:
+                nargs = len(signature)
+            elif nargs != len(signature):
+                raise ValueError("nargs does not match the signature")
         self.func = func
         self.nargs = nargs
+        self.signature = signature
+
+
+cdef enum:
+    ARG_ANY
+    ARG_INT
+    ARG_FLOAT
+    ARG_STR
+    ARG_BOOL
+
+SIGNATURE_TYPES = {
+    None: ARG_ANY,
+    object: ARG_ANY,
+    int: ARG_INT,
+    float: ARG_FLOAT,
+    str: ARG_STR,
+    bool: ARG_BOOL,
+}
+
+
+cdef bytes signature_codes(signature):
+    if signature is None:
+        return b""
+    try:
+        return bytes([SIGNATURE_TYPES[arg_type] for arg_type in signature])
+    except (KeyError, TypeError):
+        raise TypeError("unsupported signature %r" % (signature,)) from None
 
 
 cdef str to_python_string(cduk.duk_context *ctx, cduk.duk_idx_t idx):
@@ -271,90 +792,265 @@ cdef to_python_bytes(cduk.duk_context *ctx, cduk.duk_idx_t idx):
     return buf[:strlen]
 
 
+cdef cduk.duk_ret_t duk_safe_array_items(cduk.duk_context *ctx, void *udata) nogil:
+    # [ ... arr ] -> [ ... items ], items: a bare array of the items of arr
+    cdef cduk.duk_uarridx_t i, length = <cduk.duk_uarridx_t>cduk.duk_get_length(ctx, -1)
+    cduk.duk_push_bare_array(ctx)                           # [ ... arr items ]
+    for i in range(length):
+        cduk.duk_get_prop_index(ctx, -2, i)                 # [ ... arr items value ]
+        cduk.duk_put_prop_index(ctx, -2, i)                 # [ ... arr items ]
+    return 1
+
+
+cdef cduk.duk_ret_t duk_safe_own_entries(cduk.duk_context *ctx, void *udata) nogil:
+    # [ ... obj ] -> [ ... entries ], entries: a bare array of the keys and
+    # values of the own enumerable properties of obj, alternating
+    cdef cduk.duk_uarridx_t i = 0
+    cduk.duk_push_bare_array(ctx)                           # [ ... obj entries ]
+    cduk.duk_enum(ctx, -2, cduk.DUK_ENUM_OWN_PROPERTIES_ONLY)   # [ ... obj entries enum ]
+    while cduk.duk_next(ctx, -1, 1):                        # [ ... obj entries enum key value ]
+        cduk.duk_put_prop_index(ctx, -4, i + 1)             # [ ... obj entries enum key ]
+        cduk.duk_put_prop_index(ctx, -3, i)                 # [ ... obj entries enum ]
+        i += 2
+    cduk.duk_pop(ctx)                                       # [ ... obj entries ]
+    return 1
+
+
+cdef duk_push_safe_copy(Context pyctx, cduk.duk_idx_t idx, cduk.duk_safe_call_function copy):
+    # [ ... ] -> [ ... copy ], getters and Proxy traps run JS code which may
+    # throw, even when converting the arguments of a Python callback. The
+    # GIL is kept: releasing it for each container would hand it over
+    # between the levels of a nested value.
+    cduk.duk_dup(pyctx.ctx, idx)
+    duk_reraise(pyctx, cduk.duk_safe_call(pyctx.ctx, copy, NULL, 1, 1))
+
+
 cdef to_python_list(Context pyctx, cduk.duk_idx_t idx):
     cdef cduk.duk_context *ctx = pyctx.ctx
-    ret = []
-    for i in range(cduk.duk_get_length(ctx, idx)):
-        cduk.duk_get_prop_index(ctx, idx, i)
-        ret.append(to_python(pyctx, -1))
+    duk_reserve_nested(ctx)
+    duk_push_safe_copy(pyctx, idx, duk_safe_array_items)   # [ ... items ]
+    try:
+        ret = []
+        for i in range(cduk.duk_get_length(ctx, -1)):
+            cduk.duk_get_prop_index(ctx, -1, i)
+            ret.append(to_python(pyctx, -1))
+            cduk.duk_pop(ctx)
+        return ret
+    finally:
         cduk.duk_pop(ctx)
-    return ret
 
 
 cdef to_python_dict(Context pyctx, cduk.duk_idx_t idx):
     cdef cduk.duk_context *ctx = pyctx.ctx
-    ret = {}
-    cduk.duk_enum(ctx, idx, cduk.DUK_ENUM_OWN_PROPERTIES_ONLY)
-    while cduk.duk_next(ctx, -1, 1):
-        ret[to_python(pyctx, -2)] = to_python(pyctx, -1)
-        cduk.duk_pop_n(ctx, 2)
-    cduk.duk_pop_n(ctx, 1)
-    return ret
+    duk_reserve_nested(ctx)
+    duk_push_safe_copy(pyctx, idx, duk_safe_own_entries)   # [ ... entries ]
+    try:
+        ret = {}
+        for i in range(0, cduk.duk_get_length(ctx, -1), 2):
+            cduk.duk_get_prop_index(ctx, -1, i)
+            cduk.duk_get_prop_index(ctx, -2, i + 1)
+            ret[to_python(pyctx, -2)] = to_python(pyctx, -1)
+            cduk.duk_pop_n(ctx, 2)
+        return ret
+    finally:
+        cduk.duk_pop(ctx)
+
+
+cdef class RefTable:
+    # Keeps the JS objects referenced by proxies reachable: each object gets
+    # a slot in a JS array (the _refs stash entry), the reference counts of
+    # the slots are kept here and freed slots are reused
+
+    cdef void *array
+    cdef dict slots
+    cdef uintptr_t *ptrs
+    cdef Py_ssize_t *counts
+    cdef cduk.duk_uarridx_t *free
+    cdef cduk.duk_uarridx_t size
+    cdef cduk.duk_uarridx_t nfree
+
+    def __cinit__(self):
+        self.slots = {}
+
+    def __dealloc__(self):
+        cpython.PyMem_Free(self.ptrs)
+        cpython.PyMem_Free(self.counts)
+        cpython.PyMem_Free(self.free)
+
+    def __len__(self):
+        return len(self.slots)
+
+    cdef grow(self):
+        cdef cduk.duk_uarridx_t size = self.size * 2 if self.size else 64
+        cdef uintptr_t *ptrs = <uintptr_t *>cpython.PyMem_Realloc(self.ptrs, size * sizeof(uintptr_t))
+        if ptrs == NULL:
+            raise MemoryError()
+        self.ptrs = ptrs
+        cdef Py_ssize_t *counts = <Py_ssize_t *>cpython.PyMem_Realloc(self.counts, size * sizeof(Py_ssize_t))
+        if counts == NULL:
+            raise MemoryError()
+        self.counts = counts
+        cdef cduk.duk_uarridx_t *free = <cduk.duk_uarridx_t *>cpython.PyMem_Realloc(
+            self.free, size * sizeof(cduk.duk_uarridx_t))
+        if free == NULL:
+            raise MemoryError()
+        self.free = free
+        # new slots are pushed in reverse so that lower ones are used first
+        cdef cduk.duk_uarridx_t slot = size
+        while slot > self.size:
+            slot -= 1
+            self.free[self.nfree] = slot
+            self.nfree += 1
+        self.size = size
+
+    cdef cduk.duk_uarridx_t acquire(self, cduk.duk_context *ctx, cduk.duk_idx_t idx) except? 0:
+        cdef uintptr_t ptr = <uintptr_t>cduk.duk_get_heapptr(ctx, idx)
+        cdef cduk.duk_uarridx_t slot
+        cached = self.slots.get(ptr)
+        if cached is not None:
+            slot = cached
+            self.counts[slot] += 1
+            return slot
+
+        if self.nfree == 0:
+            self.grow()
+        self.nfree -= 1
+        slot = self.free[self.nfree]
+        idx = cduk.duk_normalize_index(ctx, idx)
+        cduk.duk_push_heapptr(ctx, self.array)      # [ ... _refs ]
+        cduk.duk_dup(ctx, idx)                      # [ ... _refs obj ]
+        cduk.duk_put_prop_index(ctx, -2, slot)      # [ ... _refs ]
+        cduk.duk_pop(ctx)                           # [ ... ]
+        self.slots[ptr] = slot
+        self.ptrs[slot] = ptr
+        self.counts[slot] = 1
+        return slot
+
+    cdef release(self, cduk.duk_context *ctx, cduk.duk_uarridx_t slot):
+        self.counts[slot] -= 1
+        if self.counts[slot]:
+            return
+        del self.slots[self.ptrs[slot]]
+        cduk.duk_push_heapptr(ctx, self.array)      # [ ... _refs ]
+        cduk.duk_push_undefined(ctx)                # [ ... _refs undefined ]
+        cduk.duk_put_prop_index(ctx, -2, slot)      # [ ... _refs ]
+        cduk.duk_pop(ctx)                           # [ ... ]
+        self.free[self.nfree] = slot
+        self.nfree += 1
+
+    cdef push(self, cduk.duk_context *ctx, cduk.duk_uarridx_t slot):
+        cduk.duk_push_heapptr(ctx, self.array)      # [ ... _refs ]
+        cduk.duk_get_prop_index(ctx, -1, slot)      # [ ... _refs obj ]
+        cduk.duk_remove(ctx, -2)                    # [ ... obj ]
+
+
+def release_proxy_ref(Context pyctx, cduk.duk_uarridx_t ref_id):
+    pyctx.refs.release(pyctx.ctx, ref_id)
+
+
+cdef class ThreadTable:
+    # Keeps the threads created by new_thread() reachable: each thread is
+    # stored at an index of a JS array (the _threads stash entry) which is
+    # reused once the ThreadContext is deallocated
+
+    cdef void *array
+    cdef list free
+    cdef cduk.duk_uarridx_t size
+
+    def __cinit__(self):
+        self.free = []
+
+    cdef cduk.duk_uarridx_t register(self, cduk.duk_context *ctx, cduk.duk_idx_t idx) except? 0:
+        cdef cduk.duk_uarridx_t thr_id
+        if self.free:
+            thr_id = self.free.pop()
+        else:
+            thr_id = self.size
+            self.size += 1
+        idx = cduk.duk_normalize_index(ctx, idx)
+        cduk.duk_push_heapptr(ctx, self.array)      # [ ... _threads ]
+        cduk.duk_dup(ctx, idx)                      # [ ... _threads thr ]
+        cduk.duk_put_prop_index(ctx, -2, thr_id)    # [ ... _threads ]
+        cduk.duk_pop(ctx)                           # [ ... ]
+        return thr_id
+
+    cdef unregister(self, cduk.duk_context *ctx, cduk.duk_uarridx_t thr_id):
+        # Make the thread unreachable so that it can be garbage collected
+        # (assuming there are no other references to it)
+        cduk.duk_push_heapptr(ctx, self.array)      # [ ... _threads ]
+        cduk.duk_del_prop_index(ctx, -1, thr_id)
+        cduk.duk_pop(ctx)                           # [ ... ]
+        self.free.append(thr_id)
+
+
+def unregister_thread(Context pyctx, cduk.duk_uarridx_t thr_id):
+    pyctx.threads.unregister(pyctx.ctx, thr_id)
 
 
 cdef to_python_proxy(Context pyctx, cduk.duk_idx_t idx, pojo_only=True):
     cdef cduk.duk_context *ctx = pyctx.ctx
 
-    norm_idx = cduk.duk_normalize_index(ctx, idx)
-    ref_id = hex(<uintptr_t>cduk.duk_get_heapptr(ctx, norm_idx))
-
-    if cduk.duk_is_function(ctx, idx):
-        proxy = JsFunc(pyctx, ref_id)
+    if cduk.duk_is_lightfunc(ctx, idx):
+        # proxies reference heap objects, the function object coerced from a
+        # lightfunc calls the same C function with the same magic
+        cduk.duk_dup(ctx, idx)
+        cduk.duk_to_object(ctx, -1)
+        try:
+            return JsFunc(pyctx, pyctx.refs.acquire(ctx, -1))
+        finally:
+            cduk.duk_pop(ctx)
+    elif cduk.duk_is_function(ctx, idx):
+        proxy_type = JsFunc
     elif cduk.duk_is_array(ctx, idx):
-        proxy = JsArray(pyctx, ref_id)
+        proxy_type = JsArray
     elif duk_is_plain_object(pyctx, idx) or \
             (not pojo_only and cduk.duk_is_object(pyctx.ctx, idx)):
-        proxy = JsDict(pyctx, ref_id)
+        proxy_type = JsDict
     else:
         raise TypeError("not proxable")
 
-    cduk.duk_push_global_stash(ctx)                                 # [ ... stash ]
-    cduk.duk_get_prop_string(ctx, -1, b"_ref_map")                  # [ ... stash _ref_map ]
-    cduk.duk_dup(ctx, norm_idx)                                     # [ ... stash _ref_map func ]
-    cduk.duk_put_prop_string(ctx, -2, smart_str(ref_id))            # [ ... stash _ref_map ]
-    cduk.duk_pop(ctx)                                               # [ ... stash ]
-    cduk.duk_get_prop_string(ctx, -1, b"_ref_count")                # [ ... stash _ref_count ]
-    cduk.duk_get_prop_string(ctx, -1, smart_str(ref_id))            # [ ... stash _ref_count counter ]
-    cduk.duk_push_int(ctx, cduk.duk_get_int_default(ctx, -1, 0)+1)  # [ ... stash _ref_count counter new_counter ]
-    cduk.duk_put_prop_string(ctx, -3, smart_str(ref_id))            # [ ... stash _ref_count counter ]
-    cduk.duk_pop_n(ctx, 3)                                          # [ ... ]
-
-    def finalize_proxy(ref_id):
-        cduk.duk_push_global_stash(ctx)                             # [ ... stash ]
-        cduk.duk_get_prop_string(ctx, -1, b"_ref_count")            # [ ... stash _ref_count ]
-        cduk.duk_get_prop_string(ctx, -1, smart_str(ref_id))        # [ ... stash _ref_count counter ]
-        ref_count = cduk.duk_require_int(ctx, -1) - 1
-        if ref_count == 0:
-            cduk.duk_del_prop_string(ctx, -2, smart_str(ref_id))    # [ ... stash _ref_count counter ]
-            cduk.duk_pop_n(ctx, 2)                                  # [ ... stash ]
-            cduk.duk_get_prop_string(ctx, -1, b"_ref_map")          # [ ... stash _ref_map ]
-            cduk.duk_del_prop_string(ctx, -1, smart_str(ref_id))    # [ ... stash _ref_map ]
-            cduk.duk_pop_n(ctx, 2)                                  # [ ... ]
-        else:
-            cduk.duk_push_int(ctx, ref_count)                       # [ ... stash _ref_count counter new_counter ]
-            cduk.duk_put_prop_string(ctx, -3, smart_str(ref_id))    # [ ... stash _ref_count counter ]
-            cduk.duk_pop_n(ctx, 3)                                  # [ ... ]
-    weakref.finalize(getattr(proxy, '_proxy', proxy), finalize_proxy, ref_id)
+    return proxy_type(pyctx, pyctx.refs.acquire(ctx, idx))
+
 
-    return proxy
+cdef to_python_or_proxy(Context pyctx, cduk.duk_idx_t idx):
+    # like to_python_proxy for the proxable values, to_python for the others
+    if cduk.duk_is_function(pyctx.ctx, idx) or cduk.duk_is_array(pyctx.ctx, idx) or \
+            duk_is_plain_object(pyctx, idx):
+        return to_python_proxy(pyctx, idx)
+    return to_python(pyctx, idx)
 
 
-cdef duk_is_plain_object(Context pyctx, cduk.duk_idx_t idx):
+cdef to_python_result(Context pyctx, cduk.duk_idx_t idx, lazy):
+    # with lazy, arrays and plain objects are returned as JsArray and JsDict
+    # proxies instead of being converted with all their content
+    if lazy is None:
+        lazy = pyctx.lazy
+    if lazy:
+        return to_python_or_proxy(pyctx, idx)
+    return to_python(pyctx, idx)
+
+
+cdef bint duk_is_plain_object(Context pyctx, cduk.duk_idx_t idx):
     # https://masteringjs.io/tutorials/fundamentals/pojo
+    cdef void *prototype
     if not cduk.duk_is_object(pyctx.ctx, idx):
         return False
 
     cduk.duk_get_prototype(pyctx.ctx, idx)
-    if cduk.duk_is_undefined(pyctx.ctx, -1):
-        # check if the object has no prototype
-        # (its a "bare object" Object.create(null))
-        cduk.duk_pop(pyctx.ctx)
-        return True
-
-    assert duk_get_global_dotted_string(pyctx, b'Object.prototype')
-    eq = cduk.duk_strict_equals(pyctx.ctx, -1, -2)
-    cduk.duk_pop_n(pyctx.ctx, 2)
-    return bool(eq)
+    # NULL if the object has no prototype
+    # (its a "bare object" Object.create(null))
+    prototype = cduk.duk_get_heapptr(pyctx.ctx, -1)
+    cduk.duk_pop(pyctx.ctx)
+    return prototype == NULL or prototype == pyctx.object_prototype
+
+
+cdef bint duk_instanceof_heapptr(Context pyctx, cduk.duk_idx_t idx, void *constructor):
+    cdef bint ret
+    idx = cduk.duk_normalize_index(pyctx.ctx, idx)
+    cduk.duk_push_heapptr(pyctx.ctx, constructor)
+    ret = cduk.duk_instanceof(pyctx.ctx, idx, -1)
+    cduk.duk_pop(pyctx.ctx)
+    return ret
 
 
 def push_and_pop_proxy(f):
@@ -367,22 +1063,29 @@ def push_and_pop_proxy(f):
     return wrapper
 
 
+@cython.no_gc_clear
 cdef class JsProxy:
 
     cdef Context pyctx
-    cdef object ref_id
+    cdef cduk.duk_uarridx_t ref_id
     cdef object __weakref__
 
-    def __init__(self, Context pyctx, ref_id):
+    def __init__(self, Context pyctx, cduk.duk_uarridx_t ref_id):
+        # ref_id is a slot of pyctx.refs which has already been acquired
         self.pyctx = pyctx
         self.ref_id = ref_id
 
+    def __dealloc__(self):
+        if self.pyctx is None or self.pyctx.refs is None:
+            return
+        if self.pyctx.heap is not None and self.pyctx.heap.nogil_depth:
+            # the heap is executing in another thread
+            self.pyctx.heap.pending.append(functools.partial(release_proxy_ref, self.pyctx, self.ref_id))
+        else:
+            self.pyctx.refs.release(self.pyctx.ctx, self.ref_id)
+
     cdef push_proxy_ref(self):
-        cduk.duk_push_global_stash(self.pyctx.ctx)                              # [ ... stash ]
-        cduk.duk_get_prop_string(self.pyctx.ctx, -1, b"_ref_map")               # [ ... stash _ref_map ]
-        cduk.duk_get_prop_string(self.pyctx.ctx, -1, smart_str(self.ref_id))    # [ ... stash _ref_map obj ]
-        cduk.duk_remove(self.pyctx.ctx, -2)                                     # [ ... stash obj ]
-        cduk.duk_remove(self.pyctx.ctx, -2)                                     # [ ... obj ]
+        self.pyctx.refs.push(self.pyctx.ctx, self.ref_id)
 
     cdef pop_proxy_ref(self):
         cduk.duk_pop(self.pyctx.ctx)
@@ -423,6 +1126,27 @@ class JsObject(object):
     __delitem__ = __delattr__
 
 
+# what ObjectProxy.enumerate() returns
+ENUM_KEYS = 0
+ENUM_VALUES = 1
+ENUM_ITEMS = 2
+
+# number of items JsArray iteration converts per push of the array
+ITER_CHUNK_SIZE = 1024
+
+
+class JsDictValuesView(collections.abc.ValuesView):
+
+    def __iter__(self):
+        return iter(self._mapping._proxy.enumerate(ENUM_VALUES))
+
+
+class JsDictItemsView(collections.abc.ItemsView):
+
+    def __iter__(self):
+        return iter(self._mapping._proxy.enumerate(ENUM_ITEMS))
+
+
 class JsDict(collections.abc.MutableMapping):
 
     def __init__(self, pyctx, ref_id):
@@ -447,6 +1171,21 @@ class JsDict(collections.abc.MutableMapping):
     def __len__(self):
         return self._proxy.length()
 
+    def __contains__(self, k):
+        # JS property keys are strings
+        if not isinstance(k, (str, bytes)):
+            return False
+        return self._proxy.contains(k)
+
+    def values(self):
+        return JsDictValuesView(self)
+
+    def items(self):
+        return JsDictItemsView(self)
+
+    def to_dict(self):
+        return self._proxy.to_dict()
+
     def asobject(self):
         return JsObject(self._proxy)
 
@@ -455,19 +1194,31 @@ cdef class ObjectProxy(JsProxy):
 
     @push_and_pop_proxy
     def getitem(self, key):
+        # getters run JS code, like calls
+        cdef cduk.duk_context *ctx = self.pyctx.ctx
+        cdef cduk.duk_int_t rc
+        cduk.duk_dup(ctx, -1)                                   # [ ... obj obj ]
+        duk_push_smart_str(ctx, key)                            # [ ... obj obj key ]
+        rc = duk_pcall_nogil(self.pyctx, 2, GET_PROP)           # [ ... obj value found ]
         try:
-            if not cduk.duk_get_prop_string(self.pyctx.ctx, -1, smart_str(key)):
+            if rc:
+                cduk.duk_pop(ctx)                               # [ ... obj error ]
+                duk_reraise(self.pyctx, rc)                     # [ ... obj ]
+            if not cduk.duk_get_boolean(ctx, -1):
                 raise KeyError(key)
-            return to_python_proxy(self.pyctx, -1)
-        except TypeError:
-            return to_python(self.pyctx, -1)
+            return to_python_or_proxy(self.pyctx, -2)
         finally:
-            cduk.duk_pop(self.pyctx.ctx)
+            if not rc:
+                cduk.duk_pop_n(ctx, 2)                          # [ ... obj ]
 
     @push_and_pop_proxy
     def setitem(self, key, value):
-        to_js(self.pyctx, value)
-        cduk.duk_put_prop_string(self.pyctx.ctx, -2, smart_str(key))
+        cdef cduk.duk_context *ctx = self.pyctx.ctx
+        cduk.duk_dup(ctx, -1)                                   # [ ... obj obj ]
+        duk_push_smart_str(ctx, key)                            # [ ... obj obj key ]
+        to_js(self.pyctx, value)                                # [ ... obj obj key value ]
+        duk_reraise(self.pyctx, duk_pcall_nogil(self.pyctx, 3, PUT_PROP))  # [ ... obj undefined ]
+        cduk.duk_pop(ctx)                                       # [ ... obj ]
 
     @push_and_pop_proxy
     def delitem(self, key):
@@ -476,16 +1227,52 @@ cdef class ObjectProxy(JsProxy):
         cduk.duk_del_prop_string(self.pyctx.ctx, -1, smart_str(key))
 
     def keys(self):
-        self.push_proxy_ref()
+        return iter(self.enumerate(ENUM_KEYS))
+
+    @push_and_pop_proxy
+    def enumerate(self, what):
+        # the own properties are enumerated in one pass, the values are
+        # converted like getitem() does
+        cdef cduk.duk_context *ctx = self.pyctx.ctx
+        cdef list ret = []
+        cduk.duk_enum(ctx, -1, cduk.DUK_ENUM_OWN_PROPERTIES_ONLY)      # [ ... obj enum ]
+        try:
+            while cduk.duk_next(ctx, -1, what != ENUM_KEYS):             # [ ... obj enum key (value) ]
+                if what == ENUM_KEYS:
+                    ret.append(to_python(self.pyctx, -1))
+                    cduk.duk_pop(ctx)
+                elif what == ENUM_VALUES:
+                    ret.append(to_python_or_proxy(self.pyctx, -1))
+                    cduk.duk_pop_n(ctx, 2)
+                else:
+                    ret.append((to_python(self.pyctx, -2), to_python_or_proxy(self.pyctx, -1)))
+                    cduk.duk_pop_n(ctx, 2)
+        finally:
+            cduk.duk_pop(ctx)                                           # [ ... obj ]
+        return ret
+
+    @push_and_pop_proxy
+    def length(self):
+        cdef Py_ssize_t n = 0
         cduk.duk_enum(self.pyctx.ctx, -1, cduk.DUK_ENUM_OWN_PROPERTIES_ONLY)
         while cduk.duk_next(self.pyctx.ctx, -1, 0):
-            yield to_python(self.pyctx, -1)
+            n += 1
             cduk.duk_pop(self.pyctx.ctx)
         cduk.duk_pop(self.pyctx.ctx)
-        self.pop_proxy_ref()
+        return n
 
-    def length(self):
-        return sum(1 for x in self.keys())
+    @push_and_pop_proxy
+    def contains(self, key):
+        cdef bint ret
+        duk_push_smart_str(self.pyctx.ctx, key)             # [ ... obj key ]
+        cduk.duk_get_prop_desc(self.pyctx.ctx, -2, 0)       # [ ... obj desc ]
+        ret = not cduk.duk_is_undefined(self.pyctx.ctx, -1)
+        cduk.duk_pop(self.pyctx.ctx)
+        return ret
+
+    @push_and_pop_proxy
+    def to_dict(self):
+        return to_python_dict(self.pyctx, -1)
 
 
 class JsArray(collections.abc.MutableSequence):
@@ -509,6 +1296,15 @@ class JsArray(collections.abc.MutableSequence):
     def __len__(self):
         return self._proxy.length()
 
+    def __iter__(self):
+        return self._proxy.values()
+
+    def __contains__(self, v):
+        return self._proxy.contains(v)
+
+    def to_list(self):
+        return self._proxy.to_list()
+
     def insert(self, i, v):
         self._proxy.insert(i, v)
 
@@ -517,20 +1313,24 @@ cdef class ArrayProxy(JsProxy):
 
     @push_and_pop_proxy
     def get(self, index):
+        cdef cduk.duk_size_t length
         if isinstance(index, slice):
-            length = self.length()
-            return [self.get(i) for i in
-                    xrange(index.start if index.start else 0,
-                           min(index.stop if index.stop else length, length),
-                           index.step if index.step else 1)]
+            # the array stays on the stack and its length is read once
+            length = cduk.duk_get_length(self.pyctx.ctx, -1)
+            return [self.get_index(i) for i in range(*index.indices(length))]
+        # bounds checked before the conversion to a duk_uarridx_t
+        length = cduk.duk_get_length(self.pyctx.ctx, -1)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError('index out of range')
+        return self.get_index(index)
+
+    cdef get_index(self, cduk.duk_uarridx_t index):
+        # [ ... array ]
         try:
-            if index < 0:
-                index = self.length() + index
             if cduk.duk_get_prop_index(self.pyctx.ctx, -1, index):
-                try:
-                    return to_python_proxy(self.pyctx, -1)
-                except TypeError, e:
-                    return to_python(self.pyctx, -1)
+                return to_python_or_proxy(self.pyctx, -1)
             else:
                 raise IndexError('index out of range')
         finally:
@@ -551,37 +1351,140 @@ cdef class ArrayProxy(JsProxy):
         cduk.duk_push_string(self.pyctx.ctx, "splice")
         cduk.duk_push_number(self.pyctx.ctx, index)
         cduk.duk_push_number(self.pyctx.ctx, 1)
-        cduk.duk_pcall_prop(self.pyctx.ctx, -4, 2)
+        duk_reraise(self.pyctx, duk_pcall_nogil(self.pyctx, 2, CALL_PROP, None, -4))
         cduk.duk_pop(self.pyctx.ctx)
 
     @push_and_pop_proxy
     def length(self):
-        cduk.duk_get_prop_string(self.pyctx.ctx, -1, "length")
-        ret = to_python(self.pyctx, -1)
-        cduk.duk_pop(self.pyctx.ctx)
+        return cduk.duk_get_length(self.pyctx.ctx, -1)
+
+    def values(self):
+        # the array is pushed once per chunk of ITER_CHUNK_SIZE items, holes
+        # are returned as None
+        cdef cduk.duk_uarridx_t start = 0
+        while True:
+            chunk = self.get_range(start, ITER_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield from chunk
+            start += len(chunk)
+
+    @push_and_pop_proxy
+    def get_range(self, cduk.duk_uarridx_t start, cduk.duk_uarridx_t count):
+        cdef cduk.duk_context *ctx = self.pyctx.ctx
+        cdef cduk.duk_uarridx_t i
+        cdef cduk.duk_uarridx_t stop = min(cduk.duk_get_length(ctx, -1), start + count)
+        cdef list ret = []
+        for i in range(start, stop):
+            cduk.duk_get_prop_index(ctx, -1, i)
+            ret.append(to_python_or_proxy(self.pyctx, -1))
+            cduk.duk_pop(ctx)
         return ret
 
+    @push_and_pop_proxy
+    def contains(self, value):
+        cdef cduk.duk_context *ctx = self.pyctx.ctx
+        cdef cduk.duk_uarridx_t i
+        cdef cduk.duk_idx_t top
+        if type(value) not in (str, int, float):
+            # Python equality, e.g. True == 1 or lists equal to arrays
+            return any(item is value or item == value for item in self.values())
+        top = cduk.duk_get_top(ctx)
+        to_js(self.pyctx, value)                                # [ ... array value ]
+        try:
+            for i in range(cduk.duk_get_length(ctx, -2)):
+                cduk.duk_get_prop_index(ctx, -2, i)             # [ ... array value item ]
+                if cduk.duk_strict_equals(ctx, -1, -2):
+                    return True
+                cduk.duk_pop(ctx)                               # [ ... array value ]
+            return False
+        finally:
+            cduk.duk_set_top(ctx, top)                          # [ ... array ]
+
+    @push_and_pop_proxy
+    def to_list(self):
+        return to_python_list(self.pyctx, -1)
+
     @push_and_pop_proxy
     def insert(self, index, item):
         cduk.duk_push_string(self.pyctx.ctx, "splice")
         cduk.duk_push_number(self.pyctx.ctx, index)
         cduk.duk_push_number(self.pyctx.ctx, 0)
         to_js(self.pyctx, item)
-        cduk.duk_pcall_prop(self.pyctx.ctx, -5, 3)
+        duk_reraise(self.pyctx, duk_pcall_nogil(self.pyctx, 3, CALL_PROP, None, -5))
         cduk.duk_pop(self.pyctx.ctx)
 
 
 cdef class JsFunc(JsProxy):
 
-    def __call__(self, *args):
+    def __call__(self, *args, lazy=None):
         self.push_proxy_ref()
         for arg in args:
             to_js(self.pyctx, arg)
-        duk_reraise(self.pyctx, cduk.duk_pcall(self.pyctx.ctx, len(args)))
+        duk_reraise(self.pyctx, duk_pcall_nogil(self.pyctx, len(args)))
+        try:
+            return to_python_result(self.pyctx, -1, lazy)
+        finally:
+            self.pop_proxy_ref()
+
+    def map(self, iterable, chunk_size=None):
+        return self.starmap(((arg,) for arg in iterable), chunk_size)
+
+    def starmap(self, iterable, chunk_size=None):
+        # Calls the function for each tuple of arguments, an error raised by
+        # a call is returned in place of its result. Without chunk_size the
+        # results are returned as a list, otherwise as a generator which
+        # performs the calls chunk_size at a time.
+        if chunk_size is None:
+            return self.call_batch(iterable)
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        return self.istarmap(iterable, chunk_size)
+
+    def istarmap(self, iterable, chunk_size):
+        iterator = iter(iterable)
+        while True:
+            results = self.call_batch(itertools.islice(iterator, chunk_size))
+            if not results:
+                return
+            yield from results
+
+    cdef list call_batch(self, iterable):
+        cdef cduk.duk_context *ctx = self.pyctx.ctx
+        cdef cduk.duk_idx_t top, nargs
+        cdef list results = []
+        self.push_proxy_ref()                                   # [ ... func ]
+        top = cduk.duk_get_top(ctx)
         try:
-            return to_python(self.pyctx, -1)
+            for args in iterable:
+                cduk.duk_dup(ctx, -1)                           # [ ... func func ]
+                try:
+                    nargs = 0
+                    for arg in args:
+                        to_js(self.pyctx, arg)                  # [ ... func func args ]
+                        nargs += 1
+                    if duk_pcall_nogil(self.pyctx, nargs):
+                        duk_reraise(self.pyctx, 1)
+                    results.append(to_python(self.pyctx, -1))   # [ ... func result ]
+                except Exception as e:
+                    results.append(e)
+                cduk.duk_set_top(ctx, top)                      # [ ... func ]
         finally:
             self.pop_proxy_ref()
+        return results
+
+
+cdef class JsBuffer(JsProxy):
+    # Exports the data of a JS buffer, memoryviews over it keep the buffer
+    # referenced
+
+    def __getbuffer__(self, Py_buffer *buffer, int flags):
+        cdef void *data
+        cdef cduk.duk_size_t size
+        self.push_proxy_ref()
+        data = cduk.duk_get_buffer_data(self.pyctx.ctx, -1, &size)
+        self.pop_proxy_ref()
+        PyBuffer_FillInfo(buffer, self, data, size, 0, flags)
 
 
 cdef class ToPyHelper:
@@ -615,7 +1518,7 @@ cdef class ToPyHelper:
         return self.name
 
     def instanceof(self, name):
-        if not duk_get_global_dotted_string(self.pyctx, smart_str(name)):
+        if not duk_get_global_name(self.pyctx, name):
             return False
         try:
             return bool(cduk.duk_instanceof(self.pyctx.ctx, self.idx, -1))
@@ -623,7 +1526,7 @@ cdef class ToPyHelper:
             cduk.duk_pop(self.pyctx.ctx)
 
     def equals(self, name):
-        if not duk_get_global_dotted_string(self.pyctx, smart_str(name)):
+        if not duk_get_global_name(self.pyctx, name):
             return False
         try:
             return bool(cduk.duk_strict_equals(self.pyctx.ctx, self.idx, -1))
@@ -631,6 +1534,22 @@ cdef class ToPyHelper:
             cduk.duk_pop(self.pyctx.ctx)
 
 
+cdef duk_get_json(Context pyctx, cduk.duk_idx_t idx):
+    cduk.duk_dup(pyctx.ctx, idx)
+    try:
+        duk_reraise(pyctx, cduk.duk_safe_call(pyctx.ctx, duk_safe_json_encode, NULL, 1, 1))
+        if cduk.duk_is_undefined(pyctx.ctx, -1):
+            return None
+        return json.loads(to_python_string(pyctx.ctx, -1))
+    finally:
+        cduk.duk_pop(pyctx.ctx)
+
+
+cdef cduk.duk_ret_t duk_safe_json_encode(cduk.duk_context *ctx, void *udata) nogil:
+    cduk.duk_json_encode(ctx, -1)
+    return 1
+
+
 cdef to_python(Context pyctx, cduk.duk_idx_t idx):
     cdef cduk.duk_context *ctx = pyctx.ctx
     if cduk.duk_is_boolean(ctx, idx):
@@ -644,18 +1563,26 @@ cdef to_python(Context pyctx, cduk.duk_idx_t idx):
         return int(num) if num.is_integer() else num
     elif cduk.duk_is_string(ctx, idx):
         return to_python_string(pyctx.ctx, idx)
+    elif cduk.duk_is_buffer_data(ctx, idx):
+        # plain buffers, ArrayBuffers and their views
+        return memoryview(JsBuffer(pyctx, pyctx.refs.acquire(ctx, idx)))
+    elif cduk.duk_is_lightfunc(ctx, idx):
+        return to_python_proxy(pyctx, idx)
     elif cduk.duk_is_array(ctx, idx):
+        if pyctx.marshal == 'json':
+            return duk_get_json(pyctx, idx)
         return to_python_list(pyctx, idx)
     elif cduk.duk_is_object(ctx, idx):
-        helper = ToPyHelper(pyctx, idx)
-        dct = to_python_dict(pyctx, idx)
+        idx = cduk.duk_normalize_index(ctx, idx)
         if duk_is_plain_object(pyctx, idx):
-            return dct
-        elif helper.instanceof("PythonError"):
-            cduk.duk_get_prop_string(ctx, -1, DUK_HIDDEN_SYMBOL(b'exc_name'))
+            if pyctx.marshal == 'json':
+                return duk_get_json(pyctx, idx)
+            return to_python_dict(pyctx, idx)
+        elif duk_instanceof_heapptr(pyctx, idx, pyctx.python_error_constructor):
+            cduk.duk_get_prop_string(ctx, idx, DUK_HIDDEN_SYMBOL(b'exc_name'))
             exc_name = to_python_string(ctx, -1)
             cduk.duk_pop(ctx)
-            cduk.duk_get_prop_string(ctx, -1, b'args')
+            cduk.duk_get_prop_string(ctx, idx, b'args')
             args = to_python_list(pyctx, -1)
             cduk.duk_pop(ctx)
             try:
@@ -663,23 +1590,23 @@ cdef to_python(Context pyctx, cduk.duk_idx_t idx):
             except ValueError:
                 module = 'builtins'
             return getattr(importlib.import_module(module), exc_name)(*args)
-        elif helper.instanceof("Date"):
-            cduk.duk_get_prop_string(ctx, -1, DUK_HIDDEN_SYMBOL(b'epoch_usec'))
+        elif duk_instanceof_heapptr(pyctx, idx, pyctx.date_constructor):
+            cduk.duk_get_prop_string(ctx, idx, DUK_HIDDEN_SYMBOL(b'epoch_usec'))
             if not cduk.duk_is_undefined(ctx, -1):
                 epoch_s = struct.unpack('q', to_python_bytes(ctx, -1))[0] / 1e6
                 cduk.duk_pop(ctx)
             else:
                 cduk.duk_pop(ctx)
                 cduk.duk_push_string(ctx, b"getTime")
-                cduk.duk_pcall_prop(ctx, -2, 0)
-                epoch_s = cduk.duk_get_number(ctx, idx) / 1e3
+                duk_reraise(pyctx, duk_pcall_nogil(pyctx, 0, CALL_PROP, None, idx))
+                epoch_s = cduk.duk_get_number(ctx, -1) / 1e3
                 cduk.duk_pop(ctx)
-            cduk.duk_get_prop_string(ctx, -1, DUK_HIDDEN_SYMBOL(b"dt_type"))
+            cduk.duk_get_prop_string(ctx, idx, DUK_HIDDEN_SYMBOL(b"dt_type"))
             if not cduk.duk_is_undefined(ctx, -1):
                 dt_type = to_python_string(ctx, -1)
-                cduk.duk_pop(ctx)
             else:
                 dt_type = 'datetime'
+            cduk.duk_pop(ctx)
             dt = datetime.datetime.utcfromtimestamp(epoch_s)
             if dt_type == 'date':
                 return dt.date()
@@ -687,27 +1614,39 @@ cdef to_python(Context pyctx, cduk.duk_idx_t idx):
                 return dt.time()
             else:
                 return dt
+        elif pyctx.promise_constructor != NULL and \
+                duk_instanceof_heapptr(pyctx, idx, pyctx.promise_constructor):
+            return pyctx.event_loop.to_future(to_python_proxy(pyctx, idx, pojo_only=False))
         elif pyctx.to_py_hook:
             try:
-                return pyctx.to_py_hook(dct, helper)
+                return pyctx.to_py_hook(to_python_dict(pyctx, idx), ToPyHelper(pyctx, idx))
             except TypeError:
                 pass
 
-        if helper.instanceof("Error"):
-            cduk.duk_get_prop_string(ctx, -1, b'message')
+        if duk_instanceof_heapptr(pyctx, idx, pyctx.error_constructor):
+            cduk.duk_get_prop_string(ctx, idx, b'message')
             message = to_python_string(ctx, -1)
             cduk.duk_pop(ctx)
             return Error(message)
         elif cduk.duk_is_function(ctx, idx):
             return to_python_proxy(pyctx, idx)
         else:
-            return dct
+            return to_python_dict(pyctx, idx)
 
     return 'unknown'
     # raise TypeError("not_coercible", cduk.duk_get_type(ctx, idx))
 
 
 cdef duk_get_pyctx(cduk.duk_context *ctx):
+    # the result is cached on the heap udata until another thread calls into
+    # Python, see ThreadContext.__dealloc__
+    cdef cduk.duk_memory_functions funcs
+    cdef cduk.heap_udata *udata
+    cduk.duk_get_memory_functions(ctx, &funcs)
+    udata = <cduk.heap_udata *>funcs.udata
+    if udata.pyctx_ctx == <void *>ctx:
+        return <Context>udata.pyctx
+
     cduk.duk_push_thread_stash(ctx, ctx)
     cduk.duk_get_prop_string(ctx, -1, b"_pythr_pointer")
     if cduk.duk_is_undefined(ctx, -1):
@@ -718,68 +1657,361 @@ cdef duk_get_pyctx(cduk.duk_context *ctx):
     else:
         pyctx = <ThreadContext>cduk.duk_get_pointer(ctx, -1)
     cduk.duk_pop_n(ctx, 2)
+    # Duktape threads created from JS have no Python context of their own
+    if (<Context>pyctx).ctx == ctx:
+        udata.pyctx_ctx = <void *>ctx
+        udata.pyctx = <void *>pyctx
     return pyctx
 
 
-cdef cduk.duk_ret_t js_func_wrapper(cduk.duk_context *ctx):
-    # [ args... ]
-    cdef cduk.duk_int_t nargs
+# The Python side of a function created by to_js_func(), referenced by the
+# hidden PY_CALLBACK property of the JS function, or of a function installed
+# by a FunctionTable, referenced by its magic
+@cython.final
+cdef class Callback:
 
-    pyctx = duk_get_pyctx(ctx)
-    nargs = cduk.duk_get_top(ctx)
-    cduk.duk_push_current_function(ctx)
+    cdef object func
+    cdef bytes codes
 
-    if cduk.duk_has_prop_string(ctx, -1, b"__duktape_cfunc_nargs__"):
-        cduk.duk_get_prop_string(ctx, -1, b"__duktape_cfunc_nargs__")
-        nargs = cduk.duk_require_int(ctx, -1)
-        cduk.duk_pop(ctx)
+    def __cinit__(self, func, signature=None):
+        self.func = func
+        self.codes = signature_codes(signature)
 
-    cduk.duk_get_prop_string(ctx, -1, b"__duktape_cfunc_pointer__")
-    func = <object>cduk.duk_get_pointer(ctx, -1)
-    cduk.duk_pop(ctx)
+    cdef cduk.duk_ret_t call(self, Context pyctx):
+        # [ args... ] -> [ args... result ]
+        cdef const unsigned char *codes
+        cdef cduk.duk_idx_t nargs, idx
 
-    cduk.duk_pop(ctx)
+        # Duktape pads or trims the arguments of fixed nargs functions
+        nargs = cduk.duk_get_top(pyctx.ctx)
+        try:
+            if self.codes:
+                codes = self.codes
+                args = [to_python_typed(pyctx, idx, codes[idx]) for idx in range(nargs)]
+            else:
+                args = [to_python(pyctx, idx) for idx in range(nargs)]
+            # spelled out so that the common arities are called without an
+            # intermediate tuple (vectorcall where the callee supports it)
+            if nargs == 0:
+                result = self.func()
+            elif nargs == 1:
+                result = self.func(args[0])
+            elif nargs == 2:
+                result = self.func(args[0], args[1])
+            elif nargs == 3:
+                result = self.func(args[0], args[1], args[2])
+            else:
+                result = self.func(*args)
+            to_js(pyctx, result)
+            func_err = None
+        except Exception, e:
+            func_err = e
 
-    args = [to_python(pyctx, idx) for idx in range(nargs)]
-    try:
-        to_js(pyctx, func(*args))
-        func_err = None
-    except Exception, e:
-        func_err = e
+        if func_err:
+            duk_push_python_error(pyctx, func_err)
+            return DUK_RET_THROW
 
-    if func_err:
-        duk_throw_python_error(pyctx, func_err)
+        return 1
 
-    return 1
 
+cdef bytes PY_CALLBACK = DUK_HIDDEN_SYMBOL(b"py_callback")
+
+
+cdef to_python_typed(Context pyctx, cduk.duk_idx_t idx, unsigned char code):
+    cdef cduk.duk_context *ctx = pyctx.ctx
+    cdef double number
+    if code == ARG_ANY:
+        return to_python(pyctx, idx)
+    elif code == ARG_STR:
+        if cduk.duk_is_string(ctx, idx):
+            return to_python_string(ctx, idx)
+    elif code == ARG_BOOL:
+        if cduk.duk_is_boolean(ctx, idx):
+            return bool(cduk.duk_get_boolean(ctx, idx))
+    elif cduk.duk_is_number(ctx, idx):
+        number = cduk.duk_get_number(ctx, idx)
+        if code == ARG_FLOAT:
+            return number
+        elif floor(number) == number:
+            return int(number)
+    expected = [t for t, c in SIGNATURE_TYPES.items() if c == code][0]
+    raise TypeError("argument %d must be %s, not %s" % (
+        idx, expected.__name__, type(to_python(pyctx, idx)).__name__))
 
-cdef cduk.duk_ret_t js_func_finalizer(cduk.duk_context *ctx):
-    cduk.duk_get_prop_string(ctx, 0, b"__duktape_cfunc_pointer__")
-    func = <object>cduk.duk_get_pointer(ctx, -1)
+
+cdef cduk.duk_ret_t js_func_wrapper(cduk.duk_context *ctx) nogil:
+    return duk_throw_pending(ctx, js_func_wrapper_impl(ctx))
+
+
+cdef cduk.duk_ret_t js_func_wrapper_impl(cduk.duk_context *ctx) with gil:
+    # [ args... ]
+    cdef Callback callback
+
+    pyctx = duk_get_pyctx(ctx)
+    cduk.duk_push_current_function(ctx)
+    cduk.duk_get_prop_string(ctx, -1, PY_CALLBACK)
+    callback = <Callback>cduk.duk_get_pointer(ctx, -1)
+    cduk.duk_pop_n(ctx, 2)
+    return callback.call(pyctx)
+
+
+cdef cduk.duk_ret_t js_func_finalizer(cduk.duk_context *ctx) with gil:
+    cduk.duk_get_prop_string(ctx, 0, PY_CALLBACK)
+    callback = <object>cduk.duk_get_pointer(ctx, -1)
     cduk.duk_pop(ctx)
-    cpython.Py_DECREF(func)
+    cpython.Py_DECREF(callback)
     return 0
 
 
 cdef to_js_func(Context pyctx, pyfunc):
     cdef cduk.duk_context *ctx = pyctx.ctx
 
-    func, nargs = pyfunc.func, pyfunc.nargs
-    cpython.Py_INCREF(func)
+    nargs = pyfunc.nargs
+    callback = Callback(pyfunc.func, pyfunc.signature)
+    cpython.Py_INCREF(callback)
     cduk.duk_push_c_function(ctx, js_func_wrapper,
                              nargs if nargs is not None else cduk.DUK_VARARGS)  # [ ... js_func_wrapper ]
     cduk.duk_push_c_function(ctx, js_func_finalizer, -1)  # [ ... js_func_wrapper js_func_finalizer ]
     cduk.duk_set_finalizer(ctx, -2)  # [ ... js_func_wrapper ]
-    cduk.duk_push_pointer(ctx, <void*>func)  # [ ... js_func_wrapper func ]
-    cduk.duk_put_prop_string(ctx, -2, b"__duktape_cfunc_pointer__")  # [ ... js_func_wrapper ]
-    if nargs is not None:
-        cduk.duk_push_number(ctx, nargs)  # [ ... js_func_wrapper nargs ]
-        cduk.duk_put_prop_string(ctx, -2, b"__duktape_cfunc_nargs__")   # [ ... js_func_wrapper ]
+    cduk.duk_push_pointer(ctx, <void*>callback)  # [ ... js_func_wrapper callback ]
+    cduk.duk_put_prop_string(ctx, -2, PY_CALLBACK)  # [ ... js_func_wrapper ]
+
+
+# The functions installed by a FunctionTable find their Callback in
+# HeapState.callbacks at the index stored in their magic, which has 8 bits for
+# lightfuncs and 16 bits for function objects. The Callbacks are only
+# released with the heap, which holds at most MAX_CALLBACKS of them.
+cdef enum:
+    LIGHTFUNC_MAX_CALLBACKS = 256
+    LIGHTFUNC_MAX_NARGS = 14
+MAX_CALLBACKS = 65536
+
+
+cdef cduk.duk_ret_t js_table_func_wrapper(cduk.duk_context *ctx) nogil:
+    return duk_throw_pending(ctx, js_table_func_wrapper_impl(
+        ctx, <unsigned short>cduk.duk_get_current_magic(ctx)))
+
+
+cdef cduk.duk_ret_t js_table_lightfunc_wrapper(cduk.duk_context *ctx) nogil:
+    return duk_throw_pending(ctx, js_table_func_wrapper_impl(
+        ctx, <unsigned char>cduk.duk_get_current_magic(ctx)))
+
+
+cdef cduk.duk_ret_t js_table_func_wrapper_impl(cduk.duk_context *ctx, unsigned int index) with gil:
+    # [ args... ]
+    cdef Context pyctx = duk_get_pyctx(ctx)
+    return (<Callback>pyctx.heap.callbacks[index]).call(pyctx)
+
+
+cdef duk_push_namespace(Context pyctx, bytes namespace):
+    # [ ... ] -> [ ... obj ], the missing objects of the dotted name are
+    # created, an empty name is the global object. Getters and setters may
+    # throw: the properties are accessed by protected calls
+    cdef cduk.duk_context *ctx = pyctx.ctx
+    cdef cduk.duk_idx_t top = cduk.duk_get_top(ctx)
+    cdef cduk.duk_int_t rc
+    cduk.duk_push_global_object(ctx)                        # [ ... global ]
+    if not namespace:
+        return
+    try:
+        for part in namespace.split(b'.'):
+            cduk.duk_dup(ctx, -1)                           # [ ... parent parent ]
+            cduk.duk_push_string(ctx, part)                 # [ ... parent parent key ]
+            rc = duk_pcall_nogil(pyctx, 2, GET_PROP)        # [ ... parent obj found ]
+            cduk.duk_pop(ctx)                               # [ ... parent obj ]
+            duk_reraise(pyctx, rc)
+            if cduk.duk_is_undefined(ctx, -1):
+                cduk.duk_pop(ctx)                           # [ ... parent ]
+                cduk.duk_push_object(ctx)                   # [ ... parent obj ]
+                cduk.duk_dup(ctx, -2)                       # [ ... parent obj parent ]
+                cduk.duk_push_string(ctx, part)             # [ ... parent obj parent key ]
+                cduk.duk_dup(ctx, -3)                       # [ ... parent obj parent key obj ]
+                duk_reraise(pyctx, duk_pcall_nogil(pyctx, 3, PUT_PROP))  # [ ... parent obj undefined ]
+                cduk.duk_pop(ctx)                           # [ ... parent obj ]
+            elif not cduk.duk_is_object(ctx, -1):
+                raise TypeError("%s is not an object" % force_unicode(namespace))
+            cduk.duk_remove(ctx, -2)                        # [ ... obj ]
+    except BaseException:
+        cduk.duk_set_top(ctx, top)
+        raise
+
+
+cdef struct TableInstall:
+    cduk.duk_function_list_entry *entries
+    unsigned short *indices
+    Py_ssize_t count
+    bint lightfunc
+
+
+cdef cduk.duk_ret_t duk_safe_install_table(cduk.duk_context *ctx, void *udata) nogil:
+    # [ ... ns ] -> [ ... ns ], a frozen namespace or a throwing setter
+    # throws here: run by duk_safe_call()
+    cdef TableInstall *table = <TableInstall *>udata
+    cdef Py_ssize_t i
+    cdef cduk.duk_idx_t nargs
+    cdef unsigned short index
+    if not table.lightfunc:
+        cduk.duk_put_function_list(ctx, -1, table.entries)      # [ ... ns ]
+    for i in range(table.count):
+        nargs = table.entries[i].nargs
+        index = table.indices[i]
+        if not table.lightfunc:
+            cduk.duk_get_prop_string(ctx, -1, table.entries[i].key)     # [ ... ns func ]
+            cduk.duk_set_magic(ctx, -1, <short>index)
+            cduk.duk_pop(ctx)                                           # [ ... ns ]
+            continue
+        if index < LIGHTFUNC_MAX_CALLBACKS and nargs <= LIGHTFUNC_MAX_NARGS:
+            # DUK_VARARGS is negative
+            cduk.duk_push_c_lightfunc(ctx, js_table_lightfunc_wrapper, nargs,
+                                      nargs if nargs > 0 else 0, <signed char>index)  # [ ... ns func ]
+        else:
+            # does not fit in a lightfunc
+            cduk.duk_push_c_function(ctx, js_table_func_wrapper, nargs)   # [ ... ns func ]
+            cduk.duk_set_magic(ctx, -1, <short>index)
+        cduk.duk_put_prop_string(ctx, -2, table.entries[i].key)         # [ ... ns ]
+    return 1
+
+
+@cython.final
+cdef class FunctionTable:
+    # Python functions installed as the properties of a namespace object in
+    # one pass by Context.register(), the table can be registered with any
+    # number of contexts and threads: its entries are prepared once and the
+    # Callbacks are kept by the heap instead of one finalizer per function
+
+    cdef list keys
+    cdef list callbacks
+    cdef list nargs
+    cdef cduk.duk_function_list_entry *entries
+
+    def __cinit__(self, functions):
+        cdef Py_ssize_t i
+        self.keys = []
+        self.callbacks = []
+        self.nargs = []
+        for name, func in functions.items():
+            if not isinstance(func, PyFunc):
+                func = PyFunc(func)
+            self.keys.append(smart_str(name))
+            self.callbacks.append(Callback(func.func, func.signature))
+            self.nargs.append(func.nargs if func.nargs is not None else cduk.DUK_VARARGS)
+
+        # duk_put_function_list() reads up to a NULL key
+        self.entries = <cduk.duk_function_list_entry *>cpython.PyMem_Malloc(
+            (len(self.keys) + 1) * sizeof(cduk.duk_function_list_entry))
+        if self.entries == NULL:
+            raise MemoryError()
+        for i in range(len(self.keys)):
+            self.entries[i].key = self.keys[i]
+            self.entries[i].value = js_table_func_wrapper
+            self.entries[i].nargs = self.nargs[i]
+        self.entries[len(self.keys)].key = NULL
+        self.entries[len(self.keys)].value = NULL
+        self.entries[len(self.keys)].nargs = 0
+
+    def __dealloc__(self):
+        cpython.PyMem_Free(self.entries)
+
+    def __len__(self):
+        return len(self.keys)
+
+    cdef install(self, Context pyctx, namespace, bint lightfunc):
+        cdef cduk.duk_context *ctx = pyctx.ctx
+        cdef TableInstall table
+        cdef cduk.duk_int_t rc
+        cdef Py_ssize_t i
+
+        indices = pyctx.heap.register_callbacks(self.callbacks)
+        table.entries = self.entries
+        table.count = len(self.keys)
+        table.lightfunc = lightfunc
+        table.indices = <unsigned short *>cpython.PyMem_Malloc(
+            max(table.count, 1) * sizeof(unsigned short))
+        if table.indices == NULL:
+            raise MemoryError()
+        try:
+            for i in range(table.count):
+                table.indices[i] = indices[i]
+            duk_push_namespace(pyctx, smart_str(namespace or ''))          # [ ... ns ]
+            rc = cduk.duk_safe_call(ctx, duk_safe_install_table, &table, 1, 1)  # [ ... ns|error ]
+        finally:
+            cpython.PyMem_Free(table.indices)
+        duk_reraise(pyctx, rc)
+        cduk.duk_pop(ctx)                                               # [ ... ]
+
+
+cdef to_js_buffer(Context pyctx, value):
+    # Pushes an Uint8Array: over a copy of bytes and read-only buffers, over
+    # the memory of writable buffers which are pinned until the underlying
+    # ArrayBuffer is finalized
+    cdef cduk.duk_context *ctx = pyctx.ctx
+    cdef Py_buffer *view
+    cdef const char *data
+
+    if isinstance(value, memoryview) and isinstance(value.obj, JsBuffer) and \
+            value.c_contiguous and value.nbytes == memoryview(value.obj).nbytes:
+        # a buffer returned by to_python
+        (<JsBuffer>value.obj).push_proxy_ref()
+        return
+
+    if isinstance(value, bytes) or isinstance(value, memoryview) and \
+            (value.readonly or not value.contiguous):
+        if not isinstance(value, bytes):
+            value = bytes(value)
+        data = value
+        memcpy(cduk.duk_push_fixed_buffer(ctx, len(value)), data, len(value))  # [ ... buf ]
+        cduk.duk_push_buffer_object(ctx, -1, 0, len(value), cduk.DUK_BUFOBJ_UINT8ARRAY)
+        cduk.duk_remove(ctx, -2)                                               # [ ... u8 ]
+        return
+
+    view = <Py_buffer *>cpython.PyMem_Malloc(sizeof(Py_buffer))
+    if view == NULL:
+        raise MemoryError()
+    try:
+        PyObject_GetBuffer(value, view, PyBUF_CONTIG)
+    except:
+        cpython.PyMem_Free(view)
+        raise
+    cduk.duk_push_external_buffer(ctx)                                      # [ ... buf ]
+    cduk.duk_config_buffer(ctx, -1, view.buf, view.len)
+    cduk.duk_push_buffer_object(ctx, -1, 0, view.len, cduk.DUK_BUFOBJ_ARRAYBUFFER)   # [ ... buf ab ]
+    cduk.duk_dup(ctx, -2)                                                   # [ ... buf ab buf ]
+    cduk.duk_put_prop_string(ctx, -2, DUK_HIDDEN_SYMBOL(b"external"))       # [ ... buf ab ]
+    cduk.duk_push_pointer(ctx, view)                                        # [ ... buf ab view ]
+    cduk.duk_put_prop_string(ctx, -2, DUK_HIDDEN_SYMBOL(b"py_buffer"))      # [ ... buf ab ]
+    cduk.duk_push_c_function(ctx, js_buffer_finalizer, 1)                   # [ ... buf ab finalizer ]
+    cduk.duk_set_finalizer(ctx, -2)                                         # [ ... buf ab ]
+    cduk.duk_push_buffer_object(ctx, -1, 0, view.len, cduk.DUK_BUFOBJ_UINT8ARRAY)    # [ ... buf ab u8 ]
+    cduk.duk_remove(ctx, -2)                                                # [ ... buf u8 ]
+    cduk.duk_remove(ctx, -2)                                                # [ ... u8 ]
+
+
+cdef cduk.duk_ret_t js_buffer_finalizer(cduk.duk_context *ctx) with gil:
+    cdef Py_buffer *view
+    cduk.duk_get_prop_string(ctx, 0, DUK_HIDDEN_SYMBOL(b"py_buffer"))
+    view = <Py_buffer *>cduk.duk_get_pointer(ctx, -1)
+    cduk.duk_pop(ctx)
+    # views still referencing the external buffer become empty
+    cduk.duk_get_prop_string(ctx, 0, DUK_HIDDEN_SYMBOL(b"external"))
+    cduk.duk_config_buffer(ctx, -1, NULL, 0)
+    cduk.duk_pop(ctx)
+    PyBuffer_Release(view)
+    cpython.PyMem_Free(view)
+    return 0
+
+
+cdef duk_reserve_nested(cduk.duk_context *ctx):
+    # Nested containers are converted with every level on the stack, which
+    # must be grown past the space Duktape reserves for the API: pushing
+    # beyond it outside of a protected call aborts the process
+    if not cduk.duk_check_stack(ctx, 8):
+        raise RecursionError("value too deeply nested")
 
 
 cdef to_js_array(Context pyctx, lst):
     cdef cduk.duk_context *ctx = pyctx.ctx
 
+    duk_reserve_nested(ctx)
     cduk.duk_push_array(ctx)
     for i, value in enumerate(lst):
         to_js(pyctx, value)
@@ -789,10 +2021,12 @@ cdef to_js_array(Context pyctx, lst):
 cdef to_js_dict(Context pyctx, dct):
     cdef cduk.duk_context *ctx = pyctx.ctx
 
+    duk_reserve_nested(ctx)
     cduk.duk_push_object(ctx)
     for key, value in dct.items():
+        duk_push_smart_str(ctx, key)
         to_js(pyctx, value)
-        cduk.duk_put_prop_string(ctx, -2, smart_str(key))
+        cduk.duk_put_prop(ctx, -3)
 
 
 UNIX_EPOCH = datetime.datetime.utcfromtimestamp(0)
@@ -827,7 +2061,7 @@ cdef to_js_date(Context pyctx, value):
     epoch_usec = to_epoch_usec(value)
     cduk.duk_get_global_string(ctx, b"Date")                            # [ ... Date ]
     cduk.duk_push_number(ctx, epoch_usec/1e3)                           # [ ... Date epoch_s ]
-    duk_reraise(pyctx, cduk.duk_pnew(ctx, 1))                           # [ ... date ]
+    duk_reraise(pyctx, duk_pcall_nogil(pyctx, 1, CALL_NEW))             # [ ... date ]
     cduk.duk_push_lstring(ctx, <bytes>struct.pack('q', epoch_usec), 8)  # [ ... date usec]
     cduk.duk_put_prop_string(ctx, -2, DUK_HIDDEN_SYMBOL(b'epoch_usec')) # [ ... date ]
     cduk.duk_push_string(ctx, smart_str(dt_type))                       # [ ... date dt_type ]
@@ -842,22 +2076,28 @@ cdef to_js_date(Context pyctx, value):
     cduk.duk_pop(ctx)                                                   # [ ... proxy ]
 
 
-cdef cduk.duk_ret_t js_date_proxy_get_handler(cduk.duk_context *ctx):
+# The Proxy handlers and constructors below run no Python code: they are
+# called without the GIL and may throw.
+
+cdef cduk.duk_ret_t js_date_proxy_get_handler(cduk.duk_context *ctx) nogil:
     # 'this' binding: handler
     #
     # [0]: target
     # [1]: prop
     # [2]: receiver
     #
+    cdef const char *prop = NULL
+    if not cduk.duk_is_symbol(ctx, 1):
+        prop = cduk.duk_get_string(ctx, 1)
 
-    if cduk.duk_has_prop_string(ctx, -1, DUK_HIDDEN_SYMBOL(b'epoch_usec')) and \
-            not cduk.duk_is_symbol(ctx, 1) and cduk.duk_get_string(ctx, 1).startswith(b'set'):
+    if cduk.duk_has_prop_string(ctx, -1, b"\xFFepoch_usec") and \
+            prop != NULL and strncmp(prop, b"set", 3) == 0:
         cduk.duk_push_c_function(ctx, js_date_proxy_set_wrapper,
                                  cduk.DUK_VARARGS)
         cduk.duk_dup(ctx, 0)
-        cduk.duk_put_prop_string(ctx, -2, DUK_HIDDEN_SYMBOL(b"date_target"))
+        cduk.duk_put_prop_string(ctx, -2, b"\xFFdate_target")
         cduk.duk_dup(ctx, 1)
-        cduk.duk_put_prop_string(ctx, -2, DUK_HIDDEN_SYMBOL(b"date_prop"))
+        cduk.duk_put_prop_string(ctx, -2, b"\xFFdate_prop")
     else:
         cduk.duk_pop(ctx)
         cduk.duk_get_prop(ctx, 0)
@@ -869,21 +2109,21 @@ cdef cduk.duk_ret_t js_date_proxy_get_handler(cduk.duk_context *ctx):
     return 1
 
 
-cdef cduk.duk_ret_t js_date_proxy_set_wrapper(cduk.duk_context *ctx):
+cdef cduk.duk_ret_t js_date_proxy_set_wrapper(cduk.duk_context *ctx) nogil:
     # [ args... ]
 
     cdef cduk.duk_int_t nargs
 
     nargs = cduk.duk_get_top(ctx)
     cduk.duk_push_current_function(ctx)
-    cduk.duk_get_prop_string(ctx, -1, DUK_HIDDEN_SYMBOL(b"date_target"))
-    cduk.duk_get_prop_string(ctx, -2, DUK_HIDDEN_SYMBOL(b"date_prop"))
+    cduk.duk_get_prop_string(ctx, -1, b"\xFFdate_target")
+    cduk.duk_get_prop_string(ctx, -2, b"\xFFdate_prop")
     cduk.duk_insert(ctx, 0)
     cduk.duk_insert(ctx, 0)
     cduk.duk_pop(ctx)
     cduk.duk_pcall_prop(ctx, 0, nargs)
-    cduk.duk_del_prop_string(ctx, 0, DUK_HIDDEN_SYMBOL(b'epoch_usec'))
-    cduk.duk_del_prop_string(ctx, 0, DUK_HIDDEN_SYMBOL(b'dt_type'))
+    cduk.duk_del_prop_string(ctx, 0, b"\xFFepoch_usec")
+    cduk.duk_del_prop_string(ctx, 0, b"\xFFdt_type")
 
     return 1
 
@@ -895,7 +2135,7 @@ cdef to_js(Context pyctx, value):
         cduk.duk_push_null(ctx)
         return
     elif isinstance(value, str):
-        cduk.duk_push_string(ctx, smart_str(value))
+        duk_push_str(ctx, value)
         return
     elif isinstance(value, bool):
         if value:
@@ -929,6 +2169,17 @@ cdef to_js(Context pyctx, value):
     elif isinstance(value, (JsArray, JsObject, JsDict)):
         (<JsProxy>value._proxy).push_proxy_ref()
         return
+    elif pyctx.event_loop is not None and inspect.isawaitable(value):
+        # e.g. the coroutine returned by an async def function called from
+        # JS: it runs as a task and a Promise of its result is pushed
+        promise_id = pyctx.event_loop.to_promise(value)
+        (<JsProxy>pyctx.event_loop.deferred).push_proxy_ref()
+        to_js(pyctx, promise_id)
+        rc = duk_pcall_nogil(pyctx, 1)
+        if rc != 0:
+            pyctx.event_loop.cancel_task(promise_id)
+        duk_reraise(pyctx, rc)
+        return
     elif pyctx.to_js_hook:
         try:
             to_js(pyctx, pyctx.to_js_hook(value, ToJsHelper()))
@@ -936,7 +2187,11 @@ cdef to_js(Context pyctx, value):
         except TypeError:
             pass
 
-    if isinstance(value, BaseException):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        # after the hook, which may convert them otherwise
+        to_js_buffer(pyctx, value)
+        return
+    elif isinstance(value, BaseException):
         exc_type = type(value)
         exc_name = ""
         if exc_type.__module__ != 'builtins':
@@ -963,9 +2218,52 @@ class JsType:
         self.name = name
 
     def __call__(self, Context pyctx):
-        if not duk_get_global_dotted_string(pyctx, smart_str(self.name)):
+        if not duk_get_global_name(pyctx, self.name):
+            raise ValueError("'%s' is undefined" % self.name)
+
+
+class GlobalRef(JsType):
+    # A dotted global name returned by Context.resolve(), its name is encoded
+    # once. It can be used wherever a name is accepted (JsType, JsNew,
+    # ToPyHelper.instanceof, ...). With cache=True the object the name
+    # resolves to is kept by the handle and reused by the lookups made
+    # through it in its context: JS code assigning the name is not seen
+    # until refresh() is called.
+
+    def __init__(self, pyctx, name, cache=False):
+        self.name = name
+        self.key = smart_str(name)
+        self.pyctx = pyctx
+        self.cache = cache
+        self.target = None
+
+    def __call__(self, Context pyctx):
+        if not self.push(pyctx):
             raise ValueError("'%s' is undefined" % self.name)
 
+    def push(self, Context pyctx):
+        if self.target is not None and pyctx is self.pyctx:
+            (<JsProxy>self.target).push_proxy_ref()
+            return True
+        if not duk_get_global_dotted_string(pyctx, self.key):
+            return False
+        if self.cache and pyctx is self.pyctx and cduk.duk_is_object(pyctx.ctx, -1):
+            self.target = JsProxy(pyctx, pyctx.refs.acquire(pyctx.ctx, -1))
+        return True
+
+    def refresh(self):
+        # drops the cached object, the name is resolved again on next use
+        self.target = None
+
+    def get(self):
+        return self.pyctx.get_global(self)
+
+    def proxy(self):
+        return self.pyctx.proxy(self)
+
+    def __repr__(self):
+        return 'GlobalRef(%r)' % self.name
+
 
 class JsNew(JsType):
 
@@ -977,21 +2275,21 @@ class JsNew(JsType):
         super().__call__(pyctx)
         for arg in self.args:
             to_js(pyctx, arg)
-        duk_reraise(pyctx, cduk.duk_pnew(pyctx.ctx, len(self.args)))
+        duk_reraise(pyctx, duk_pcall_nogil(pyctx, len(self.args), CALL_NEW))
 
 
-cdef cduk.duk_ret_t python_error_constructor(cduk.duk_context *ctx):
+cdef cduk.duk_ret_t python_error_constructor(cduk.duk_context *ctx) nogil:
     if not cduk.duk_is_constructor_call(ctx):
         return cduk.DUK_RET_TYPE_ERROR
 
-    pyctx = duk_get_pyctx(ctx)
-
     # stack: [ name message args ]
     cduk.duk_push_this(ctx)
     cduk.duk_dup(ctx, 0)
-    cduk.duk_put_prop_string(ctx, -2, DUK_HIDDEN_SYMBOL(b'exc_name'))
-    name = to_python_string(ctx, 0)
-    cduk.duk_push_string(ctx, smart_str(f"PythonError({name})"))
+    cduk.duk_put_prop_string(ctx, -2, b"\xFFexc_name")
+    cduk.duk_push_string(ctx, b"PythonError(")
+    cduk.duk_dup(ctx, 0)
+    cduk.duk_push_string(ctx, b")")
+    cduk.duk_concat(ctx, 3)
     cduk.duk_put_prop_string(ctx, -2, b"name")
     cduk.duk_dup(ctx, 1)
     cduk.duk_put_prop_string(ctx, -2, b"message")
@@ -1003,7 +2301,7 @@ cdef cduk.duk_ret_t python_error_constructor(cduk.duk_context *ctx):
     return 0
 
 
-cdef cduk.duk_ret_t thread_only_constructor(cduk.duk_context *ctx):
+cdef cduk.duk_ret_t thread_only_constructor(cduk.duk_context *ctx) nogil:
     if not cduk.duk_is_constructor_call(ctx):
         return cduk.DUK_RET_TYPE_ERROR
 
@@ -1012,13 +2310,12 @@ cdef cduk.duk_ret_t thread_only_constructor(cduk.duk_context *ctx):
         # silenty ignore error and push an empty object as target
         cduk.duk_pop(ctx)
         cduk.duk_push_object(ctx)
-    target_id = hex(<uintptr_t>cduk.duk_get_heapptr(ctx, -1))
     cduk.duk_dup(ctx, 0)
-    cduk.duk_put_prop_string(ctx, -2, DUK_HIDDEN_SYMBOL(b'constructor'))
+    cduk.duk_put_prop_string(ctx, -2, b"\xFFconstructor")
     cduk.duk_dup(ctx, 1)
-    cduk.duk_put_prop_string(ctx, -2, DUK_HIDDEN_SYMBOL(b'name'))
-    cduk.duk_push_string(ctx, smart_str(target_id))
-    cduk.duk_put_prop_string(ctx, -2, DUK_HIDDEN_SYMBOL(b'id'))
+    cduk.duk_put_prop_string(ctx, -2, b"\xFFname")
+    cduk.duk_push_sprintf(ctx, b"%p", cduk.duk_get_heapptr(ctx, -1))
+    cduk.duk_put_prop_string(ctx, -2, b"\xFFid")
     cduk.duk_push_object(ctx)  # [ ... target handler ]
     cduk.duk_push_c_function(ctx, thread_only_get_handler, 3)
     cduk.duk_put_prop_string(ctx, -2, "get")
@@ -1030,24 +2327,13 @@ cdef cduk.duk_ret_t thread_only_constructor(cduk.duk_context *ctx):
     return 1;
 
 
-cdef cduk.duk_ret_t thread_only_get_handler(cduk.duk_context *ctx):
+cdef cduk.duk_ret_t thread_only_get_handler(cduk.duk_context *ctx) nogil:
     # 'this' binding: handler
     # [0]: target
     # [1]: prop
     # [2]: receiver (proxy)
     #
-    cduk.duk_push_thread_stash(ctx, ctx)
-    cduk.duk_get_prop_string(ctx, 0, DUK_HIDDEN_SYMBOL(b'id'))
-    cduk.duk_get_prop(ctx, -2)
-    if cduk.duk_is_undefined(ctx, -1):
-        cduk.duk_pop(ctx)
-        cduk.duk_get_prop_string(ctx, 0, DUK_HIDDEN_SYMBOL(b'name'))
-        name = 'ThreadOnly' if cduk.duk_is_undefined(ctx, -1) else to_python_string(ctx, -1)
-        cduk.duk_pop(ctx)
-        cduk.duk_generic_error(ctx, smart_str("%s has not been initialized!" % name))
-        return 1
-
-    local_idx = cduk.duk_normalize_index(ctx, -1)
+    cdef cduk.duk_idx_t local_idx = thread_only_push_local(ctx)
     cduk.duk_dup(ctx, 1)
     cduk.duk_get_prop(ctx, local_idx)
     if cduk.duk_is_function(ctx, -1):
@@ -1058,30 +2344,367 @@ cdef cduk.duk_ret_t thread_only_get_handler(cduk.duk_context *ctx):
     return 1
 
 
-cdef cduk.duk_ret_t thread_only_set_handler(cduk.duk_context *ctx):
+cdef cduk.duk_ret_t thread_only_set_handler(cduk.duk_context *ctx) nogil:
     # 'this' binding: handler
     # [0]: target
     # [1]: prop
     # [2]: val
     # [3]: receiver (proxy)
     #
+    thread_only_push_local(ctx)
+    cduk.duk_dup(ctx, 1)
+    cduk.duk_dup(ctx, 2)
+    cduk.duk_put_prop(ctx, -3)
+
+    return 1
 
+
+cdef cduk.duk_idx_t thread_only_push_local(cduk.duk_context *ctx) nogil:
+    # [ target ... ] -> [ target ... stash local ], the instance of the
+    # ThreadOnly [0] in the thread stash
+    cdef const char *name
     cduk.duk_push_thread_stash(ctx, ctx)
-    cduk.duk_get_prop_string(ctx, 0, DUK_HIDDEN_SYMBOL(b'id'))
+    cduk.duk_get_prop_string(ctx, 0, b"\xFFid")
     cduk.duk_get_prop(ctx, -2)
     if cduk.duk_is_undefined(ctx, -1):
-        cduk.duk_pop(ctx)
-        cduk.duk_get_prop_string(ctx, 0, DUK_HIDDEN_SYMBOL(b'name'))
-        name = 'ThreadOnly' if cduk.duk_is_undefined(ctx, -1) else to_python_string(ctx, -1)
-        cduk.duk_pop(ctx)
-        cduk.duk_generic_error(ctx, smart_str("%s has not been initialized!" % name))
-        return 1
+        cduk.duk_get_prop_string(ctx, 0, b"\xFFname")
+        name = cduk.duk_get_string(ctx, -1)
+        if name == NULL:
+            name = b"ThreadOnly"
+        cduk.duk_push_error_object(ctx, cduk.DUK_ERR_ERROR, b"%s has not been initialized!", name)
+        cduk.duk_throw(ctx)
+    return cduk.duk_normalize_index(ctx, -1)
 
-    cduk.duk_dup(ctx, 1)
-    cduk.duk_dup(ctx, 2)
+
+CompileCacheInfo = collections.namedtuple('CompileCacheInfo',
+                                          ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+cdef class CompileCache:
+
+    cdef object entries
+    cdef Py_ssize_t maxsize
+    cdef Py_ssize_t hits
+    cdef Py_ssize_t misses
+    cdef cduk.duk_uarridx_t next_slot
+
+    def __init__(self, maxsize):
+        self.entries = collections.OrderedDict()
+        self.maxsize = maxsize
+
+
+cdef duk_get_compiled(Context pyctx, key):
+    # look up a compiled function in the compile cache, on hit the function
+    # is pushed on the stack
+    cdef CompileCache cache = pyctx.compile_cache
+    if cache.maxsize <= 0:
+        return False
+    slot = cache.entries.get(key)
+    if slot is None:
+        cache.misses += 1
+        return False
+    # unlike a compilation, a hit pushes without growing the value stack,
+    # which keeps the results of eval()
+    if not cduk.duk_check_stack(pyctx.ctx, 3):
+        raise MemoryError("value stack limit reached")
+    cache.entries.move_to_end(key)
+    cache.hits += 1
+    cduk.duk_push_global_stash(pyctx.ctx)                       # [ ... stash ]
+    cduk.duk_get_prop_string(pyctx.ctx, -1, b"_compiled")       # [ ... stash _compiled ]
+    cduk.duk_get_prop_index(pyctx.ctx, -1, slot)                # [ ... stash _compiled func ]
+    cduk.duk_remove(pyctx.ctx, -2)                              # [ ... stash func ]
+    cduk.duk_remove(pyctx.ctx, -2)                              # [ ... func ]
+    return True
+
+
+cdef duk_put_compiled(Context pyctx, key):
+    # store the compiled function on top of the stack in the compile cache
+    cdef CompileCache cache = pyctx.compile_cache
+    if cache.maxsize <= 0:
+        return
+    slot = cache.next_slot
+    cache.next_slot += 1
+    cduk.duk_push_global_stash(pyctx.ctx)                       # [ ... func stash ]
+    cduk.duk_get_prop_string(pyctx.ctx, -1, b"_compiled")       # [ ... func stash _compiled ]
+    cduk.duk_dup(pyctx.ctx, -3)                                 # [ ... func stash _compiled func ]
+    cduk.duk_put_prop_index(pyctx.ctx, -2, slot)                # [ ... func stash _compiled ]
+    cache.entries[key] = slot
+    while len(cache.entries) > cache.maxsize:
+        _, evicted_slot = cache.entries.popitem(last=False)
+        cduk.duk_del_prop_index(pyctx.ctx, -1, evicted_slot)
+    cduk.duk_pop_n(pyctx.ctx, 2)                                # [ ... func ]
+
+
+cdef class HeapState:
+    # State shared by a context and all of its threads
+
+    # whether JS code is executed with the GIL released
+    cdef bint release_gil
+    # number of calls currently executing without the GIL
+    cdef int nogil_depth
+    # operations touching the heap requested from other threads (i.e. proxies
+    # being deallocated) while it was executing without the GIL
+    cdef list pending
+    # the running Profiler, referenced by the heap udata
+    cdef object profiler
+
+    # the Callbacks of the functions installed by FunctionTables, indexed by
+    # the magic of the functions and released with the heap
+    cdef list callbacks
+    cdef dict callback_indices
+
+    def __cinit__(self, release_gil):
+        self.release_gil = release_gil
+        self.pending = []
+        self.callbacks = []
+        self.callback_indices = {}
+
+    cdef list register_callbacks(self, list callbacks):
+        # returns the indices of the callbacks, the new ones are registered
+        # unless they would not fit
+        new = [callback for callback in dict.fromkeys(callbacks)
+               if callback not in self.callback_indices]
+        if len(self.callbacks) + len(new) > MAX_CALLBACKS:
+            raise OverflowError("too many registered functions, at most %d per heap" %
+                                MAX_CALLBACKS)
+        for callback in new:
+            self.callback_indices[callback] = len(self.callbacks)
+            self.callbacks.append(callback)
+        return [self.callback_indices[callback] for callback in callbacks]
+
+    cdef enter_nogil(self):
+        self.nogil_depth += 1
+
+    cdef exit_nogil(self):
+        self.nogil_depth -= 1
+        while not self.nogil_depth and self.pending:
+            self.pending.pop()()
+
+
+# number of bytecode instructions between two checks of the execution limits
+EXEC_CHECK_INTERVAL = cduk.HEAP_UDATA_CHECK_INTERVAL
+
+
+cdef class Profiler:
+    # Samples of the JS call stacks taken by Context.start_profiler(): stacks
+    # maps the stacks, tuples of (function name, file name, line) frames from
+    # the outermost call, to their number of samples. Samples are taken from
+    # the execution limits check (every EXEC_CHECK_INTERVAL instructions) so
+    # the interval is a minimum, and time spent outside of bytecode (in
+    # Python callbacks, compiling, ...) is not sampled. Only own data
+    # properties of the functions are read for the names.
+
+    cdef readonly object stacks
+    cdef readonly Py_ssize_t samples
+    cdef readonly double interval
+
+    def __init__(self, interval):
+        self.stacks = collections.Counter()
+        self.interval = interval
+
+    cdef record(self, cduk.duk_context *ctx):
+        # [ ... frames ] as collected by profiler_collect()
+        cdef cduk.duk_size_t i, count = cduk.duk_get_length(ctx, -1)
+        cdef const char *string
+        frames = []
+        for i in range(0, count, 3):
+            cduk.duk_get_prop_index(ctx, -1, i)                 # [ ... frames name ]
+            string = cduk.duk_get_string(ctx, -1)
+            name = force_unicode(string) if string != NULL and string[0] else '<anonymous>'
+            cduk.duk_get_prop_index(ctx, -2, i + 1)             # [ ... frames name file ]
+            string = cduk.duk_get_string(ctx, -1)
+            filename = force_unicode(string) if string != NULL else ''
+            cduk.duk_get_prop_index(ctx, -3, i + 2)             # [ ... frames name file line ]
+            line = cduk.duk_get_int(ctx, -1)
+            cduk.duk_pop_n(ctx, 3)                              # [ ... frames ]
+            frames.append((name, filename, line))
+        frames.reverse()
+        self.stacks[tuple(frames)] += 1
+        self.samples += 1
+
+    def collapsed(self, lines=True):
+        # the stacks in the collapsed format of flamegraph.pl and compatible
+        # tools: one "outer;inner count" line per stack
+        counts = collections.Counter()
+        for stack, count in self.stacks.items():
+            frames = []
+            for name, filename, line in stack:
+                frame = '%s (%s:%d)' % (name, filename, line) if lines else \
+                    '%s (%s)' % (name, filename)
+                frames.append(frame.replace(';', ':'))
+            counts[';'.join(frames)] += count
+        return ''.join('%s %d\n' % item for item in sorted(counts.items()))
+
+
+cdef void duk_get_own_data_prop(cduk.duk_context *ctx, const char *key) nogil:
+    # [ ... obj ] -> [ ... obj value ], undefined for accessors: no getter runs
+    cduk.duk_push_string(ctx, key)                              # [ ... obj key ]
+    cduk.duk_get_prop_desc(ctx, -2, 0)                          # [ ... obj desc ]
+    if cduk.duk_is_object(ctx, -1):
+        cduk.duk_get_prop_string(ctx, -1, b"value")             # [ ... obj desc value ]
+        cduk.duk_remove(ctx, -2)                                # [ ... obj value ]
+
+
+cdef cduk.duk_ret_t profiler_collect(cduk.duk_context *ctx, void *udata) nogil:
+    # [ ... ] -> [ ... frames ], frames: a bare object holding the function
+    # name, file name and line of each call from the innermost one. No JS
+    # runs here, errors (e.g. out of memory) are caught by the safe call.
+    cdef cduk.duk_int_t level = -1
+    cdef cduk.duk_uarridx_t i = 0
+    cduk.duk_push_bare_object(ctx)                              # [ ... frames ]
+    while True:
+        cduk.duk_inspect_callstack_entry(ctx, level)            # [ ... frames entry ]
+        if cduk.duk_is_undefined(ctx, -1):
+            cduk.duk_pop(ctx)                                   # [ ... frames ]
+            cduk.duk_push_uint(ctx, i)
+            cduk.duk_put_prop_string(ctx, -2, b"length")
+            return 1
+        cduk.duk_get_prop_string(ctx, -1, b"function")          # [ ... frames entry func ]
+        duk_get_own_data_prop(ctx, b"name")                     # [ ... frames entry func name ]
+        cduk.duk_put_prop_index(ctx, -4, i)                     # [ ... frames entry func ]
+        duk_get_own_data_prop(ctx, b"fileName")                 # [ ... frames entry func file ]
+        cduk.duk_put_prop_index(ctx, -4, i + 1)                 # [ ... frames entry func ]
+        cduk.duk_get_prop_string(ctx, -2, b"lineNumber")        # [ ... frames entry func line ]
+        cduk.duk_put_prop_index(ctx, -4, i + 2)                 # [ ... frames entry func ]
+        cduk.duk_pop_n(ctx, 2)                                  # [ ... frames ]
+        i += 3
+        level -= 1
+
+
+cdef void profiler_record(void *udata, cduk.duk_context *ctx) with gil:
+    (<Profiler>(<cduk.heap_udata *>udata).profiler).record(ctx)
+
+
+cdef void profiler_sampler(void *udata, cduk.duk_context *ctx) nogil:
+    # Called from the execution limits check in the bytecode executor where
+    # an error must not be thrown: the frames are collected under
+    # duk_safe_call() and only the GIL is taken to record them
+    if not cduk.duk_check_stack(ctx, 8):
+        return
+    if cduk.duk_safe_call(ctx, profiler_collect, NULL, 0, 1) == 0:
+        profiler_record(udata, ctx)
+    cduk.duk_pop(ctx)
+
+
+# What duk_pcall_nogil() runs
+cdef enum:
+    # [ ... func args ] -> [ ... retval ]
+    CALL_FUNCTION
+    # [ ... func this args ] -> [ ... retval ]
+    CALL_METHOD
+    # [ ... constructor args ] -> [ ... instance ]
+    CALL_NEW
+    # [ ... key args ] -> [ ... retval ], calls obj_idx[key]
+    CALL_PROP
+    # [ ... obj key ] -> [ ... value found ]
+    GET_PROP
+    # [ ... obj key value ] -> [ ... undefined ]
+    PUT_PROP
+
+
+cdef cduk.duk_ret_t duk_safe_get_prop(cduk.duk_context *ctx, void *udata) nogil:
+    # safe calls share the value stack frame of the caller
+    cduk.duk_push_boolean(ctx, cduk.duk_get_prop(ctx, -2))
+    return 2
+
+
+cdef cduk.duk_ret_t duk_safe_put_prop(cduk.duk_context *ctx, void *udata) nogil:
     cduk.duk_put_prop(ctx, -3)
+    return 0
 
-    return 1
+
+cdef inline cduk.duk_int_t duk_pcall_op(cduk.duk_context *ctx, cduk.duk_idx_t nargs, int op,
+                                        cduk.duk_idx_t obj_idx) nogil:
+    if op == CALL_METHOD:
+        return cduk.duk_pcall_method(ctx, nargs)
+    elif op == CALL_NEW:
+        return cduk.duk_pnew(ctx, nargs)
+    elif op == CALL_PROP:
+        return cduk.duk_pcall_prop(ctx, obj_idx, nargs)
+    elif op == GET_PROP:
+        return cduk.duk_safe_call(ctx, duk_safe_get_prop, NULL, 2, 2)
+    elif op == PUT_PROP:
+        return cduk.duk_safe_call(ctx, duk_safe_put_prop, NULL, 3, 1)
+    return cduk.duk_pcall(ctx, nargs)
+
+
+cdef cduk.duk_int_t duk_pcall_nogil(Context pyctx, cduk.duk_idx_t nargs, int op=CALL_FUNCTION,
+                                    timeout=None, cduk.duk_idx_t obj_idx=0):
+    # Every entry point running JS code goes through here. The execution
+    # limits (timeout falls back to the context one) are enforced by the
+    # outermost call only, nested calls share its budget. On error the
+    # error replaces the results, GET_PROP leaves [ ... error undefined ].
+    cdef cduk.duk_context *ctx = pyctx.ctx
+    cdef cduk.duk_int_t rc
+    cdef cduk.duk_context *exec_ctx = pyctx.udata.exec_ctx
+    if not pyctx.udata.depth:
+        if timeout is None:
+            timeout = pyctx.timeout
+        cduk.heap_udata_arm(pyctx.udata, timeout or 0, pyctx.max_ops or 0)
+    if obj_idx < 0:
+        obj_idx = cduk.duk_normalize_index(ctx, obj_idx)
+    pyctx.udata.exec_ctx = ctx
+    pyctx.udata.depth += 1
+    if pyctx.heap.release_gil:
+        pyctx.heap.enter_nogil()
+        with nogil:
+            rc = duk_pcall_op(ctx, nargs, op, obj_idx)
+        pyctx.heap.exit_nogil()
+    else:
+        rc = duk_pcall_op(ctx, nargs, op, obj_idx)
+    pyctx.udata.depth -= 1
+    pyctx.udata.exec_ctx = exec_ctx
+    return rc
+
+
+cdef cduk.duk_int_t duk_pcompile_nogil(Context pyctx, cduk.duk_uint_t flags):
+    cdef cduk.duk_context *ctx = pyctx.ctx
+    cdef cduk.duk_int_t rc
+    if not pyctx.heap.release_gil:
+        return cduk.duk_pcompile(ctx, flags)
+    pyctx.heap.enter_nogil()
+    with nogil:
+        rc = cduk.duk_pcompile(ctx, flags)
+    pyctx.heap.exit_nogil()
+    return rc
+
+
+cdef duk_compile_eval(Context pyctx, js, filename):
+    # Eval code: compiles into a function with zero arguments, which
+    # executes like an ECMAScript eval call
+    compile_flags = cduk.DUK_COMPILE_EVAL
+    if pyctx.force_strict:
+        compile_flags |= cduk.DUK_COMPILE_STRICT
+    key = (js, filename, compile_flags)
+    if not duk_get_compiled(pyctx, key):
+        duk_push_smart_str(pyctx.ctx, js)                       # [ ... source ]
+        cduk.duk_push_string(pyctx.ctx, smart_str(filename))    # [ ... source filename ]
+        duk_reraise(pyctx, duk_pcompile_nogil(pyctx, compile_flags))    # [ ... func ]
+        duk_put_compiled(pyctx, key)
+
+
+cdef duk_call_program(Context pyctx, filename, timeout=None):
+    # [ ... func ] -> [ ... ]
+    if filename is not None:
+        cduk.duk_push_global_stash(pyctx.ctx)
+        cduk.duk_push_string(pyctx.ctx, smart_str(filename))
+        # used by duk_resolve_module
+        cduk.duk_put_prop_string(pyctx.ctx, -2, b"__duktape_loading_file__")
+        cduk.duk_pop(pyctx.ctx)
+    try:
+        # bind 'this' to global object
+        cduk.duk_push_global_object(pyctx.ctx)                      # [ ... func global ]
+        duk_reraise(pyctx, duk_pcall_nogil(pyctx, 0, CALL_METHOD, timeout))  # [ ... retval ]
+        cduk.duk_pop(pyctx.ctx)
+    finally:
+        if filename is not None:
+            cduk.duk_push_global_stash(pyctx.ctx)
+            cduk.duk_del_prop_string(pyctx.ctx, -1, b"__duktape_loading_file__")
+            cduk.duk_pop(pyctx.ctx)
+
+
+MemoryStats = collections.namedtuple('MemoryStats',
+                                     ['used', 'peak', 'limit', 'allocs', 'reallocs', 'frees', 'failed'])
 
 
 class Type:
@@ -1113,13 +2736,83 @@ cdef class Context:
     cdef object to_js_hook
     cdef object to_py_hook
     cdef object force_strict
-
-    def __init__(self, module_path=None, to_js_hook=None, to_py_hook=None, force_strict=False):
-        self.ctx = cduk.duk_create_heap_default()
+    cdef CompileCache compile_cache
+    cdef RefTable refs
+    cdef ThreadTable threads
+    cdef HeapState heap
+    cdef cduk.heap_udata *udata
+    cdef readonly ModuleCache module_cache
+    cdef object module_loader
+    cdef object timeout
+    cdef object max_ops
+    cdef object bytecode_cache
+    cdef object marshal
+    cdef object lazy
+    cdef object event_loop
+    # set by EventLoop, Promise objects are converted to asyncio futures
+    cdef void *promise_constructor
+    # builtins used by to_python, referenced by the global stash
+    cdef void *object_prototype
+    cdef void *date_constructor
+    cdef void *error_constructor
+    cdef void *python_error_constructor
+
+    def __init__(self, module_path=None, to_js_hook=None, to_py_hook=None, force_strict=False,
+                 compile_cache_size=128, bytecode_cache=None, marshal='native', release_gil=False,
+                 timeout=None, max_ops=None, memory_limit=None, allocator='malloc',
+                 module_cache=True, module_loader=None, lazy=False):
+        # release_gil: execute JS code without holding the GIL, the context
+        # (and its threads) must then never be used by two threads at once
+        #
+        # timeout (seconds) and max_ops (bytecode instructions) limit every
+        # call into JS, they are checked every EXEC_CHECK_INTERVAL
+        # instructions and raise TimeoutError when exceeded
+        #
+        # memory_limit (bytes) caps the memory allocated by the heap, failing
+        # allocations throw Error('alloc failed') in JS. allocator='pool'
+        # serves small allocations from per size free lists instead of malloc
+        #
+        # module_cache: True for a cache of the require() resolutions owned
+        # by the context, a ModuleCache to share one, False to disable it
+        #
+        # module_loader: where require() reads modules from (instead of the
+        # file system), an object with isfile(path) and read(path) methods
+        # such as DirectoryLoader, DictLoader, ZipLoader or MmapLoader
+        #
+        # lazy: the default of the lazy argument of eval() and JsFunc calls,
+        # returning arrays and plain objects as JsArray and JsDict proxies
+        if marshal not in ('native', 'json'):
+            raise ValueError("marshal must be one of 'native' or 'json'")
+        if allocator not in ('malloc', 'pool'):
+            raise ValueError("allocator must be one of 'malloc' or 'pool'")
+        self.udata = <cduk.heap_udata *>cpython.PyMem_Malloc(sizeof(cduk.heap_udata))
+        if self.udata == NULL:
+            raise MemoryError()
+        memset(self.udata, 0, sizeof(cduk.heap_udata))
+        self.udata.memory_limit = memory_limit or 0
+        self.udata.pool = allocator == 'pool'
+        self.ctx = cduk.duk_create_heap(cduk.heap_udata_alloc, cduk.heap_udata_realloc,
+                                        cduk.heap_udata_free, self.udata, NULL)
+        if self.ctx == NULL:
+            cpython.PyMem_Free(self.udata)
+            self.udata = NULL
+            raise MemoryError("cannot create the heap")
+        self.timeout = timeout
+        self.max_ops = max_ops
+        self.module_loader = module_loader
+        if module_cache is True:
+            self.module_cache = ModuleCache()
+        elif module_cache is not False and module_cache is not None:
+            self.module_cache = module_cache
         self.module_path = module_path
         self.to_js_hook = to_js_hook
         self.to_py_hook = to_py_hook
         self.force_strict = force_strict
+        self.compile_cache = CompileCache(compile_cache_size)
+        self.bytecode_cache = bytecode_cache
+        self.marshal = marshal
+        self.lazy = lazy
+        self.heap = HeapState(release_gil)
         self.setup()
 
     @property
@@ -1137,20 +2830,27 @@ cdef class Context:
         if self.ctx:
             cduk.duk_destroy_heap(self.ctx)
             self.ctx = NULL
+            cduk.heap_udata_release_pool(self.udata)
+            cpython.PyMem_Free(self.udata)
+            self.udata = NULL
 
     def setup(self):
         cduk.duk_push_global_stash(self.ctx)
         cduk.duk_push_pointer(self.ctx, <void*>self)
         cduk.duk_put_prop_string(self.ctx, -2, b"_pyctx_pointer")
-        cduk.duk_push_object(self.ctx)
-        cduk.duk_put_prop_string(self.ctx, -2, b"_ref_map")
-        cduk.duk_push_object(self.ctx)
-        cduk.duk_put_prop_string(self.ctx, -2, b"_ref_count")
-        cduk.duk_push_object(self.ctx)
+        self.refs = RefTable()
+        cduk.duk_push_array(self.ctx)
+        self.refs.array = cduk.duk_get_heapptr(self.ctx, -1)
+        cduk.duk_put_prop_string(self.ctx, -2, b"_refs")
+        self.threads = ThreadTable()
+        cduk.duk_push_array(self.ctx)
+        self.threads.array = cduk.duk_get_heapptr(self.ctx, -1)
         cduk.duk_put_prop_string(self.ctx, -2, b"_threads")
+        cduk.duk_push_object(self.ctx)
+        cduk.duk_put_prop_string(self.ctx, -2, b"_compiled")
         cduk.duk_pop(self.ctx)
 
-        if self.module_path:
+        if self.module_path or self.module_loader is not None:
             cduk.duk_push_object(self.ctx);
             cduk.duk_push_c_function(self.ctx, duk_resolve_module, cduk.DUK_VARARGS);
             cduk.duk_put_prop_string(self.ctx, -2, b"resolve");
@@ -1174,21 +2874,70 @@ cdef class Context:
         cduk.duk_put_prop_string(self.ctx, -2, b"prototype")
         cduk.duk_put_global_string(self.ctx, b"ThreadOnly")
 
+        # keep references to the builtins used by to_python so that they
+        # are not looked up for every converted object
+        cduk.duk_push_global_stash(self.ctx)
+        duk_get_global_dotted_string(self, b"Object.prototype")
+        self.object_prototype = cduk.duk_get_heapptr(self.ctx, -1)
+        cduk.duk_put_prop_string(self.ctx, -2, b"_object_prototype")
+        cduk.duk_get_global_string(self.ctx, b"Date")
+        self.date_constructor = cduk.duk_get_heapptr(self.ctx, -1)
+        cduk.duk_put_prop_string(self.ctx, -2, b"_date_constructor")
+        cduk.duk_get_global_string(self.ctx, b"Error")
+        self.error_constructor = cduk.duk_get_heapptr(self.ctx, -1)
+        cduk.duk_put_prop_string(self.ctx, -2, b"_error_constructor")
+        cduk.duk_get_global_string(self.ctx, b"PythonError")
+        self.python_error_constructor = cduk.duk_get_heapptr(self.ctx, -1)
+        cduk.duk_put_prop_string(self.ctx, -2, b"_python_error_constructor")
+        cduk.duk_pop(self.ctx)
+
     def __bool__(self):
         return True
 
+    cdef clear_stack(self):
+        # drops the values left on the stack, e.g. by a pooled context user
+        cduk.duk_set_top(self.ctx, 0)
+
     def __setitem__(self, key, value):
+        key = smart_str(key)
         to_js(self, value)
-        cduk.duk_put_global_string(self.ctx, smart_str(key))
+        cduk.duk_put_global_string(self.ctx, key)
 
     def __getitem__(self, key):
         cduk.duk_get_global_string(self.ctx, smart_str(key))
-        return to_python(self, -1)
+        try:
+            return to_python(self, -1)
+        finally:
+            cduk.duk_pop(self.ctx)
 
     def __len__(self):
         return cduk.duk_get_top(self.ctx)
 
-    def load(self, filename):
+    def get_global(self, name):
+        # like __getitem__ for a dotted name ("Foo.bar") or a GlobalRef
+        if not duk_get_global_name(self, name):
+            return None
+        try:
+            return to_python(self, -1)
+        finally:
+            cduk.duk_pop(self.ctx)
+
+    def resolve(self, name, cache=False):
+        # returns a reusable GlobalRef handle for a dotted global name,
+        # caching the object it resolves to with cache=True
+        return GlobalRef(self, name, cache)
+
+    def get_json(self, key):
+        # like __getitem__ but the value is marshalled as JSON in one pass:
+        # only JSON data is preserved (functions and undefined values are
+        # dropped, dates are converted to strings, ...)
+        cduk.duk_get_global_string(self.ctx, smart_str(key))
+        try:
+            return duk_get_json(self, -1)
+        finally:
+            cduk.duk_pop(self.ctx)
+
+    def load(self, filename, timeout=None):
         # Global code: compiles into a function with zero arguments, which
         # executes like a top level ECMAScript program
         #
@@ -1204,45 +2953,117 @@ cdef class Context:
         # duk_pcompile() and duk_pcall() instead of duk_peval() (which is a
         # convenience call for eval code).
         # Current duk_(p)eval() won't supply a this binding.
-        cduk.duk_push_global_stash(self.ctx)
-        cduk.duk_push_string(self.ctx, smart_str(filename))
-        # used by duk_resolve_module
-        cduk.duk_put_prop_string(self.ctx, -2, b"__duktape_loading_file__")
-        cduk.duk_pop(self.ctx)
-        try:
-            cduk.fileio_push_file_string(self.ctx, smart_str(filename)) # [ ... source ]
+        compile_flags = 0
+        if self.force_strict:
+            compile_flags |= cduk.DUK_COMPILE_STRICT
+        cduk.fileio_push_file_string(self.ctx, smart_str(filename)) # [ ... source ]
+        if cduk.duk_is_string(self.ctx, -1):
+            key = (to_python_bytes(self.ctx, -1), filename, compile_flags)
+        else:
+            key = None
+        if key is not None and duk_get_compiled(self, key):
+            cduk.duk_remove(self.ctx, -2)  # [ ... func ]
+        elif self.bytecode_cache and \
+                duk_load_cached_bytecode(self, filename, 'program', compile_flags):
+            cduk.duk_remove(self.ctx, -2)  # [ ... func ]
+            if key is not None:
+                duk_put_compiled(self, key)
+        else:
             cduk.duk_push_string(self.ctx, smart_str(filename)) # [ ... source filename ]
-            compile_flags = 0
-            if self.force_strict:
-                compile_flags |= cduk.DUK_COMPILE_STRICT
-            duk_reraise(self, cduk.duk_pcompile(self.ctx, compile_flags)) # [ ... func ]
-            # bind 'this' to global object
-            cduk.duk_push_global_object(self.ctx)  # [ ... func global ]
-            duk_reraise(self, cduk.duk_pcall_method(self.ctx, 0)) # [ ... retval ]
-            cduk.duk_pop(self.ctx)
+            duk_reraise(self, duk_pcompile_nogil(self, compile_flags)) # [ ... func ]
+            if self.bytecode_cache:
+                duk_save_cached_bytecode(self, filename, 'program', compile_flags)
+            if key is not None:
+                duk_put_compiled(self, key)
+        duk_call_program(self, filename, timeout)
+
+    def dump_bytecode(self, filename, source=None):
+        # Compiles filename (or source, using filename as the script name)
+        # like load() does and returns its bytecode
+        compile_flags = 0
+        if self.force_strict:
+            compile_flags |= cduk.DUK_COMPILE_STRICT
+        if source is None:
+            cduk.fileio_push_file_string(self.ctx, smart_str(filename)) # [ ... source ]
+        else:
+            duk_push_smart_str(self.ctx, source)                        # [ ... source ]
+        cduk.duk_push_string(self.ctx, smart_str(filename))             # [ ... source filename ]
+        duk_reraise(self, cduk.duk_pcompile(self.ctx, compile_flags))   # [ ... func ]
+        try:
+            return duk_dump_bytecode(self)
         finally:
-            cduk.duk_push_global_stash(self.ctx)
-            cduk.duk_del_prop_string(self.ctx, -1, b"__duktape_loading_file__")
             cduk.duk_pop(self.ctx)
 
+    def load_bytecode(self, bytecode, filename=None):
+        # Executes bytecode returned by dump_bytecode() like load() does.
+        # Duktape does not validate bytecode: never load untrusted bytecode!
+        duk_push_bytecode(self, bytecode)  # [ ... func ]
+        duk_call_program(self, filename)
 
-    def eval(self, js, filename="eval"):
-        # Eval code: compiles into a function with zero arguments, which
-        # executes like an ECMAScript eval call
-        cduk.duk_push_string(self.ctx, smart_str(js))       # [ ... source ]
-        cduk.duk_push_string(self.ctx, smart_str(filename)) # [ ... source filename ]
-        compile_flags = cduk.DUK_COMPILE_EVAL
-        if self.force_strict:
-            compile_flags |= cduk.DUK_COMPILE_STRICT
-        duk_reraise(self, cduk.duk_pcompile(self.ctx, compile_flags)) # [ ... func ]
-        duk_reraise(self, cduk.duk_pcall(self.ctx, 0)) # [ ... retval ]
-        return to_python(self, -1)
+    def eval(self, js, filename="eval", timeout=None, lazy=None):
+        duk_compile_eval(self, js, filename)                        # [ ... func ]
+        duk_reraise(self, duk_pcall_nogil(self, 0, CALL_FUNCTION, timeout)) # [ ... retval ]
+        return to_python_result(self, -1, lazy)
 
     loads = eval
 
+    def compile(self, js, filename="eval"):
+        # Returns a JsFunc which, when called, executes the compiled code
+        # like eval() does without parsing the source again
+        duk_compile_eval(self, js, filename)  # [ ... func ]
+        try:
+            return to_python_proxy(self, -1)
+        finally:
+            cduk.duk_pop(self.ctx)
+
+    def clear_module_cache(self):
+        if self.module_cache is not None:
+            self.module_cache.clear()
+
+    def compile_cache_info(self):
+        cache = self.compile_cache
+        return CompileCacheInfo(cache.hits, cache.misses, cache.maxsize, len(cache.entries))
+
+    def clear_compile_cache(self):
+        cache = self.compile_cache
+        cduk.duk_push_global_stash(self.ctx)
+        cduk.duk_push_object(self.ctx)
+        cduk.duk_put_prop_string(self.ctx, -2, b"_compiled")
+        cduk.duk_pop(self.ctx)
+        cache.entries.clear()
+        cache.hits = cache.misses = 0
+
     def gc(self):
         cduk.duk_gc(self.ctx, 0)
 
+    def memory_stats(self):
+        # shared by all the threads of the heap
+        udata = self.udata
+        return MemoryStats(udata.memory_used, udata.memory_peak, udata.memory_limit or None,
+                           udata.allocs, udata.reallocs, udata.frees, udata.failed)
+
+    def start_profiler(self, interval_ms=10):
+        # Samples the JS call stack every interval_ms while code executes in
+        # the heap (this context and its threads) until stop_profiler()
+        if self.heap.profiler is not None:
+            raise RuntimeError("the profiler is already running")
+        profiler = Profiler(interval_ms / 1e3)
+        self.heap.profiler = profiler
+        self.udata.profiler = <void *>profiler
+        self.udata.sample_interval = profiler.interval
+        self.udata.next_sample = 0
+        self.udata.sampler = profiler_sampler
+
+    def stop_profiler(self):
+        # returns the Profiler holding the samples
+        profiler = self.heap.profiler
+        if profiler is None:
+            raise RuntimeError("the profiler is not running")
+        self.udata.sampler = NULL
+        self.udata.profiler = NULL
+        self.heap.profiler = None
+        return profiler
+
     def _get(self):
         return to_python(self, -1)
 
@@ -1258,29 +3079,32 @@ cdef class Context:
         else:
             thr_idx = cduk.duk_push_thread(self.ctx)
         thr = ThreadContext(self, thr_idx, new_globalenv)
-        thr_id = str(id(thr))
 
         # Store a reference to the thread so that it is reachable from a
-        # garbage collection point of view
-        cduk.duk_push_global_stash(self.ctx)                            # [ ... thr stash ]
-        cduk.duk_get_prop_string(self.ctx, -1, b"_threads")             # [ ... thr stash _threads ]
-        cduk.duk_dup(self.ctx, thr_idx)                                 # [ ... thr stash _threads thr ]
-        cduk.duk_put_prop_string(self.ctx, -2, smart_str(thr_id))       # [ ... thr stash _threads ]
-        cduk.duk_pop_n(self.ctx, 3)                                     # [ ... ]
-
-        def finalize_thread(thr_id):
-            # Make the thread unreachable so that it can be garbage collected
-            # (assuming there are no other references to it)
-            cduk.duk_push_global_stash(self.ctx)                        # [ ... stash ]
-            cduk.duk_get_prop_string(self.ctx, -1, b"_threads")         # [ ... stash _threads ]
-            cduk.duk_del_prop_string(self.ctx, -1, smart_str(thr_id))
-            cduk.duk_pop_n(self.ctx, 2)                                 # [ ... ]
-        weakref.finalize(thr, finalize_thread, thr_id)
+        # garbage collection point of view, until thr is deallocated
+        thr.thread_id = self.threads.register(self.ctx, thr_idx)
+        cduk.duk_pop(self.ctx)                                          # [ ... ]
 
         return thr
 
+    def register(self, namespace, functions, lightfunc=True):
+        # Installs functions, a mapping of names to functions or PyFuncs, or a
+        # FunctionTable, in the namespace object (a dotted name created if
+        # needed, None for the global object); the FunctionTable is returned
+        # to be registered with other contexts. The functions are kept until
+        # the heap is destroyed, at most MAX_CALLBACKS of them: reuse tables
+        # rather than registering new ones repeatedly.
+        if not isinstance(functions, FunctionTable):
+            functions = FunctionTable(functions)
+        (<FunctionTable>functions).install(self, namespace, lightfunc)
+        return functions
+
+    def thread_pool(self, size=16, new_globalenv=True, reset=None, init=None, max_idle=None):
+        # A pool of threads of this context, see ThreadContextPool
+        return ThreadContextPool(self, size, new_globalenv, reset, init, max_idle)
+
     def proxy(self, key):
-        if not duk_get_global_dotted_string(self, smart_str(key)):
+        if not duk_get_global_name(self, key):
             # XXX raise Error?
             return
         try:
@@ -1289,9 +3113,11 @@ cdef class Context:
             cduk.duk_pop(self.ctx)
 
 
+@cython.no_gc_clear
 cdef class ThreadContext(Context):
 
     cdef Context parent_pyctx
+    cdef cduk.duk_uarridx_t thread_id
     cdef object __weakref__
 
     def __init__(self, Context parent_pyctx, thr_idx, new_globalenv):
@@ -1300,10 +3126,31 @@ cdef class ThreadContext(Context):
         self.to_js_hook = parent_pyctx.to_js_hook
         self.to_py_hook = parent_pyctx.to_py_hook
         self.force_strict = parent_pyctx.force_strict
+        self.bytecode_cache = parent_pyctx.bytecode_cache
+        self.marshal = parent_pyctx.marshal
+        self.lazy = parent_pyctx.lazy
+        self.heap = parent_pyctx.heap
+        self.udata = parent_pyctx.udata
+        self.timeout = parent_pyctx.timeout
+        self.max_ops = parent_pyctx.max_ops
+        self.module_cache = parent_pyctx.module_cache
+        self.module_loader = parent_pyctx.module_loader
         if new_globalenv:
+            # compiled functions are bound to the global environment they
+            # have been compiled in, so a new one needs its own cache
+            self.compile_cache = CompileCache(parent_pyctx.compile_cache.maxsize)
             self.ctx = cduk.duk_get_context(parent_pyctx.ctx, thr_idx)
             self.setup()
         else:
+            self.compile_cache = parent_pyctx.compile_cache
+            self.refs = parent_pyctx.refs
+            self.threads = parent_pyctx.threads
+            self.object_prototype = parent_pyctx.object_prototype
+            self.date_constructor = parent_pyctx.date_constructor
+            self.error_constructor = parent_pyctx.error_constructor
+            self.python_error_constructor = parent_pyctx.python_error_constructor
+            self.event_loop = parent_pyctx.event_loop
+            self.promise_constructor = parent_pyctx.promise_constructor
             self.ctx = cduk.duk_get_context(parent_pyctx.ctx, thr_idx)
             cduk.duk_push_thread_stash(self.ctx, self.ctx)
             cduk.duk_push_pointer(self.ctx, <void*>self)
@@ -1323,6 +3170,17 @@ cdef class ThreadContext(Context):
         #   duk_destroy_heap: If ctx is NULL, the call is a no-op.
         #
         self.ctx = NULL
+        if self.udata != NULL and self.udata.pyctx == <void *>self:
+            self.udata.pyctx_ctx = NULL
+            self.udata.pyctx = NULL
+        parent = self.parent_pyctx
+        if parent is None or parent.threads is None:
+            return
+        if parent.heap is not None and parent.heap.nogil_depth:
+            # the heap is executing in another thread
+            parent.heap.pending.append(functools.partial(unregister_thread, parent, self.thread_id))
+        else:
+            parent.threads.unregister(parent.ctx, self.thread_id)
 
     def suspend(self):
         state = ThreadState()
@@ -1333,14 +3191,14 @@ cdef class ThreadContext(Context):
         cduk.duk_resume(self.ctx, &state.ts)
 
     def init_thread_only(self, key, *args):
-        if not duk_get_global_dotted_string(self, smart_str(key)):
+        if not duk_get_global_name(self, key):
             raise RuntimeError("ThreadOnly %r does not exist!" % key)
         cduk.duk_push_thread_stash(self.ctx, self.ctx)
         cduk.duk_get_prop_string(self.ctx, -2, DUK_HIDDEN_SYMBOL(b'id'))
         cduk.duk_get_prop_string(self.ctx, 0, DUK_HIDDEN_SYMBOL(b'constructor'))
         for arg in args:
             to_js(self, arg)
-        duk_reraise(self, cduk.duk_pnew(self.ctx, len(args)))
+        duk_reraise(self, duk_pcall_nogil(self, len(args), CALL_NEW))
         cduk.duk_put_prop(self.ctx, -3)
         cduk.duk_pop_n(self.ctx, 2)
 
@@ -1348,3 +3206,774 @@ cdef class ThreadContext(Context):
 cdef class ThreadState(object):
 
     cdef cduk.duk_thread_state ts
+
+
+ContextPoolStats = collections.namedtuple('ContextPoolStats',
+                                          'checkouts creations discards wait_time idle in_use')
+
+
+# Evaluated in every pooled context when reset='snapshot': records the own
+# properties of the global object and returns a function restoring them
+SNAPSHOT_GLOBALS_JS = b'''
+(function(global) {
+    var saved = Object.create(null);
+    Object.getOwnPropertyNames(global).forEach(function(key) {
+        saved[key] = Object.getOwnPropertyDescriptor(global, key);
+    });
+    return function() {
+        Object.getOwnPropertyNames(global).forEach(function(key) {
+            if (key in saved) {
+                var desc = Object.getOwnPropertyDescriptor(global, key);
+                if (desc.configurable) {
+                    Object.defineProperty(global, key, saved[key]);
+                } else if (desc.writable) {
+                    global[key] = saved[key].value;
+                }
+            } else if (!delete global[key]) {
+                // var declarations can not be deleted
+                global[key] = undefined;
+            }
+        });
+    };
+})(new Function('return this')())
+'''
+
+
+class ContextPool:
+
+    def __init__(self, factory=None, size=4, max_idle=None, reset='gc', **context_kwargs):
+        # factory defaults to Context(**context_kwargs), max_idle is the
+        # number of seconds after which an idle context is discarded
+        if reset not in (None, 'gc', 'snapshot'):
+            raise ValueError("reset must be one of None, 'gc' or 'snapshot'")
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        if factory is None:
+            factory = functools.partial(Context, **context_kwargs)
+        elif context_kwargs:
+            raise TypeError("context arguments can not be combined with a factory")
+        self.factory = factory
+        self.size = size
+        self.max_idle = max_idle
+        self.reset = reset
+        self.lock = threading.Condition()
+        self.idle = collections.deque()
+        self.total = 0
+        self.checkouts = 0
+        self.creations = 0
+        self.discards = 0
+        self.wait_time = 0.0
+        self.closed = False
+
+        for i in range(size):
+            self.idle.append(self.create())
+            self.total += 1
+
+    def create(self):
+        ctx = self.factory()
+        if self.reset == 'snapshot':
+            restore = ctx.eval(SNAPSHOT_GLOBALS_JS)
+        else:
+            restore = None
+        (<Context?>ctx).clear_stack()
+        with self.lock:
+            self.creations += 1
+        return [ctx, restore, time.monotonic()]
+
+    def acquire(self, timeout=None):
+        started = time.monotonic()
+        with self.lock:
+            while True:
+                if self.closed:
+                    raise RuntimeError("the pool is closed")
+                now = time.monotonic()
+                if self.max_idle is not None:
+                    # the least recently used entries are on the left
+                    while self.idle and now - self.idle[0][2] > self.max_idle:
+                        self.idle.popleft()
+                        self.total -= 1
+                        self.discards += 1
+                if self.idle:
+                    entry = self.idle.pop()
+                    break
+                if self.total < self.size:
+                    self.total += 1
+                    entry = None
+                    break
+                if timeout is not None and now - started >= timeout:
+                    raise builtins.TimeoutError("no context available in the pool")
+                self.lock.wait(None if timeout is None else timeout - (now - started))
+            self.checkouts += 1
+            self.wait_time += time.monotonic() - started
+
+        if entry is None:
+            try:
+                entry = self.create()
+            except BaseException:
+                with self.lock:
+                    self.total -= 1
+                    self.lock.notify()
+                raise
+        return entry
+
+    def release(self, entry):
+        ctx, restore, _ = entry
+        try:
+            self.clean(ctx, restore)
+        except Exception:
+            with self.lock:
+                self.total -= 1
+                self.discards += 1
+                self.lock.notify()
+            return
+        entry[2] = time.monotonic()
+        with self.lock:
+            if self.closed:
+                self.total -= 1
+                self.discards += 1
+            else:
+                self.idle.append(entry)
+            self.lock.notify()
+
+    def clean(self, ctx, restore):
+        (<Context>ctx).clear_stack()
+        if restore is not None:
+            restore()
+            (<Context>ctx).clear_stack()
+        if self.reset is not None:
+            ctx.gc()
+
+    @contextlib.contextmanager
+    def checkout(self, timeout=None):
+        entry = self.acquire(timeout)
+        try:
+            yield entry[0]
+        finally:
+            self.release(entry)
+
+    def stats(self):
+        with self.lock:
+            return ContextPoolStats(self.checkouts, self.creations, self.discards, self.wait_time,
+                                    len(self.idle), self.total - len(self.idle))
+
+    def close(self):
+        # discards the idle contexts, the ones in use are dropped on release,
+        # acquire() then raises RuntimeError
+        with self.lock:
+            self.total -= len(self.idle)
+            self.idle.clear()
+            self.closed = True
+            self.lock.notify_all()
+
+
+class ThreadContextPool(ContextPool):
+    # A pool of threads of one heap: they are cheaper to create than contexts
+    # and reusing them saves setting up the global environment of each.
+    # The threads share the heap so the pool must only be used from one OS
+    # thread at a time (e.g. an asyncio loop), acquire() then never waits
+    # and raises TimeoutError when size threads are in use.
+    #
+    # reset: 'snapshot' (the default for new_globalenv threads) restores the
+    # globals on release, 'gc' also runs a garbage collection of the whole
+    # heap. init(thread) is called on creation, before the snapshot.
+
+    def __init__(self, Context ctx, size=16, new_globalenv=True, reset=None, init=None,
+                 max_idle=None):
+        if reset is None and new_globalenv:
+            reset = 'snapshot'
+        if reset is not None and not new_globalenv:
+            raise ValueError("threads sharing the global environment cannot be reset")
+        self.init = init
+        self.ctx = ctx
+        self.new_globalenv = new_globalenv
+        super().__init__(self.new_thread, size, max_idle, reset)
+
+    def new_thread(self):
+        thread = self.ctx.new_thread(self.new_globalenv)
+        if self.init is not None:
+            self.init(thread)
+        return thread
+
+    def acquire(self, timeout=0):
+        return super().acquire(timeout)
+
+    def checkout(self, timeout=0):
+        return super().checkout(timeout)
+
+    def clean(self, ctx, restore):
+        (<Context>ctx).clear_stack()
+        if restore is not None:
+            restore()
+            (<Context>ctx).clear_stack()
+        if self.reset == 'gc':
+            ctx.gc()
+
+
+# Evaluated by EventLoop and called with the Python callbacks: installs the
+# timer functions, a Promise implementation when the engine lacks one and a
+# job queue drained after every timer callback. Returns the functions called
+# by EventLoop.
+EVENT_LOOP_JS = b'''
+(function(host) {
+    var global = new Function('return this')();
+    var callbacks = {};
+    var deferreds = {};
+    var jobs = [];
+    var draining = false;
+    var slice = Array.prototype.slice;
+
+    function enqueueJob(job) {
+        jobs.push(job);
+        if (!draining && jobs.length === 1) {
+            host.requestDrain();
+        }
+    }
+
+    function drain() {
+        draining = true;
+        try {
+            for (var i = 0; i < jobs.length; i++) {
+                try {
+                    jobs[i]();
+                } catch (e) {
+                    host.error(e);
+                }
+            }
+        } finally {
+            jobs = [];
+            draining = false;
+        }
+    }
+
+    function bind(func, args) {
+        if (typeof func !== 'function') {
+            throw new TypeError('callback is not a function');
+        }
+        return args.length ? function() { func.apply(global, args); } : func;
+    }
+
+    function timer(repeat) {
+        return function(func, delay) {
+            var callback = bind(func, slice.call(arguments, 2));
+            var id = host.schedule(+delay || 0, repeat);
+            callbacks[id] = callback;
+            return id;
+        };
+    }
+
+    function clear(id) {
+        if (id in callbacks) {
+            delete callbacks[id];
+            host.cancel(id);
+        }
+    }
+
+    global.setTimeout = timer(false);
+    global.setInterval = timer(true);
+    global.setImmediate = function(func) {
+        var callback = bind(func, slice.call(arguments, 1));
+        var id = host.immediate();
+        callbacks[id] = callback;
+        return id;
+    };
+    global.clearTimeout = global.clearInterval = global.clearImmediate = clear;
+    global.queueMicrotask = function(func) {
+        enqueueJob(bind(func, []));
+    };
+
+    if (typeof global.Promise !== 'function') {
+        var PENDING = 0, FULFILLED = 1, REJECTED = 2;
+
+        var settle = function(promise, state, value) {
+            var p = promise._promise;
+            if (p.state !== PENDING) {
+                return;
+            }
+            p.state = state;
+            p.value = value;
+            var reactions = p.reactions;
+            p.reactions = null;
+            for (var i = 0; i < reactions.length; i++) {
+                react(reactions[i], p);
+            }
+        };
+
+        var resolvePromise = function(promise, value) {
+            if (value === promise) {
+                return settle(promise, REJECTED, new TypeError('a promise cannot resolve to itself'));
+            }
+            if (value !== null && (typeof value === 'object' || typeof value === 'function')) {
+                var then;
+                try {
+                    then = value.then;
+                } catch (e) {
+                    return settle(promise, REJECTED, e);
+                }
+                if (typeof then === 'function') {
+                    enqueueJob(function() {
+                        var called = false;
+                        try {
+                            then.call(value, function(v) {
+                                if (!called) { called = true; resolvePromise(promise, v); }
+                            }, function(e) {
+                                if (!called) { called = true; settle(promise, REJECTED, e); }
+                            });
+                        } catch (e) {
+                            if (!called) { called = true; settle(promise, REJECTED, e); }
+                        }
+                    });
+                    return;
+                }
+            }
+            settle(promise, FULFILLED, value);
+        };
+
+        var react = function(reaction, p) {
+            enqueueJob(function() {
+                var handler = p.state === FULFILLED ? reaction.fulfilled : reaction.rejected;
+                var result;
+                if (typeof handler !== 'function') {
+                    if (p.state === FULFILLED) {
+                        resolvePromise(reaction.promise, p.value);
+                    } else {
+                        settle(reaction.promise, REJECTED, p.value);
+                    }
+                    return;
+                }
+                try {
+                    result = handler(p.value);
+                } catch (e) {
+                    return settle(reaction.promise, REJECTED, e);
+                }
+                resolvePromise(reaction.promise, result);
+            });
+        };
+
+        var Promise = function Promise(executor) {
+            if (!(this instanceof Promise)) {
+                throw new TypeError('Promise must be called with new');
+            }
+            var self = this;
+            var done = false;
+            Object.defineProperty(this, '_promise', {
+                value: {state: PENDING, value: undefined, reactions: []}
+            });
+            try {
+                executor(function(value) {
+                    if (!done) { done = true; resolvePromise(self, value); }
+                }, function(reason) {
+                    if (!done) { done = true; settle(self, REJECTED, reason); }
+                });
+            } catch (e) {
+                if (!done) { done = true; settle(self, REJECTED, e); }
+            }
+        };
+
+        Promise.prototype.then = function(fulfilled, rejected) {
+            var p = this._promise;
+            var reaction = {fulfilled: fulfilled, rejected: rejected, promise: new Promise(function() {})};
+            if (p.state === PENDING) {
+                p.reactions.push(reaction);
+            } else {
+                react(reaction, p);
+            }
+            return reaction.promise;
+        };
+        Promise.prototype['catch'] = function(rejected) {
+            return this.then(undefined, rejected);
+        };
+        Promise.prototype['finally'] = function(func) {
+            return this.then(function(value) {
+                return Promise.resolve(func()).then(function() { return value; });
+            }, function(reason) {
+                return Promise.resolve(func()).then(function() { throw reason; });
+            });
+        };
+        Promise.resolve = function(value) {
+            if (value instanceof Promise) {
+                return value;
+            }
+            return new Promise(function(resolve) { resolve(value); });
+        };
+        Promise.reject = function(reason) {
+            return new Promise(function(resolve, reject) { reject(reason); });
+        };
+        Promise.all = function(values) {
+            return new Promise(function(resolve, reject) {
+                var results = [], remaining = values.length;
+                if (!remaining) {
+                    return resolve(results);
+                }
+                values.forEach(function(value, i) {
+                    Promise.resolve(value).then(function(v) {
+                        results[i] = v;
+                        if (--remaining === 0) {
+                            resolve(results);
+                        }
+                    }, reject);
+                });
+            });
+        };
+        Promise.allSettled = function(values) {
+            return Promise.all(values.map(function(value) {
+                return Promise.resolve(value).then(function(v) {
+                    return {status: 'fulfilled', value: v};
+                }, function(e) {
+                    return {status: 'rejected', reason: e};
+                });
+            }));
+        };
+        Promise.race = function(values) {
+            return new Promise(function(resolve, reject) {
+                values.forEach(function(value) {
+                    Promise.resolve(value).then(resolve, reject);
+                });
+            });
+        };
+        global.Promise = Promise;
+    }
+
+    return {
+        run: function(id, repeat) {
+            var callback = callbacks[id];
+            if (!repeat) {
+                delete callbacks[id];
+            }
+            draining = true;
+            try {
+                if (callback) {
+                    callback();
+                }
+            } finally {
+                drain();
+            }
+        },
+        drain: drain,
+        pending: function() {
+            return jobs.length;
+        },
+        deferred: function(id) {
+            return new global.Promise(function(resolve, reject) {
+                deferreds[id] = [resolve, reject];
+            });
+        },
+        resolve: function(id, fulfilled, value) {
+            var deferred = deferreds[id];
+            delete deferreds[id];
+            deferred[fulfilled ? 0 : 1](value);
+        },
+        settle: function(promise, id) {
+            promise.then(function(value) {
+                host.settle(id, true, value);
+            }, function(reason) {
+                host.settle(id, false, reason);
+            });
+        },
+        Promise: global.Promise
+    };
+})
+'''
+
+
+class EventLoop:
+    # Runs the setTimeout, setInterval and setImmediate callbacks and the
+    # Promise jobs of a Context on an asyncio event loop. Timers are kept in
+    # a heap ordered by deadline with a single asyncio timer armed for the
+    # earliest one, their ids are stable. Promises converted to Python (e.g.
+    # returned by eval() or a JsFunc) become asyncio futures, awaitables
+    # converted to JS (e.g. returned by an async def function called from JS)
+    # become Promises. The loop argument is required when no asyncio loop is
+    # running (e.g. to use run_until_idle()).
+
+    def __init__(self, Context ctx, loop=None):
+        if ctx.event_loop is not None:
+            raise ValueError("the context already has an event loop")
+        self.ctx = ctx
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+        # timer id -> [deadline, delay, repeat], cancelled timers are removed
+        # here and skipped when they reach the top of the heap
+        self.timers = {}
+        self.queue = []
+        self.immediates = collections.deque()
+        self.ids = itertools.count(1)
+        self.handle = None
+        self.drain_scheduled = False
+        self.futures = {}
+        self.tasks = {}
+        self.waiters = []
+
+        install = ctx.eval(EVENT_LOOP_JS)
+        cduk.duk_pop(ctx.ctx)
+        api = install({
+            'schedule': PyFunc(self.schedule, 2),
+            'immediate': PyFunc(self.immediate, 0),
+            'cancel': PyFunc(self.cancel, 1),
+            'requestDrain': PyFunc(self.request_drain, 0),
+            'settle': PyFunc(self.settle, 3),
+            'error': PyFunc(self.error, 1),
+        }, lazy=True)
+        self.run_callback = api['run']
+        self.drain = api['drain']
+        self.pending_jobs = api['pending']
+        self.settle_promise = api['settle']
+        self.deferred = api['deferred']
+        self.resolve_deferred = api['resolve']
+
+        cduk.duk_push_global_stash(ctx.ctx)
+        (<JsProxy>api['Promise']).push_proxy_ref()
+        ctx.promise_constructor = cduk.duk_get_heapptr(ctx.ctx, -1)
+        cduk.duk_put_prop_string(ctx.ctx, -2, b"_promise_constructor")
+        cduk.duk_pop(ctx.ctx)
+        ctx.event_loop = self
+
+    def schedule(self, delay, repeat):
+        # delays are clamped to 1ms (as in Node.js) so that run_timers() only
+        # runs the timers which were due when it started
+        timer_id = next(self.ids)
+        delay = max(delay, 1) / 1000
+        deadline = self.loop.time() + delay
+        self.timers[timer_id] = [deadline, delay, repeat]
+        heapq.heappush(self.queue, (deadline, timer_id))
+        if self.queue[0][1] == timer_id:
+            self.arm()
+        return timer_id
+
+    def immediate(self):
+        timer_id = next(self.ids)
+        self.timers[timer_id] = None
+        if not self.immediates:
+            self.loop.call_soon(self.run_immediates)
+        self.immediates.append(timer_id)
+        return timer_id
+
+    def cancel(self, timer_id):
+        self.timers.pop(timer_id, None)
+        self.check_idle()
+
+    def arm(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        while self.queue and self.queue[0][1] not in self.timers:
+            heapq.heappop(self.queue)
+        if self.queue:
+            self.handle = self.loop.call_at(self.queue[0][0], self.run_timers)
+
+    def run_timers(self):
+        self.handle = None
+        self.run_drain()
+        now = self.loop.time()
+        while self.queue and self.queue[0][0] <= now:
+            deadline, timer_id = heapq.heappop(self.queue)
+            timer = self.timers.get(timer_id)
+            if timer is None or timer[0] != deadline:
+                continue
+            if timer[2]:
+                timer[0] = now + timer[1]
+                heapq.heappush(self.queue, (timer[0], timer_id))
+            else:
+                del self.timers[timer_id]
+            self.run(timer_id, timer[2])
+        self.arm()
+        self.check_idle()
+
+    def run_immediates(self):
+        # the immediates scheduled by these callbacks run on the next
+        # iteration of the loop
+        self.run_drain()
+        for i in range(len(self.immediates)):
+            timer_id = self.immediates.popleft()
+            if self.timers.pop(timer_id, False) is not False:
+                self.run(timer_id, False)
+        self.check_idle()
+
+    def run(self, timer_id, repeat):
+        try:
+            self.run_callback(timer_id, repeat)
+        except Exception as e:
+            self.error(e)
+
+    def request_drain(self):
+        if not self.drain_scheduled:
+            self.drain_scheduled = True
+            self.loop.call_soon(self.run_drain)
+
+    def run_drain(self):
+        # jobs queued outside of a callback (e.g. by eval()) run before the
+        # next callback
+        if self.drain_scheduled:
+            self.drain_scheduled = False
+            self.drain()
+            self.check_idle()
+
+    def error(self, error):
+        self.loop.call_exception_handler({
+            'message': 'Unhandled error in a JS callback',
+            'exception': error if isinstance(error, BaseException) else Error(str(error)),
+        })
+
+    def to_future(self, promise):
+        future = self.loop.create_future()
+        future_id = next(self.ids)
+        self.futures[future_id] = future
+        self.settle_promise(promise, future_id)
+        return future
+
+    def settle(self, future_id, fulfilled, value):
+        future = self.futures.pop(future_id, None)
+        if future is None or future.done():
+            return
+        if fulfilled:
+            future.set_result(value)
+        elif isinstance(value, BaseException):
+            future.set_exception(value)
+        else:
+            future.set_exception(Error(str(value)))
+
+    def to_promise(self, awaitable):
+        # runs the awaitable as a task, returns the id of the deferred
+        # Promise settled with its result
+        promise_id = next(self.ids)
+        task = asyncio.ensure_future(awaitable, loop=self.loop)
+        self.tasks[promise_id] = task
+        task.add_done_callback(functools.partial(self.task_done, promise_id))
+        return promise_id
+
+    def cancel_task(self, promise_id):
+        # the deferred Promise of the task could not be created
+        task = self.tasks.pop(promise_id, None)
+        if task is not None:
+            task.cancel()
+        self.check_idle()
+
+    def task_done(self, promise_id, task):
+        if self.tasks.pop(promise_id, None) is None:
+            # closed
+            return
+        if task.cancelled():
+            fulfilled, value = False, Error("cancelled")
+        elif task.exception() is not None:
+            fulfilled, value = False, task.exception()
+        else:
+            fulfilled, value = True, task.result()
+        try:
+            self.resolve_deferred(promise_id, fulfilled, value)
+        except Exception as e:
+            # e.g. the result cannot be converted
+            try:
+                self.resolve_deferred(promise_id, False, e)
+            except Exception as e:
+                self.error(e)
+        self.check_idle()
+
+    def idle(self):
+        return not self.timers and not self.tasks and not self.drain_scheduled and \
+            not self.pending_jobs()
+
+    def check_idle(self):
+        if self.waiters and self.idle():
+            waiters, self.waiters = self.waiters, []
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    async def wait(self):
+        # waits until there are no timers and no jobs left
+        if not self.idle():
+            waiter = self.loop.create_future()
+            self.waiters.append(waiter)
+            await waiter
+
+    def run_until_idle(self):
+        self.loop.run_until_complete(self.wait())
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.timers.clear()
+        self.queue.clear()
+        self.immediates.clear()
+        for future in self.futures.values():
+            future.cancel()
+        self.futures.clear()
+        tasks = list(self.tasks.values())
+        self.tasks.clear()
+        for task in tasks:
+            task.cancel()
+
+
+# Contexts built by JsProcessExecutor(fork_after_warm=True) before forking its
+# workers, by executor token
+_warm_contexts = {}
+_executor_tokens = itertools.count()
+# The context of a JsProcessExecutor worker process
+_worker_context = None
+
+
+def _build_worker_context(context_kwargs, scripts, functions, initializer, initargs):
+    ctx = Context(**context_kwargs)
+    for name, func in functions.items():
+        ctx[name] = func if isinstance(func, PyFunc) else PyFunc(func)
+    for filename in scripts:
+        ctx.load(filename)
+    if initializer is not None:
+        initializer(ctx, *initargs)
+    cduk.duk_set_top((<Context>ctx).ctx, 0)
+    return ctx
+
+
+def _init_worker(token, *args):
+    global _worker_context
+    # a warm context is inherited from the parent when the worker is forked
+    _worker_context = _warm_contexts.get(token)
+    if _worker_context is None:
+        _worker_context = _build_worker_context(*args)
+
+
+def _call_worker(func_name, *args):
+    cdef Context ctx = _worker_context
+    # looked up on each call: the scripts may reassign the function
+    try:
+        if not duk_get_global_dotted_string(ctx, smart_str(func_name)) or \
+                not cduk.duk_is_function(ctx.ctx, -1):
+            raise TypeError("%r is not a function" % func_name)
+        return to_python(ctx, -1)(*args)
+    finally:
+        ctx.clear_stack()
+
+
+class JsProcessExecutor(concurrent.futures.Executor):
+    # Calls global JS functions in a pool of worker processes, each building
+    # its Context once: Context(**context_kwargs), the functions (callables
+    # or PyFuncs) set as globals, the scripts loaded and initializer(ctx,
+    # *initargs) called. Arguments and results are pickled, they must be
+    # convertible to and from JS without proxies.
+    #
+    # fork_after_warm: the context is built in this process and the workers
+    # are forked from it, inheriting its heap copy-on-write instead of each
+    # loading the scripts (requires the fork start method)
+
+    def __init__(self, max_workers=None, context_kwargs=None, scripts=(), functions=None,
+                 initializer=None, initargs=(), fork_after_warm=False, mp_context=None):
+        self.token = next(_executor_tokens)
+        args = (context_kwargs or {}, tuple(scripts), dict(functions or {}), initializer, initargs)
+        if fork_after_warm:
+            if mp_context is None:
+                mp_context = multiprocessing.get_context('fork')
+            elif mp_context.get_start_method() != 'fork':
+                raise ValueError("fork_after_warm requires the fork start method")
+            _warm_contexts[self.token] = _build_worker_context(*args)
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers, mp_context, initializer=_init_worker, initargs=(self.token,) + args)
+
+    def submit(self, func_name, *args):
+        return self.pool.submit(_call_worker, func_name, *args)
+
+    def map(self, func_name, *iterables, timeout=None, chunksize=1):
+        return self.pool.map(functools.partial(_call_worker, func_name), *iterables,
+                             timeout=timeout, chunksize=chunksize)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        self.pool.shutdown(wait, cancel_futures=cancel_futures)
+        _warm_contexts.pop(self.token, None)
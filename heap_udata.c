@@ -0,0 +1,255 @@
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include "duktape_c/duktape.h"
+
+/* Duktape calls the execution timeout check every DUK_HTHREAD_INTCTR_DEFAULT
+ * bytecode instructions, which is not configurable.
+ */
+#define HEAP_UDATA_CHECK_INTERVAL (256L * 1024L)
+
+/* Every allocation is prefixed by a header holding its size, padded to keep
+ * the returned pointers aligned.
+ */
+#define HEAP_UDATA_HEADER_SIZE 16
+
+/* The pool allocator serves the sizes up to HEAP_UDATA_POOL_MAX_SIZE from
+ * free lists, one per multiple of HEAP_UDATA_POOL_GRANULE, refilled by
+ * carving HEAP_UDATA_POOL_CHUNK_SIZE bytes chunks which are only released
+ * with the heap.
+ */
+#define HEAP_UDATA_POOL_GRANULE 16
+#define HEAP_UDATA_POOL_CLASSES 16
+#define HEAP_UDATA_POOL_MAX_SIZE (HEAP_UDATA_POOL_GRANULE * HEAP_UDATA_POOL_CLASSES)
+#define HEAP_UDATA_POOL_CHUNK_SIZE (64 * 1024)
+
+typedef union heap_udata_header {
+    size_t size;
+    union heap_udata_header *next;
+    char padding[HEAP_UDATA_HEADER_SIZE];
+} heap_udata_header;
+
+typedef void (*heap_udata_sampler)(void *udata, duk_context *ctx);
+
+typedef struct {
+    /* memory accounting, sizes are the requested ones */
+    size_t memory_limit;  /* 0 for no limit */
+    size_t memory_used;
+    size_t memory_peak;
+    size_t allocs;
+    size_t reallocs;
+    size_t frees;
+    size_t failed;
+
+    int pool;
+    heap_udata_header *pool_free[HEAP_UDATA_POOL_CLASSES];
+    heap_udata_header *pool_chunks;
+    char *pool_chunk_next;
+    char *pool_chunk_end;
+
+    /* number of limited calls executing, limits are only enforced when
+     * non zero */
+    int depth;
+    /* set once a limit has been exceeded, Duktape requires the check to
+     * consistently report the timeout until the error has bubbled out */
+    int timed_out;
+    /* monotonic time in seconds, 0 for no timeout */
+    double deadline;
+    /* 0 for no limit */
+    long long max_ops;
+    long long ops;
+
+    /* the thread of the innermost call made from Python, set around the
+     * calls as the timeout check is not given the executing thread */
+    duk_context *exec_ctx;
+
+    /* sampling profiler: when set, sampler is called with exec_ctx at most
+     * every sample_interval seconds (and at least every
+     * HEAP_UDATA_CHECK_INTERVAL instructions) */
+    heap_udata_sampler sampler;
+    void *profiler;
+    double sample_interval;
+    double next_sample;
+
+    /* the Python context of the thread which last called into Python,
+     * saves the stash lookups when dispatching callbacks */
+    void *pyctx_ctx;
+    void *pyctx;
+} heap_udata;
+
+static double heap_udata_monotonic_time(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (double) ts.tv_sec + (double) ts.tv_nsec / 1e9;
+}
+
+void heap_udata_arm(heap_udata *udata, double timeout, long long max_ops) {
+    udata->timed_out = 0;
+    udata->deadline = timeout > 0 ? heap_udata_monotonic_time() + timeout : 0;
+    udata->max_ops = max_ops;
+    udata->ops = 0;
+}
+
+duk_bool_t duk_exec_timeout_check(void *udata) {
+    heap_udata *limits = (heap_udata *) udata;
+    if (limits == NULL) {
+        return 0;
+    }
+    if (limits->sampler != NULL && limits->exec_ctx != NULL && !limits->timed_out) {
+        double now = heap_udata_monotonic_time();
+        if (now >= limits->next_sample) {
+            limits->next_sample = now + limits->sample_interval;
+            limits->sampler(udata, limits->exec_ctx);
+        }
+    }
+    if (limits->depth == 0) {
+        return 0;
+    }
+    if (!limits->timed_out) {
+        limits->ops += HEAP_UDATA_CHECK_INTERVAL;
+        if (limits->max_ops && limits->ops >= limits->max_ops) {
+            limits->timed_out = 1;
+        } else if (limits->deadline && heap_udata_monotonic_time() >= limits->deadline) {
+            limits->timed_out = 1;
+        }
+    }
+    return limits->timed_out;
+}
+
+static int heap_udata_pool_class(size_t size) {
+    return (int) ((size + HEAP_UDATA_POOL_GRANULE - 1) / HEAP_UDATA_POOL_GRANULE) - 1;
+}
+
+static heap_udata_header *heap_udata_pool_alloc(heap_udata *udata, int cls) {
+    heap_udata_header *block = udata->pool_free[cls];
+    size_t block_size = HEAP_UDATA_HEADER_SIZE + (size_t) (cls + 1) * HEAP_UDATA_POOL_GRANULE;
+    if (block != NULL) {
+        udata->pool_free[cls] = block->next;
+        return block;
+    }
+    if (udata->pool_chunk_next == NULL ||
+            (size_t) (udata->pool_chunk_end - udata->pool_chunk_next) < block_size) {
+        heap_udata_header *chunk = malloc(HEAP_UDATA_POOL_CHUNK_SIZE);
+        if (chunk == NULL) {
+            return NULL;
+        }
+        /* the remainder of the previous chunk is wasted */
+        chunk->next = udata->pool_chunks;
+        udata->pool_chunks = chunk;
+        udata->pool_chunk_next = (char *) chunk + HEAP_UDATA_HEADER_SIZE;
+        udata->pool_chunk_end = (char *) chunk + HEAP_UDATA_POOL_CHUNK_SIZE;
+    }
+    block = (heap_udata_header *) udata->pool_chunk_next;
+    udata->pool_chunk_next += block_size;
+    return block;
+}
+
+static heap_udata_header *heap_udata_raw_alloc(heap_udata *udata, size_t size) {
+    if (udata->pool && size <= HEAP_UDATA_POOL_MAX_SIZE) {
+        return heap_udata_pool_alloc(udata, heap_udata_pool_class(size));
+    }
+    return malloc(HEAP_UDATA_HEADER_SIZE + size);
+}
+
+static void heap_udata_raw_free(heap_udata *udata, heap_udata_header *block) {
+    if (udata->pool && block->size <= HEAP_UDATA_POOL_MAX_SIZE) {
+        int cls = heap_udata_pool_class(block->size);
+        block->next = udata->pool_free[cls];
+        udata->pool_free[cls] = block;
+    } else {
+        free(block);
+    }
+}
+
+static int heap_udata_reserve(heap_udata *udata, size_t old_size, size_t new_size) {
+    if (udata->memory_limit && new_size > old_size &&
+            udata->memory_used + (new_size - old_size) > udata->memory_limit) {
+        udata->failed++;
+        return 0;
+    }
+    return 1;
+}
+
+static void heap_udata_account(heap_udata *udata, size_t old_size, size_t new_size) {
+    udata->memory_used = udata->memory_used - old_size + new_size;
+    if (udata->memory_used > udata->memory_peak) {
+        udata->memory_peak = udata->memory_used;
+    }
+}
+
+void *heap_udata_alloc(void *ptr, duk_size_t size) {
+    heap_udata *udata = (heap_udata *) ptr;
+    heap_udata_header *block;
+    if (size == 0 || !heap_udata_reserve(udata, 0, size)) {
+        return NULL;
+    }
+    block = heap_udata_raw_alloc(udata, size);
+    if (block == NULL) {
+        udata->failed++;
+        return NULL;
+    }
+    block->size = size;
+    udata->allocs++;
+    heap_udata_account(udata, 0, size);
+    return (char *) block + HEAP_UDATA_HEADER_SIZE;
+}
+
+void heap_udata_free(void *ptr, void *data) {
+    heap_udata *udata = (heap_udata *) ptr;
+    heap_udata_header *block;
+    if (data == NULL) {
+        return;
+    }
+    block = (heap_udata_header *) ((char *) data - HEAP_UDATA_HEADER_SIZE);
+    udata->frees++;
+    heap_udata_account(udata, block->size, 0);
+    heap_udata_raw_free(udata, block);
+}
+
+void *heap_udata_realloc(void *ptr, void *data, duk_size_t size) {
+    heap_udata *udata = (heap_udata *) ptr;
+    heap_udata_header *block, *new_block;
+    size_t old_size;
+    if (data == NULL) {
+        return heap_udata_alloc(ptr, size);
+    }
+    if (size == 0) {
+        heap_udata_free(ptr, data);
+        return NULL;
+    }
+    block = (heap_udata_header *) ((char *) data - HEAP_UDATA_HEADER_SIZE);
+    old_size = block->size;
+    if (!heap_udata_reserve(udata, old_size, size)) {
+        return NULL;
+    }
+    if (!udata->pool || (old_size > HEAP_UDATA_POOL_MAX_SIZE && size > HEAP_UDATA_POOL_MAX_SIZE)) {
+        new_block = realloc(block, HEAP_UDATA_HEADER_SIZE + size);
+    } else if (old_size <= HEAP_UDATA_POOL_MAX_SIZE && size <= HEAP_UDATA_POOL_MAX_SIZE &&
+               heap_udata_pool_class(old_size) == heap_udata_pool_class(size)) {
+        new_block = block;
+    } else {
+        new_block = heap_udata_raw_alloc(udata, size);
+        if (new_block != NULL) {
+            memcpy((char *) new_block + HEAP_UDATA_HEADER_SIZE, data, old_size < size ? old_size : size);
+            heap_udata_raw_free(udata, block);
+        }
+    }
+    if (new_block == NULL) {
+        udata->failed++;
+        return NULL;
+    }
+    new_block->size = size;
+    udata->reallocs++;
+    heap_udata_account(udata, old_size, size);
+    return (char *) new_block + HEAP_UDATA_HEADER_SIZE;
+}
+
+void heap_udata_release_pool(heap_udata *udata) {
+    heap_udata_header *chunk = udata->pool_chunks;
+    while (chunk != NULL) {
+        heap_udata_header *next = chunk->next;
+        free(chunk);
+        chunk = next;
+    }
+    udata->pool_chunks = NULL;
+}
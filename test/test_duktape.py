@@ -1,3 +1,4 @@
+import asyncio
 import os
 import datetime
 import gc
@@ -112,6 +113,101 @@ def test_push_plain_func():
     assert ctx['y'] == 'bar'
 
 
+def test_typed_pyfunc():
+    ctx = duktape.Context()
+    ctx['repeat'] = duktape.PyFunc(lambda s, n: [type(s).__name__, type(n).__name__, s * n], signature=(str, int))
+    ctx['scale'] = duktape.PyFunc(lambda x, flag, v: [type(x).__name__, flag, v], signature=(float, bool, None))
+    assert ctx.eval('repeat("ab", 3)') == ['str', 'int', 'ababab']
+    assert ctx.eval('scale(2, true, {a: 1})') == ['float', True, {'a': 1}]
+    # missing arguments are undefined
+    with pytest.raises(TypeError, match='argument 1 must be int, not NoneType'):
+        ctx.eval('repeat("ab")')
+    with pytest.raises(TypeError, match='argument 1 must be int, not float'):
+        ctx.eval('repeat("ab", 1.5)')
+    with pytest.raises(TypeError, match='argument 0 must be str, not int'):
+        ctx.eval('repeat(1, 1)')
+
+    with pytest.raises(TypeError):
+        duktape.PyFunc(len, signature=(list,))
+    with pytest.raises(ValueError):
+        duktape.PyFunc(len, 2, signature=(str,))
+
+
+def test_pyfunc_dispatch_across_threads():
+    ctx = duktape.Context()
+    ctx['who'] = lambda: 'ctx'
+    ctx.eval('function call() { return who(); }')
+    th = ctx.new_thread(True)
+    th['who'] = lambda: 'thread'
+    th.eval('function call() { return who(); }')
+    for _ in range(3):
+        assert ctx.eval('call()') == 'ctx'
+        assert th.eval('call()') == 'thread'
+    del th
+    gc.collect()
+    assert ctx.eval('call()') == 'ctx'
+
+
+@pytest.mark.parametrize('lightfunc', [True, False])
+def test_register_function_table(lightfunc):
+    def boom():
+        raise ValueError('boom')
+
+    ctx = duktape.Context()
+    table = ctx.register('api.util', {
+        'add': duktape.PyFunc(lambda a, b: a + b, 2),
+        'join': duktape.PyFunc(lambda *a: '-'.join(a), signature=(str,) * 16),
+        'args': lambda *a: list(a),
+        'boom': boom,
+    }, lightfunc=lightfunc)
+    assert len(table) == 4
+    assert ctx.eval('[api.util.add(1, 2), api.util.add.length, api.util.args(1, "a")]') == [3, 2, [1, 'a']]
+    assert ctx.eval('api.util.join.apply(null, "abcdefghijklmnop".split(""))') == '-'.join('abcdefghijklmnop')
+    with pytest.raises(ValueError, match='boom'):
+        ctx.eval('api.util.boom()')
+    assert ctx.get_global('api.util.add')(3, 4) == 7
+
+    # the table is reused by other contexts and threads
+    other = duktape.Context()
+    other.register(None, table, lightfunc=lightfunc)
+    assert other.eval('add(1, 1)') == 2
+    th = ctx.new_thread(True)
+    th.register('util', table, lightfunc=lightfunc)
+    assert th.eval('util.add(2, 2)') == 4
+
+    ctx['api'] = 1
+    with pytest.raises(TypeError):
+        ctx.register('api.util', table)
+
+    # throwing accessors and frozen namespaces raise instead of aborting
+    top = len(ctx)
+    ctx.eval('''
+        var frozen = Object.freeze({});
+        Object.defineProperty(this, 'broken', {get: function() { throw new Error('getter'); }});
+        var guarded = {};
+        Object.defineProperty(guarded, 'add', {set: function() { throw new Error('setter'); }});
+    ''')
+    with pytest.raises(duktape.Error):
+        ctx.register('frozen', table, lightfunc=lightfunc)
+    with pytest.raises(duktape.Error, match='getter'):
+        ctx.register('broken.util', table, lightfunc=lightfunc)
+    with pytest.raises(duktape.Error, match='setter'):
+        ctx.register('guarded', table, lightfunc=lightfunc)
+    assert len(ctx) == top + 1  # eval leaves its result
+
+
+def test_register_max_callbacks():
+    ctx = duktape.Context()
+    table = ctx.register('many', {'f%d' % i: abs for i in range(duktape.MAX_CALLBACKS - 1)})
+    assert ctx.eval('many.f0(-1)') == 1
+    with pytest.raises(OverflowError):
+        ctx.register('more', {'a': abs, 'b': abs})
+    assert ctx.eval('typeof more') == 'undefined'
+    ctx.register('again', table)  # already registered
+    ctx.register('last', {'a': abs})
+    assert ctx.eval('again.f1(-2) + last.a(-3)') == 5
+
+
 def test_py_func_with_dict_arg_works():
     def foo(x):
         return x == {'foo': 1, 'bar': 2}
@@ -896,3 +992,1019 @@ def test_push_js_proxy():
     assert foo['b'] == 2
     assert ctx.eval('foo.b === 2')
     assert ctx.eval('bar.b === 2')
+
+
+def test_compile():
+    ctx = duktape.Context()
+    ctx['x'] = 1
+    inc = ctx.compile('x = x + 1; x;')
+    assert inc() == 2
+    assert inc() == 3
+    assert ctx['x'] == 3
+
+    with pytest.raises(duktape.Error):
+        ctx.compile('bad syntax bad bad bad')
+
+
+def test_compile_cache():
+    ctx = duktape.Context(compile_cache_size=2)
+    for i in range(3):
+        assert ctx.eval('1 + 1') == 2
+    info = ctx.compile_cache_info()
+    assert (info.hits, info.misses, info.maxsize, info.currsize) == (2, 1, 2, 1)
+
+    ctx.eval('2 + 2')
+    ctx.eval('3 + 3')
+    assert ctx.compile_cache_info().currsize == 2
+    # '1 + 1' has been evicted
+    assert ctx.eval('1 + 1') == 2
+    assert ctx.compile_cache_info().misses == 4
+
+    with tempfile.NamedTemporaryFile() as tf:
+        tf.write(b"var counter = (typeof counter === 'undefined') ? 1 : counter + 1;")
+        tf.flush()
+        ctx.load(tf.name)
+        ctx.load(tf.name)
+    assert ctx['counter'] == 2
+    assert ctx.compile_cache_info().hits == 3
+
+    ctx.clear_compile_cache()
+    assert ctx.compile_cache_info() == (0, 0, 2, 0)
+
+    ctx = duktape.Context(compile_cache_size=0)
+    ctx.eval('1 + 1')
+    ctx.eval('1 + 1')
+    assert ctx.compile_cache_info() == (0, 0, 0, 0)
+
+
+def test_compile_cache_hits_reserve_stack():
+    # eval results stay on the value stack, cache hits must grow it
+    ctx = duktape.Context()
+    for i in range(1000):
+        assert ctx.eval('1 + 1') == 2
+    assert ctx.compile_cache_info().hits == 999
+
+
+def test_compile_cache_thread_new_globalenv():
+    ctx = duktape.Context()
+    ctx['foo'] = 1
+    assert ctx.eval('foo') == 1
+
+    th = ctx.new_thread(True)
+    th['foo'] = 2
+    assert th.eval('foo') == 2
+    assert ctx.eval('foo') == 1
+
+
+def test_bytecode_dump_and_load():
+    ctx = duktape.Context()
+    bytecode = ctx.dump_bytecode('answer.js', source='var answer = 6 * 7;')
+    assert isinstance(bytecode, bytes)
+
+    ctx = duktape.Context()
+    ctx.load_bytecode(bytecode)
+    assert ctx['answer'] == 42
+
+    with tempfile.NamedTemporaryFile() as tf:
+        tf.write(b"this.question = answer - 1;")
+        tf.flush()
+        bytecode = ctx.dump_bytecode(tf.name)
+    ctx.load_bytecode(bytecode)
+    assert ctx['question'] == 41
+
+    # sources are not truncated at a NUL
+    bytecode = ctx.dump_bytecode('nul.js', source="var nul = 'a\0b'; var after = 1;")
+    ctx.load_bytecode(bytecode)
+    assert ctx.eval('nul.length') == 3
+    assert ctx['after'] == 1
+
+    with pytest.raises(duktape.Error):
+        ctx.load_bytecode(b'not bytecode')
+
+
+def test_bytecode_cache():
+    with tempfile.TemporaryDirectory() as cache_dir, \
+            tempfile.TemporaryDirectory() as src_dir:
+        script = os.path.join(src_dir, 'script.js')
+        with open(script, 'w') as f:
+            f.write("var fruit = require('./fruit');")
+        with open(os.path.join(src_dir, 'fruit.js'), 'w') as f:
+            f.write("module.exports = 'Apple';")
+
+        ctx = duktape.Context(module_path=src_dir, bytecode_cache=cache_dir)
+        ctx.load(script)
+        assert ctx['fruit'] == 'Apple'
+        assert len(os.listdir(cache_dir)) == 2
+
+        ctx = duktape.Context(module_path=src_dir, bytecode_cache=cache_dir)
+        ctx.load(script)
+        assert ctx['fruit'] == 'Apple'
+
+        # changing the source invalidates the cached bytecode
+        with open(os.path.join(src_dir, 'fruit.js'), 'w') as f:
+            f.write("module.exports = 'Banana';")
+        ctx = duktape.Context(module_path=src_dir, bytecode_cache=cache_dir)
+        ctx.load(script)
+        assert ctx['fruit'] == 'Banana'
+        assert len(os.listdir(cache_dir)) == 2
+
+
+def test_bytecode_cache_invalid():
+    import hashlib
+    with tempfile.TemporaryDirectory() as cache_dir, \
+            tempfile.TemporaryDirectory() as src_dir:
+        script = os.path.join(src_dir, 'script.js')
+        with open(script, 'w') as f:
+            f.write("var fruit = 'Apple';")
+        duktape.Context(bytecode_cache=cache_dir).load(script)
+        cache_file, = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)]
+        with open(cache_file, 'rb') as f:
+            header = f.read(duktape.BYTECODE_CACHE_HEADER.size)
+
+        # a corrupted body and a body which does not load are recompiled
+        for body, digest in [(b'corrupted', header[-20:]),
+                             (b'not bytecode', hashlib.sha1(b'not bytecode').digest())]:
+            with open(cache_file, 'wb') as f:
+                f.write(header[:-20] + digest + body)
+            ctx = duktape.Context(bytecode_cache=cache_dir)
+            ctx.load(script)
+            assert ctx['fruit'] == 'Apple'
+            assert len(ctx) == 0
+
+
+def test_bytecode_cache_modules():
+    with tempfile.TemporaryDirectory() as cache_dir, \
+            tempfile.TemporaryDirectory() as src_dir:
+        with open(os.path.join(src_dir, 'mod.js'), 'w') as f:
+            f.write("exports.strict = (function() { return !this; })();"
+                    "exports.dirname = typeof __dirname;"
+                    "exports.filename = __filename;"
+                    "try { exports.name = arguments.callee.name; } catch (e) {}")
+        # strict and non strict contexts do not share the module wrappers
+        for strict in [False, True]:
+            ctx = duktape.Context(module_path=src_dir, force_strict=strict)
+            expected = ctx.eval('require("mod")')
+            assert expected['strict'] is strict
+            for i in range(2):
+                ctx = duktape.Context(module_path=src_dir, bytecode_cache=cache_dir,
+                                      force_strict=strict)
+                # the cached wrapper is called like the uncached one
+                assert ctx.eval('require("mod")') == expected
+        assert len(os.listdir(cache_dir)) == 2
+
+
+def test_cesu8_strings():
+    ctx = duktape.Context()
+    ctx.eval("function identity(x) { return x; }")
+    identity = ctx['identity']
+    for s in ['', 'ascii', 'caf\xe9', '€ uro', '한국어',
+              'a\U0001f600b\U0001f600', '\ud83d', 'x' * 100000]:
+        assert identity(s) == s
+        assert identity({s: s}) == {s: s}
+    assert ctx.eval("'\\ud83d'.length") == 1
+    assert ctx.eval("'\\ud83d'") == '\ud83d'
+    assert ctx.eval("'€\\ud83d\\ude00'") == '€\U0001f600'
+
+
+def test_get_json():
+    ctx = duktape.Context()
+    ctx.eval('var foo = {a: [1, 2.5, "\U0001f600"], b: {c: null}, d: function() {}, e: undefined}')
+    assert ctx.get_json('foo') == {'a': [1, 2.5, '\U0001f600'], 'b': {'c': None}}
+    assert ctx.get_json('undefined_value') is None
+
+
+@pytest.mark.parametrize('marshal', ['native', 'json'])
+def test_marshal(marshal):
+    ctx = duktape.Context(marshal=marshal)
+    data = [{'id': i, 'name': 'item %d' % i, 'tags': ['a', 'b']} for i in range(10)]
+    ctx['data'] = data
+    assert ctx.eval('data') == data
+    assert ctx.eval('data[0]') == data[0]
+    assert ctx.eval('[]') == []
+
+    with pytest.raises(ValueError):
+        duktape.Context(marshal='xml')
+    with pytest.raises(ValueError):
+        duktape.Context(marshal='auto')
+
+
+def test_to_python_builtins_thread():
+    ctx = duktape.Context()
+    for thread in (ctx, ctx.new_thread(False), ctx.new_thread(True)):
+        assert thread.eval('Object.create(null)') == {}
+        assert thread.eval('({a: {b: [1]}})') == {'a': {'b': [1]}}
+        assert thread.eval('new Date(0)') == datetime.datetime(1970, 1, 1)
+        assert str(thread.eval('new TypeError("boom")')) == 'boom'
+        assert isinstance(thread.eval('(function() {})'), duktape.JsFunc)
+
+
+def test_proxy_refs_released():
+    ctx = duktape.Context()
+    ctx.eval('''
+        var finalized = 0;
+        function make() {
+            var func = function() { return 1; };
+            Duktape.fin(func, function() { finalized++; });
+            return func;
+        }''')
+    make = ctx.eval('make')
+    proxies = [make() for i in range(100)]
+    same = [ctx.eval('make') for i in range(10)]
+    ctx.gc()
+    assert ctx['finalized'] == 0
+
+    del proxies[:50]
+    ctx.gc()
+    assert ctx['finalized'] == 50
+
+    # freed slots are reused
+    proxies.extend(make() for i in range(50))
+    assert [p() for p in proxies] == [1] * 100
+    del proxies, same
+    ctx.gc()
+    assert ctx['finalized'] == 150
+    assert make() is not None
+
+
+def test_func_map():
+    ctx = duktape.Context()
+    ctx.eval('''
+        function score(a, b) {
+            if (a < 0) throw new RangeError('negative');
+            return a * (b || 1);
+        }''')
+    score = ctx.eval('score')
+    stack_len = len(ctx)
+    assert score.map(range(5)) == [0, 1, 2, 3, 4]
+    assert score.starmap([(1, 2), (3,), (4, 5)]) == [2, 3, 20]
+
+    results = score.map([1, -1, object(), 2])
+    assert results[0] == 1 and results[3] == 2
+    assert isinstance(results[1], duktape.Error)
+    assert 'negative' in str(results[1])
+    assert isinstance(results[2], TypeError)
+
+    results = score.starmap(((i, 2) for i in range(10)), chunk_size=3)
+    assert not isinstance(results, list)
+    assert list(results) == [i * 2 for i in range(10)]
+    assert list(score.map([], chunk_size=3)) == []
+    with pytest.raises(ValueError):
+        score.map([1], chunk_size=0)
+    assert len(ctx) == stack_len
+
+
+def test_context_pool():
+    pool = duktape.ContextPool(size=2, force_strict=True)
+    assert pool.stats().creations == 2
+    with pool.checkout() as ctx:
+        assert ctx.force_strict
+        ctx.eval('var foo = 1')
+        with pool.checkout() as other:
+            assert other is not ctx
+            with pytest.raises(TimeoutError):
+                with pool.checkout(timeout=0.01):
+                    pass
+    stats = pool.stats()
+    assert (stats.checkouts, stats.creations, stats.idle, stats.in_use) == (2, 2, 2, 0)
+
+    def work():
+        for i in range(20):
+            with pool.checkout() as ctx:
+                assert ctx.eval('1 + 1') == 2
+    threads = [threading.Thread(target=work) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert pool.stats().checkouts == 82
+    assert pool.stats().creations == 2
+
+    with pytest.raises(TypeError):
+        duktape.ContextPool(lambda: duktape.Context(), force_strict=True)
+
+
+def test_context_pool_reset():
+    pool = duktape.ContextPool(lambda: duktape.Context(), size=1, reset='snapshot')
+    with pool.checkout() as ctx:
+        ctx.eval('var foo = 1; bar = 2; Math = null;')
+    with pool.checkout() as ctx:
+        assert ctx.eval('typeof foo') == 'undefined'
+        assert ctx.eval('typeof bar') == 'undefined'
+        assert ctx.eval('Math.max(1, 2)') == 2
+        assert len(ctx) == 3
+
+    pool = duktape.ContextPool(size=1, max_idle=0)
+    with pool.checkout() as ctx:
+        pass
+    time.sleep(0.01)
+    with pool.checkout() as other:
+        assert other is not ctx
+    assert pool.stats().discards == 2
+    pool.close()
+    assert pool.stats().idle == 0
+    with pytest.raises(RuntimeError):
+        pool.acquire()
+
+    # waiting threads are woken up by close()
+    pool = duktape.ContextPool(size=1)
+    errors = []
+
+    def wait():
+        try:
+            pool.acquire()
+        except RuntimeError as e:
+            errors.append(e)
+    with pool.checkout():
+        thread = threading.Thread(target=wait)
+        thread.start()
+        time.sleep(0.01)
+        pool.close()
+        thread.join()
+    assert len(errors) == 1
+    assert pool.stats().in_use == 0
+
+
+def test_release_gil():
+    ctx = duktape.Context(module_path=os.path.join(TEST_DIR, 'node_modules'), release_gil=True)
+    ctx['add'] = lambda a, b: a + b
+    assert ctx.eval('add(1, 2)') == 3
+    assert ctx.eval('require("a").foo') == 'a'
+    ctx['div'] = lambda a, b: a / b
+    with pytest.raises(ZeroDivisionError):
+        ctx.eval('div(1, 0)')
+    with pytest.raises(duktape.Error, match='Cannot find module'):
+        ctx.eval('require("missing")')
+    with pytest.raises(duktape.Error, match="Cannot find module '%s'"):
+        ctx.eval('require("%s")')
+
+    def run(results, i):
+        results[i] = duktape.Context(release_gil=True).eval(
+            'var n = 0; for (var i = 0; i < 100000; i++) { n += i; } n')
+    results = [None] * 4
+    threads = [threading.Thread(target=run, args=(results, i)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [4999950000] * 4
+
+
+def assert_gil_released():
+    thread = threading.Thread(target=lambda: None)
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_release_gil_throwing_callbacks():
+    # JS errors thrown while Duktape calls back into C must not leave the GIL
+    # acquired
+    ctx = duktape.Context(release_gil=True)
+    ctx['f'] = lambda value: value
+    ctx['now'] = datetime.datetime(2020, 1, 2)
+    ctx.eval('''
+        function caught(func) {
+            try { func(); } catch (e) { return String(e.message || e); }
+        }
+        Object.defineProperty(Date.prototype, 'boom', {get: function() { throw new Error('date'); }});
+        function Foo() {}
+        Object.defineProperty(Foo.prototype, 'boom', {
+            get: function() { throw new Error('get'); },
+            set: function() { throw new Error('set'); }
+        });
+        var foo = new ThreadOnly(Foo, 'foo');
+    ''')
+    assert 'boom' in ctx.eval('''caught(function() { f({get x() { throw new Error('boom'); }}); })''')
+    assert 'boom' in ctx.eval('''caught(function() {
+        var items = [1]; Object.defineProperty(items, 0, {get: function() { throw new Error('boom'); }});
+        f(items);
+    })''')
+    assert_gil_released()
+    assert ctx.eval('new PythonError(1, 2, 3).name') == 'PythonError(1)'
+    assert ctx.eval('caught(function() { new PythonError({toString: null, valueOf: null}); })')
+    assert_gil_released()
+    assert ctx.eval('caught(function() { now.boom; })') == 'date'
+    assert_gil_released()
+    assert ctx.eval('caught(function() { foo.boom; })') == 'foo has not been initialized!'
+    thread = ctx.new_thread(False)
+    thread.init_thread_only('foo')
+    assert thread.eval('caught(function() { foo.boom; })') == 'get'
+    assert thread.eval('caught(function() { foo.boom = 1; })') == 'set'
+    assert_gil_released()
+
+    # the conversion of a value returned to Python raises
+    with pytest.raises(duktape.Error, match='boom'):
+        ctx.eval('({get x() { throw new Error("boom"); }})')
+    assert_gil_released()
+
+
+def test_release_gil_deferred_proxy_release():
+    ctx = duktape.Context(release_gil=True)
+    ctx.eval('''
+        var finalized = 0;
+        function make() {
+            var func = function() {};
+            Duktape.fin(func, function() { finalized++; });
+            return func;
+        }''')
+    make = ctx.eval('make')
+    proxies = [make() for i in range(10)]
+    started = threading.Event()
+
+    def drop():
+        started.wait()
+        proxies.clear()
+    ctx['started'] = started.set
+    thread = threading.Thread(target=drop)
+    thread.start()
+    # the proxies are dropped while the loop runs without the GIL
+    ctx.eval('started(); var t = Date.now(); while (Date.now() - t < 200);')
+    thread.join()
+    ctx.gc()
+    assert ctx['finalized'] == 10
+
+
+def test_timeout():
+    ctx = duktape.Context(timeout=0.1)
+    started = time.monotonic()
+    with pytest.raises(duktape.TimeoutError, match='execution timeout'):
+        ctx.eval('while (true);')
+    assert time.monotonic() - started < 1
+    # catch blocks can not swallow the timeout
+    with pytest.raises(duktape.TimeoutError):
+        ctx.eval('for (;;) { try { while (true); } catch (e) {} }')
+    with pytest.raises(duktape.TimeoutError):
+        ctx.eval('while (true);', timeout=0.01)
+    loop = ctx.eval('(function() { while (true); })')
+    with pytest.raises(duktape.TimeoutError):
+        loop()
+    with pytest.raises(duktape.Error) as excinfo:
+        ctx.eval('throw new RangeError("not a timeout")')
+    assert not isinstance(excinfo.value, duktape.TimeoutError)
+    assert ctx.eval('1 + 1') == 2
+
+    # nested calls share the budget of the outermost one
+    ctx = duktape.Context()
+    ctx['nested'] = lambda: ctx.eval('while (true);')
+    with pytest.raises(duktape.TimeoutError):
+        ctx.eval('nested()', timeout=0.05)
+    with pytest.raises(duktape.TimeoutError):
+        ctx.new_thread(False).eval('while (true);', timeout=0.01)
+
+    # constructors, getters, setters and methods called from Python are
+    # limited too
+    ctx = duktape.Context(timeout=0.05)
+    ctx.eval('''
+        function Loop() { while (true); }
+        var obj = {get loop() { while (true); }, set loop(v) { while (true); },
+                   get fail() { throw new Error("getter"); }};
+        var arr = [1, 2];
+        Array.prototype.splice = function() { while (true); };
+    ''')
+    top = len(ctx)
+    with pytest.raises(duktape.TimeoutError):
+        ctx['loop'] = duktape.JsNew('Loop')
+    obj = ctx.proxy('obj')
+    with pytest.raises(duktape.TimeoutError):
+        obj['loop']
+    with pytest.raises(duktape.TimeoutError):
+        obj['loop'] = 1
+    with pytest.raises(duktape.Error, match='getter'):
+        obj['fail']
+    with pytest.raises(KeyError):
+        obj['missing']
+    with pytest.raises(duktape.TimeoutError):
+        ctx.proxy('arr').insert(0, 0)
+    assert len(ctx) == top
+
+
+def test_max_ops():
+    ctx = duktape.Context(max_ops=duktape.EXEC_CHECK_INTERVAL * 4)
+    assert ctx.eval('var n = 0; for (var i = 0; i < 1000; i++) { n += i; } n') == 499500
+    with pytest.raises(duktape.TimeoutError):
+        ctx.eval('for (var i = 0; i < 1e9; i++);')
+
+
+@pytest.mark.parametrize('allocator', ['malloc', 'pool'])
+def test_memory_limit(allocator):
+    ctx = duktape.Context(memory_limit=2 * 1024 * 1024, allocator=allocator)
+    stats = ctx.memory_stats()
+    assert 0 < stats.used <= stats.peak <= stats.limit
+    assert ctx.eval('var a = []; for (var i = 0; i < 1000; i++) { a.push("x" + i); } a.length') == 1000
+
+    with pytest.raises(duktape.Error, match='alloc failed'):
+        ctx.eval('var big = []; while (true) { big.push(new Array(1000).join("x") + big.length); }')
+    stats = ctx.memory_stats()
+    assert stats.failed > 0
+    assert stats.peak <= stats.limit
+    assert stats.allocs > stats.frees > 0
+
+    # the heap is still usable once the garbage is collected
+    ctx.eval('big = null')
+    ctx.gc()
+    assert ctx.memory_stats().used < stats.used
+    assert ctx.eval('"a" + "b"') == 'ab'
+
+    with pytest.raises(ValueError):
+        duktape.Context(allocator='tcmalloc')
+    with pytest.raises(MemoryError):
+        duktape.Context(memory_limit=1024)
+
+
+def test_module_cache():
+    ctx = duktape.Context(module_path=os.path.join(TEST_DIR, 'node_modules'))
+    cache = ctx.module_cache
+    assert ctx.eval('require("c").foo') == 'c'
+    misses = cache.misses
+    assert misses > 0
+    # require() caches the loaded modules, resolutions are shared by contexts
+    other = duktape.Context(module_path=os.path.join(TEST_DIR, 'node_modules'), module_cache=cache)
+    assert other.eval('require("c").foo') == 'c'
+    assert cache.misses == misses and cache.hits > 0
+
+    for i in range(2):
+        with pytest.raises(duktape.Error, match='Cannot find module'):
+            ctx.eval('require("missing")')
+    assert cache.misses == misses + 2
+
+    ctx.clear_module_cache()
+    assert len(cache) == 0
+    assert not duktape.Context(module_cache=False).module_cache
+
+    # failed resolutions are only cached with negative=True
+    with tempfile.TemporaryDirectory() as module_dir:
+        ctx = duktape.Context(module_path=module_dir)
+        negative = duktape.Context(module_path=module_dir,
+                                   module_cache=duktape.ModuleCache(negative=True))
+        for context in [ctx, negative]:
+            with pytest.raises(duktape.Error, match='Cannot find module'):
+                context.eval('require("late")')
+        with open(os.path.join(module_dir, 'late.js'), 'w') as f:
+            f.write('exports.foo = 1;')
+        assert ctx.eval('require("late").foo') == 1
+        with pytest.raises(duktape.Error, match='Cannot find module'):
+            negative.eval('require("late")')
+        assert negative.module_cache.hits == 1
+
+
+def test_module_cache_validate():
+    with tempfile.TemporaryDirectory() as module_dir:
+        cache = duktape.ModuleCache(validate=True)
+        ctx = duktape.Context(module_path=module_dir, module_cache=cache)
+        with pytest.raises(duktape.Error, match='Cannot find module'):
+            ctx.eval('require("mod")')
+        with open(os.path.join(module_dir, 'mod.js'), 'w') as f:
+            f.write('exports.foo = 1;')
+        assert ctx.eval('require("mod").foo') == 1
+
+        os.makedirs(os.path.join(module_dir, 'pkg', 'lib'))
+        for name in ['a', 'b']:
+            with open(os.path.join(module_dir, 'pkg', 'lib', name + '.js'), 'w') as f:
+                f.write('exports.name = "%s";' % name)
+        with open(os.path.join(module_dir, 'pkg', 'package.json'), 'w') as f:
+            f.write('{"main": "lib/a.js"}')
+        assert duktape.Context(module_path=module_dir, module_cache=cache).eval('require("pkg").name') == 'a'
+        with open(os.path.join(module_dir, 'pkg', 'package.json'), 'w') as f:
+            f.write('{"main": "lib/b.js"}')
+        os.utime(os.path.join(module_dir, 'pkg', 'package.json'), ns=(0, 0))
+        os.remove(os.path.join(module_dir, 'pkg', 'lib', 'a.js'))
+        assert duktape.Context(module_path=module_dir, module_cache=cache).eval('require("pkg").name') == 'b'
+
+
+MODULES = {
+    'main.js': 'var lib = require("./lib"); exports.total = lib.add(1, 2) + require("pkg").value;',
+    'lib/index.js': 'exports.add = function(a, b) { return a + b; };',
+    'node_modules/pkg/package.json': '{"main": "src/pkg.js"}',
+    'node_modules/pkg/src/pkg.js': 'exports.value = require("./data.json").value;',
+    'node_modules/pkg/src/data.json': '{"value": "€"}',
+}
+
+
+def check_module_loader(loader):
+    ctx = duktape.Context(module_path='node_modules', module_loader=loader, force_strict=True)
+    assert ctx.eval('require("pkg").value') == '€'
+    assert ctx.eval('require("./main").total') == '3€'
+    with pytest.raises(duktape.Error, match="Cannot find module 'missing'"):
+        ctx.eval('require("missing")')
+
+
+def test_dict_loader():
+    check_module_loader(duktape.DictLoader(MODULES))
+
+    loader = duktape.DictLoader({'broken.js': 'exports.a = ;'})
+    with pytest.raises(duktape.Error, match='SyntaxError'):
+        duktape.Context(module_loader=loader).eval('require("broken")')
+
+
+def test_unhashable_loader():
+    class Loader(duktape.DictLoader):
+        __hash__ = None
+    check_module_loader(Loader(MODULES))
+
+
+def test_directory_and_zip_loader():
+    import zipfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with zipfile.ZipFile(os.path.join(tmp_dir, 'bundle.zip'), 'w') as zf:
+            for path, source in MODULES.items():
+                zf.writestr(path, source)
+                os.makedirs(os.path.join(tmp_dir, 'root', os.path.dirname(path)), exist_ok=True)
+                with open(os.path.join(tmp_dir, 'root', path), 'w', encoding='utf-8') as f:
+                    f.write(source)
+        check_module_loader(duktape.ZipLoader(os.path.join(tmp_dir, 'bundle.zip')))
+        check_module_loader(duktape.DirectoryLoader(os.path.join(tmp_dir, 'root')))
+
+
+def test_mmap_loader():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bundle = os.path.join(tmp_dir, 'bundle.dukb')
+        duktape.MmapLoader.build(bundle, MODULES)
+        loader = duktape.MmapLoader(bundle)
+        check_module_loader(loader)
+        loader.close()
+
+        duktape.MmapLoader.build(bundle, os.path.join(TEST_DIR, 'node_modules'))
+        loader = duktape.MmapLoader(bundle)
+        assert duktape.Context(module_loader=loader).eval('require("a").fruit') == 'Apple'
+        # live views keep the map open after close()
+        view = loader.read('a/index.js')
+        loader.close()
+        assert bytes(view).startswith(b'const b')
+        assert not loader.isfile('a/index.js')
+        loader.close()
+
+        with open(bundle, 'wb') as f:
+            f.write(b'not a bundle' * 2)
+        with pytest.raises(ValueError):
+            duktape.MmapLoader(bundle)
+
+
+def test_buffers():
+    ctx = duktape.Context()
+    ctx['data'] = b'\x01\x02\x03'
+    assert ctx.eval('data instanceof Uint8Array && data.length') == 3
+    assert ctx.eval('data[0] = 42; data[0]') == 42
+
+    # bytearrays are shared with JS
+    buf = bytearray(b'abc')
+    ctx['buf'] = buf
+    ctx.eval('buf[0] = 65')
+    assert buf == bytearray(b'Abc')
+    with pytest.raises(BufferError):
+        buf.append(1)
+    ctx.eval('buf = null')
+    ctx.gc()
+    buf.append(1)
+
+    view = ctx.eval('var arr = new Uint16Array([1, 2, 3]); arr')
+    assert isinstance(view, memoryview)
+    assert view.cast('H').tolist() == [1, 2, 3]
+    view.cast('H')[1] = 7
+    assert ctx.eval('arr[1]') == 7
+    assert ctx.eval('(function(x) { return x === arr; })')(view)
+    assert bytes(ctx.eval('new ArrayBuffer(2)')) == b'\x00\x00'
+
+    # the to_js_hook comes first
+    def hook(value, helper):
+        if isinstance(value, bytes):
+            return value.decode()
+        raise TypeError()
+    ctx = duktape.Context(to_js_hook=hook)
+    ctx['text'] = b'abc'
+    ctx['buf'] = bytearray(b'abc')
+    assert ctx.eval('text') == 'abc'
+    assert ctx.eval('buf instanceof Uint8Array')
+
+
+def test_lazy():
+    ctx = duktape.Context()
+    ctx.eval('var big = []; for (var i = 0; i < 1000; i++) big.push({id: i});')
+    big = ctx.eval('big', lazy=True)
+    assert isinstance(big, duktape.JsArray)
+    assert big[-1]['id'] == 999
+    assert [item['id'] for item in big[-3:]] == [997, 998, 999]
+    assert [item['id'] for item in big[10:1:-4]] == [10, 6, 2]
+    with pytest.raises(IndexError):
+        big[-1001]
+    for index in [1000, 2 ** 32, 2 ** 64]:
+        with pytest.raises(IndexError):
+            big[index]
+    assert isinstance(ctx.eval('({a: 1})', lazy=True), duktape.JsDict)
+    assert ctx.eval('1', lazy=True) == 1
+    assert ctx.eval('big.length') == 1000
+
+    ctx = duktape.Context(lazy=True)
+    get = ctx.eval('(function(n) { return {n: n}; })')
+    assert isinstance(get(1), duktape.JsDict)
+    assert get(1, lazy=False) == {'n': 1}
+    assert isinstance(ctx.new_thread(False).eval('[]'), duktape.JsArray)
+
+
+def test_proxy_iteration():
+    ctx = duktape.Context()
+    ctx.eval('var arr = []; for (var i = 0; i < 3000; i++) arr.push(i); arr.push([1], {a: 1});')
+    arr = ctx.proxy('arr')
+    top = len(ctx)
+    assert len(arr) == 3002
+    items = list(arr)
+    assert items[:3000] == list(range(3000))
+    assert isinstance(items[-2], duktape.JsArray) and isinstance(items[-1], duktape.JsDict)
+    assert 2999 in arr and 3000 not in arr and 'x' not in arr
+    assert True in arr and None not in arr
+    assert arr.to_list()[-2:] == [[1], {'a': 1}]
+    for i in arr:
+        break
+    assert len(ctx) == top
+
+    ctx.eval('var obj = {a: 1, b: [2], c: undefined}')
+    obj = ctx.proxy('obj')
+    top = len(ctx)
+    assert len(obj) == 3
+    assert list(obj) == ['a', 'b', 'c']
+    assert 'c' in obj and 'toString' not in obj
+    assert 1 not in obj and None not in obj and ('a',) not in obj
+    assert [k for k, v in obj.items()] == ['a', 'b', 'c']
+    assert list(obj.values())[0] == 1 and list(obj.values())[1].to_list() == [2]
+    assert obj.to_dict() == {'a': 1, 'b': [2], 'c': None}
+    assert len(ctx) == top
+
+
+def test_global_cache():
+    ctx = duktape.Context()
+    ctx.eval('var ns = {Point: function Point(x) { this.x = x; }, n: 1}')
+    point = ctx.resolve('ns.Point')
+    assert ctx.get_global('ns.n') == 1
+    assert ctx.get_global('ns.missing') is None
+    assert isinstance(ctx.get_global(point), duktape.JsFunc)
+
+    ctx['p'] = duktape.JsNew(point, 2)
+    assert ctx.eval('p instanceof ns.Point && p.x') == 2
+    assert ctx.proxy(point)(3) is None
+
+    # lookups by name and uncached handles see the assignments made by JS
+    ctx.eval('ns.Point = Array')
+    ctx['p'] = duktape.JsNew(point)
+    assert ctx.eval('Array.isArray(p)')
+    ctx['p'] = duktape.JsNew('ns.Point')
+    assert ctx.eval('Array.isArray(p)')
+    assert ctx.proxy('ns.Point')(1, 2) == [1, 2]
+
+    # a cached handle keeps its object until refreshed
+    cached = ctx.resolve('ns.Point', cache=True)
+    ctx['p'] = duktape.JsNew(cached)
+    ctx.eval('ns.Point = Date')
+    assert ctx.eval('p instanceof Array')
+    ctx['p'] = duktape.JsNew(cached)
+    assert ctx.eval('p instanceof Array')
+    ctx['p'] = duktape.JsNew('ns.Point', 0)
+    assert ctx.eval('p instanceof Date')
+    cached.refresh()
+    ctx['p'] = duktape.JsNew(cached, 0)
+    assert ctx.eval('p instanceof Date')
+
+    def hook(value, helper):
+        if helper.instanceof(point):
+            return ('point', value['x'])
+        raise TypeError()
+
+    ctx = duktape.Context(to_py_hook=hook)
+    ctx.eval('var ns = {Point: function Point(x) { this.x = x; }}')
+    point = ctx.resolve('ns.Point', cache=True)
+    assert ctx.eval('[new ns.Point(1), new ns.Point(2)]') == [('point', 1), ('point', 2)]
+
+
+def test_event_loop():
+    async def main():
+        ctx = duktape.Context()
+        event_loop = duktape.EventLoop(ctx)
+        ctx.eval('''
+            var log = [], n = 0;
+            var interval = setInterval(function() {
+                log.push('interval');
+                if (++n == 3) clearInterval(interval);
+            }, 2);
+            setTimeout(function(a, b) { log.push(a + b); }, 1, 'time', 'out');
+            clearTimeout(setTimeout(function() { log.push('cancelled'); }, 1));
+            setImmediate(function() { log.push('immediate'); });
+            Promise.resolve().then(function() { log.push('then'); });
+        ''')
+        await event_loop.wait()
+        assert ctx['log'] == ['then', 'immediate', 'timeout'] + ['interval'] * 3
+
+        delayed = ctx.eval('''var delayed = function(x) {
+            return new Promise(function(resolve) { setTimeout(resolve, 5, x * 2); });
+        }; delayed''')
+        assert await asyncio.gather(*[delayed(i) for i in range(500)]) == list(range(0, 1000, 2))
+        assert await ctx.eval('Promise.all([1, Promise.resolve(2), delayed(1.5)])') == [1, 2, 3]
+        with pytest.raises(duktape.Error, match='bad'):
+            await ctx.eval('Promise.resolve().then(function() { throw new TypeError("bad"); })')
+
+        with pytest.raises(ValueError):
+            duktape.EventLoop(ctx)
+
+    asyncio.run(main())
+
+
+def test_event_loop_zero_interval():
+    with pytest.raises(RuntimeError):
+        duktape.EventLoop(duktape.Context())  # no running loop
+
+    loop = asyncio.new_event_loop()
+    try:
+        ctx = duktape.Context()
+        event_loop = duktape.EventLoop(ctx, loop)
+        ctx.eval('''
+            var n = 0, id = setInterval(function() { n++; }, 0);
+            setTimeout(function() { clearInterval(id); }, 10);
+        ''')
+        event_loop.run_until_idle()
+        assert 0 < ctx['n'] <= 11
+    finally:
+        loop.close()
+
+
+def test_event_loop_coroutines():
+    events = []
+
+    async def fetch(x):
+        events.append(('start', x))
+        await asyncio.sleep(0.05)
+        events.append(('end', x))
+        if x < 0:
+            raise ValueError('negative')
+        return x * 2
+
+    async def main():
+        ctx = duktape.Context()
+        event_loop = duktape.EventLoop(ctx)
+        ctx['fetch'] = fetch
+        ctx['fetch2'] = duktape.PyFunc(fetch, 1)
+
+        results = await ctx.eval('Promise.all([1, 2, 3].map(function(x) { return fetch(x); }))')
+        assert results == [2, 4, 6]
+        # the calls overlap
+        assert [event for event, x in events] == ['start'] * 3 + ['end'] * 3
+
+        ctx.eval('''
+            var caught;
+            fetch2(-1).then(null, function(e) { caught = e.message; });
+        ''')
+        await event_loop.wait()
+        assert ctx['caught'] == 'negative'
+        with pytest.raises(ValueError, match='negative'):
+            await ctx.eval('fetch(-1)')
+
+        # the task is cancelled when its Promise cannot be created
+        event_loop.deferred = ctx.eval('(function() { throw new Error("no promise"); })')
+        del events[:]
+        with pytest.raises(duktape.Error, match='no promise'):
+            ctx.eval('fetch(1)')
+        assert not event_loop.tasks
+        await asyncio.sleep(0)
+        assert events == []
+
+    asyncio.run(main())
+
+
+def test_thread_context_pool():
+    ctx = duktape.Context()
+    ctx.eval('var shared = 1;')
+    pool = ctx.thread_pool(size=2, init=lambda thread: thread.eval('var answer = 42;'))
+    for i in range(5):
+        with pool.checkout() as thread:
+            assert thread.eval('typeof shared') == 'undefined'
+            assert thread.eval('typeof leaked') == 'undefined'
+            assert thread.eval('answer') == 42
+            thread.eval('var leaked = answer = 1;')
+    stats = pool.stats()
+    assert stats.creations == 2 and stats.checkouts == 5
+
+    with pool.checkout(), pool.checkout():
+        with pytest.raises(TimeoutError):
+            pool.acquire()
+
+    shared = ctx.thread_pool(new_globalenv=False)
+    with shared.checkout() as thread:
+        assert thread.eval('shared') == 1
+    with pytest.raises(ValueError):
+        ctx.thread_pool(new_globalenv=False, reset='snapshot')
+
+    # threads are unregistered when their ThreadContext is deallocated
+    threads = [ctx.new_thread(False) for i in range(10)]
+    del threads
+    pool.close()
+    shared.close()
+    gc.collect()
+    ctx.gc()
+    for i in range(10):
+        assert ctx.new_thread(True).eval('1 + 1') == 2
+
+
+def init_worker(ctx, offset):
+    ctx['offset'] = offset
+
+
+@pytest.mark.parametrize('fork_after_warm', [False, True])
+def test_process_executor(fork_after_warm):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        script = os.path.join(tmp_dir, 'lib.js')
+        with open(script, 'w') as f:
+            f.write('var lib = {add: function(a, b) { return a + b + offset; }};'
+                    'function absolute(x) { return py_abs(x); }'
+                    'function fail() { throw new Error("fail"); }'
+                    'function swap() { lib.add = function(a, b) { return a * b; }; }')
+        with duktape.JsProcessExecutor(2, scripts=[script], functions={'py_abs': abs},
+                                       initializer=init_worker, initargs=(100,),
+                                       fork_after_warm=fork_after_warm) as executor:
+            assert executor.submit('lib.add', 1, 2).result() == 103
+            assert executor.submit('absolute', -5).result() == 5
+            assert list(executor.map('lib.add', range(10), range(10), chunksize=4)) == \
+                [i * 2 + 100 for i in range(10)]
+            with pytest.raises(TypeError):
+                executor.submit('offset').result()
+            with pytest.raises(TypeError):
+                executor.submit('absolute', 'x').result()
+            with pytest.raises(duktape.Error, match='fail'):
+                executor.submit('fail').result()
+
+        with duktape.JsProcessExecutor(1, scripts=[script], functions={'py_abs': abs},
+                                       initializer=init_worker, initargs=(0,),
+                                       fork_after_warm=fork_after_warm) as executor:
+            assert executor.submit('lib.add', 2, 3).result() == 5
+            executor.submit('swap').result()
+            assert executor.submit('lib.add', 2, 3).result() == 6
+
+
+def test_profiler():
+    ctx = duktape.Context()
+    ctx.eval('''
+        function inner(n) { var x = 0; for (var i = 0; i < n; i++) { x = (x + i) % 7; } return x; }
+        function outer(n) { return inner(n) + 1; }
+    ''', filename='profiled.js')
+    ctx.start_profiler(interval_ms=1)
+    with pytest.raises(RuntimeError):
+        ctx.start_profiler()
+    ctx.eval('outer(2e6)')
+    profiler = ctx.stop_profiler()
+    with pytest.raises(RuntimeError):
+        ctx.stop_profiler()
+
+    assert profiler.samples > 0
+    assert sum(profiler.stacks.values()) == profiler.samples
+    collapsed = profiler.collapsed(lines=False)
+    assert 'eval (eval);outer (profiled.js);inner (profiled.js) ' in collapsed
+    for line in profiler.collapsed().splitlines():
+        stack, count = line.rsplit(' ', 1)
+        assert int(count) > 0
+
+    ctx.eval('outer(2e6)')
+    assert profiler.samples == sum(profiler.stacks.values())
+
+    # accessors are not called from the interrupt
+    ctx = duktape.Context()
+    ctx.eval('''
+        function inner(n) { var x = 0; for (var i = 0; i < n; i++) { x = (x + i) % 7; } return x; }
+        Object.defineProperty(inner, 'name', {get: function() { throw new Error('name'); }});
+        Object.defineProperty(Object.prototype, '0', {set: function() { throw new Error('set'); }});
+    ''', filename='accessors.js')
+    ctx.start_profiler(interval_ms=1)
+    ctx.eval('inner(2e6)')
+    profiler = ctx.stop_profiler()
+    assert profiler.samples > 0
+    assert any(stack[-1][:2] == ('<anonymous>', 'accessors.js') for stack in profiler.stacks)
+
+
+def test_deeply_nested_values():
+    # deeper than the value stack space Duktape reserves for the API
+    ctx = duktape.Context()
+    value = [1]
+    for i in range(200):
+        value = [{'key': value}]
+    ctx['value'] = value
+    assert ctx['value'] == value
+    assert ctx.eval('JSON.stringify(value)').count('[') == 201
+
+    ctx.eval('var nested = {}; for (var i = 0; i < 500; i++) { nested = {inner: [nested]}; }')
+    nested = ctx['nested']
+    for i in range(500):
+        nested = nested['inner'][0]
+    assert nested == {}
+
+
+def test_getitem_pops():
+    def hook(value, helper):
+        raise ValueError('hook')
+
+    ctx = duktape.Context()
+    ctx.eval('var answer = 42;')
+    top = len(ctx)  # eval leaves its result
+    for i in range(100000):
+        assert ctx['answer'] == 42
+    assert len(ctx) == top
+
+    ctx = duktape.Context(to_py_hook=hook)
+    ctx.eval('function Foo() { this.a = 1; } var obj = new Foo();')
+    top = len(ctx)
+    with pytest.raises(ValueError):
+        ctx['obj']
+    assert len(ctx) == top